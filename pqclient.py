@@ -7,23 +7,48 @@
 
 # Files in c:\vproute on all TC computers:   pqclient.exe   pq1.bat thru pq9.bat
 
-import socket
-import select
-import requests
-from requests.exceptions import RequestException
+import asyncio
+import ssl
+import random
 import sys
+import gzip
+import base64
 import time
+from urllib.parse import urlencode, urlsplit, unquote
+from urllib.request import getproxies, proxy_bypass
 import argparse
+import itertools
+import sqlite3
+import logging
+from collections import deque
+
+from pqframe import Framer, PacketReader, pqframeexception, readsize
+from pqframe import v2hello, packet, flagack, flagnak, flagstatus, flagcompressed
+from pqframe import flagping, flagpong
+from pqframe import Decompressor, compressors, closewriter
+from pqlog import setuplogging
+
+log = logging.getLogger("pqclient")
+framelog = logging.getLogger("pqclient.frames")  # Raw traffic, at DEBUG
 
 # Globals
 version='1.0'
-eomstring = "</comm>"
 exit_code=0
 
 # Defaults for command-line args
-debug = True 
+debug = False
+loglevel = "info"  # Lowest level of message to log
+logframes = 0  # Recent frames to keep in memory for errors, exit and SIGUSR1, 0 to log them at debug level
 catchname = "https://work.brownleedatasystems.com/i/pqcatchlog.php"
 catchtimeout = 10
+catchqueuesize = 1000
+catchretrymax = 60  # Longest wait in seconds between retries of a failed post
+catchretrystatuses = (408, 429)  # 4xx answers worth retrying; any other 4xx drops the message
+spoolfile = "pqclient-{operatorid}.spool"
+catchpoolsize = 1
+catchbatch = 1  # Messages per post; 1 posts each as msg= like always
+catchbatchms = 50
+catchgzip = False  # Gzip post bodies; the catch URL's web server must inflate them
 medhost = 'localhost'
 medport = 5100
 firhost = 'localhost'
@@ -32,11 +57,21 @@ polhost = 'localhost'
 polport = 5300
 serverhost = '167.71.250.119'  #rms. server
 serverport = 6000
+pqconnecttimeout = 2  # Seconds to wait for a ProQA application to answer
+pqretrymax = 30  # Longest wait in seconds between ProQA reconnect attempts
+serverconnecttimeout = 5  # Seconds to connect and register with pqserver
+serverretrymax = 30  # Longest wait in seconds between pqserver reconnect attempts
+protocol = "auto"  # pqserver protocol: "1", "2", or "auto" to try 2 then fall back
+compression = "zstd,zlib"  # Compression to offer pqserver with protocol 2
 
 # Exceptions to throw
 class pqexception(Exception):
     pass
 
+# A kept-alive catch URL connection failed before answering
+class pqstaleexception(pqexception):
+    pass
+
 def parsecmdline():
     """parsecmdline() -- parses cmd-line arguments
 
@@ -50,8 +85,8 @@ def parsecmdline():
     options -- dictionary of selected command-line options
     """
 
-    # Since we'll be updating it later, use the global debug variable
-    global debug
+    # Since we'll be updating them later, use the global settings
+    global debug, catchgzip
 
     parser = argparse.ArgumentParser(
         description="Client into pqserver.py on rms. for communications between CAD and ProQA med,fire,police"
@@ -59,7 +94,19 @@ def parsecmdline():
 
     #-d / --debug
     parser.add_argument("-d", "--debug", dest="debug", default=debug,
-                        action="store_true", help="enable debugging outputs")
+                        action="store_true", help="enable debugging outputs (same as --log-level debug)")
+
+    #--log-level
+    parser.add_argument("--log-level", dest="loglevel", default=loglevel,
+                        choices=["debug", "info", "warning", "error"],
+                        help="lowest level of message to log")
+
+    #--log-frames
+    parser.add_argument("--log-frames", dest="logframes", type=int,
+                        default=logframes,
+                        help="keep this many recent frames in memory and log them when an error "
+                             "is logged, on exit and on SIGUSR1 (Unix), instead of logging "
+                             "every frame at debug level")
 
     #-o / --operator-id
     parser.add_argument("-o", "--operator-id", dest="operatorid",
@@ -110,15 +157,68 @@ def parsecmdline():
                         default=catchname,
                         help="URL to POST ProQA messages")
 
+    #--catch-queue
+    parser.add_argument("--catch-queue", dest="catchqueuesize", type=int,
+                        default=catchqueuesize,
+                        help="ProQA messages that may wait to be posted with --no-spool")
+
+    #--spool
+    parser.add_argument("--spool", dest="spoolfile",
+                        default=spoolfile,
+                        help="file to keep ProQA messages in until they are posted")
+
+    #--no-spool
+    parser.add_argument("--no-spool", dest="spoolfile", action="store_const", const=None,
+                        help="keep ProQA messages waiting to be posted in memory only")
+
+    #--catch-pool-size
+    parser.add_argument("--catch-pool-size", dest="catchpoolsize", type=int,
+                        default=catchpoolsize,
+                        help="keep-alive connections to hold open to the catch URL")
+
+    #--catch-batch
+    parser.add_argument("--catch-batch", dest="catchbatch", type=int,
+                        default=catchbatch,
+                        help="post up to this many ProQA messages at once as msg[] fields; "
+                             "above 1, even a lone message is posted as msg[]")
+
+    #--catch-batch-ms
+    parser.add_argument("--catch-batch-ms", dest="catchbatchms", type=float,
+                        default=catchbatchms,
+                        help="milliseconds to wait for a batch to fill before posting it")
+
+    #--read-size
+    parser.add_argument("--read-size", dest="readsize", type=int,
+                        default=readsize,
+                        help="bytes to request on each socket read")
+
+    #--protocol
+    parser.add_argument("--protocol", dest="protocol", choices=["auto", "1", "2"],
+                        default=protocol,
+                        help="protocol to talk to pqserver with; auto tries 2 and falls back to 1")
+
+    #--compression
+    parser.add_argument("--compression", dest="compression",
+                        default=compression,
+                        help="comma-separated compression methods to offer pqserver, or none")
+
+    #--catch-gzip
+    parser.add_argument("--catch-gzip", dest="catchgzip", default=catchgzip,
+                        action="store_true",
+                        help="gzip posts to the catch URL (its web server must accept them)")
+
     #parse arguments
     options = parser.parse_args()
 
-    # Set global debug setting from command-line options
+    # Set global settings from command-line options
     debug = options.debug
+    catchgzip = options.catchgzip
 
     if debug:
-        print("Processed command-line arguments:")
-        print(options)
+        options.loglevel = "debug"
+    setuplogging("pqclient", options.loglevel.upper(), options.logframes)
+
+    log.debug("Processed command-line arguments: %s", options)
 
     # Required argument
     if not options.operatorid:
@@ -126,7 +226,7 @@ def parsecmdline():
 
     return options
 
-def pqconnect(name, host, port):
+async def pqconnect(name, host, port):
     """pqconnect() -- Make connection to specified ProQA application
 
     Params:
@@ -138,21 +238,23 @@ def pqconnect(name, host, port):
     pqexception when connection can't be established with ProQA application
 
     Returns:
-    File descriptor of connected TCP socket
+    (reader, writer) asyncio streams of the connection
     """
 
     try:
-        return socket.create_connection((host, port))
+        return await asyncio.wait_for(asyncio.open_connection(host, port), pqconnecttimeout)
+    except asyncio.TimeoutError:
+        raise pqexception(f"Failed to connect to ProQA {name} on {host}:{port}: timed out")
     except OSError as e:
         raise pqexception(f"Failed to connect to ProQA {name} on {host}:{port}: {e}")
 
-def pqsend(name, conn, msg):
+async def pqsend(name, writer, msg):
     """pqsend() -- Send message to a ProQA application and respond with results
 
     Params:
     name -- human-friendly name of the application
-    conn -- file descriptor of the TCP socket to send to
-    msg -- string to send
+    writer -- asyncio.StreamWriter of the connection to send to
+    msg -- bytes to send
 
     Throws:
     pqexception when communication fails with ProQA application
@@ -162,267 +264,1522 @@ def pqsend(name, conn, msg):
     """
 
     try:
-        conn.sendall(msg)
-        print(f"Data successfully sent to ProQA {name}")
+        writer.write(msg)
+        await writer.drain()
+        log.debug("Data successfully sent to ProQA %s", name)
     except OSError as e:
         raise pqexception(f"Error sending to ProQA {name}: {e}")
 
     return True
 
-def serverconnect(host, port, operatorid):
-    """serverconnect() -- Keep retrying until connection can be made to PQServer
+class CatchSession:
+    """CatchSession -- Keep-alive HTTP/1.1 connections for posting to the catch URL
 
-    Params:
-    host -- hostname or IP where PQServer is listening
-    port -- TCP port number where PQServer is listening
-    operatorid -- numeric operator identifier
+    Just enough of an HTTP client for pqcatchlog.php, on asyncio streams so
+    a post never holds up anything else, and with nothing outside the
+    standard library for pyinstaller to bundle.  Up to poolsize idle
+    connections to each host are kept for the next post, so the TCP and
+    TLS handshakes are paid once rather than for every message.
 
-    Throws:
-    None
+    Proxies come from the environment (HTTP_PROXY, HTTPS_PROXY, ALL_PROXY
+    and NO_PROXY, or the Windows settings) as they did with requests.
+    Only http:// proxies are supported; https catch URLs are tunnelled
+    through them with CONNECT.
 
-    Returns:
-    File descriptor of connected TCP socket
+    verify is True to check the catch URL's certificate against the
+    system CAs, the name of a CA file to check it against, or False.
     """
 
-    conn = None
+    def __init__(self, poolsize=catchpoolsize, verify=True):
+        self.poolsize = poolsize
+        self.verify = verify
+        self.idle = {}  # (scheme, host, port) -> list of idle (reader, writer)
+        self.proxies = getproxies()
+        self.routes = {}  # (scheme, host, port) -> urlsplit() proxy, or None
 
-    while not conn:
-        try:
-            conn = socket.create_connection((host, port), timeout=5)
-            conn.settimeout(1)
-            conn.sendall(operatorid.encode('utf-8'))
-            data = conn.recv(32)
+    def sslcontext(self):
+        """sslcontext() -- TLS settings for https catch URLs
 
-            if not data:
-                raise socket.error("pqserver answered but didn't respond")
-            elif data.decode('utf-8').rstrip() != "OK":
-                raise socket.error(f"pqserver replied: {data.decode('utf-8').rstrip()}")
+        Params:
+        None
+
+        Throws:
+        OSError if a CA file can't be read
+
+        Returns:
+        ssl.SSLContext
+        """
+
+        if isinstance(self.verify, str):
+            return ssl.create_default_context(cafile=self.verify)
+
+        context = ssl.create_default_context()
+        if not self.verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def proxyfor(self, key):
+        """proxyfor() -- Proxy the environment says to reach a host through
+
+        Params:
+        key -- (scheme, host, port) of the catch URL
+
+        Throws:
+        pqexception if the proxy isn't an http:// one
+
+        Returns:
+        urlsplit() of the proxy URL, or None to connect directly
+        """
+
+        if key not in self.routes:
+            scheme, host, port = key
+            proxy = self.proxies.get(scheme) or self.proxies.get("all")
+            if not proxy or proxy_bypass(f"{host}:{port}"):
+                self.routes[key] = None
             else:
-                print("Connection to pqserver succeeded, entering normal operation")
-        except OSError as e:
-            print(f"Unable to connect to pqserver: {e}")
-            if conn:
-                conn.shutdown(socket.SHUT_RDWR)
-                conn.close()
-                conn = None
+                self.routes[key] = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+
+        proxy = self.routes[key]
+        if proxy and (proxy.scheme != "http" or not proxy.hostname):
+            raise pqexception(f"Unsupported proxy {proxy.geturl()}")
+        return proxy
+
+    def proxyauth(self, proxy):
+        """proxyauth() -- Proxy-Authorization header for a proxy URL with credentials
+
+        Params:
+        proxy -- urlsplit() of the proxy URL
+
+        Throws:
+        None
+
+        Returns:
+        Dictionary of headers, empty if the proxy URL has no user name
+        """
+
+        if not proxy.username:
+            return {}
+        credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+        return {"Proxy-Authorization": "Basic " +
+                base64.b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+    async def post(self, url, body, headers=None, timeout=catchtimeout):
+        """post() -- POST a body to a URL and wait for the response
+
+        Params:
+        url -- http:// or https:// URL to post to
+        body -- bytes to post
+        headers -- dictionary of extra request headers
+        timeout -- seconds to allow for connecting, and again for the exchange
+
+        Throws:
+        pqexception for an unusable URL or proxy, or a malformed response
+        OSError, asyncio.TimeoutError or asyncio.IncompleteReadError if
+        the catch URL can't be reached or stops answering
+
+        Returns:
+        HTTP status code of the response
+        """
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise pqexception(f"Unable to post to {url}")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        proxy = self.proxyfor(key)
+        hostport = parts.netloc.rpartition("@")[2]
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = {"Host": hostport,
+                   "User-Agent": f"pqclient/{version}",
+                   "Content-Type": "application/x-www-form-urlencoded",
+                   "Content-Length": str(len(body)),
+                   **(headers or {})}
+        if proxy and parts.scheme == "http":
+            # Plain http goes to the proxy with the whole URL in the request line
+            path = f"http://{hostport}{path}"
+            headers.update(self.proxyauth(proxy))
+        request = f"POST {path} HTTP/1.1\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+        request = request.encode('utf-8') + body
+
+        idle = self.idle.get(key)
+        if idle:
+            try:
+                return await asyncio.wait_for(self.exchange(key, idle.pop(), request), timeout)
+            except pqstaleexception as e:
+                # A kept-alive connection may have been closed by the far end
+                # while idle.  Nothing came back, so the post never reached
+                # the catch URL and can go again on a fresh connection
+                log.debug("Retrying post to %s after: %s", url, e)
+
+        conn = await asyncio.wait_for(self.connect(key, proxy), timeout)
+        return await asyncio.wait_for(self.exchange(key, conn, request), timeout)
+
+    async def connect(self, key, proxy):
+        """connect() -- Open a connection to a catch URL's host
+
+        Params:
+        key -- (scheme, host, port) to connect to
+        proxy -- urlsplit() of the proxy to go through, or None
+
+        Throws:
+        pqexception if the proxy won't tunnel to the host
+        OSError or asyncio.IncompleteReadError if the connection fails
+
+        Returns:
+        (reader, writer) of the connection
+        """
+
+        scheme, host, port = key
+        context = self.sslcontext() if scheme == "https" else None
+        if not proxy:
+            return await asyncio.open_connection(host, port, ssl=context)
+
+        reader, writer = await asyncio.open_connection(proxy.hostname, proxy.port or 80)
+        if not context:
+            return reader, writer
+
+        try:
+            headers = {"Host": f"{host}:{port}", **self.proxyauth(proxy)}
+            writer.write((f"CONNECT {host}:{port} HTTP/1.1\r\n" + "".join(
+                f"{name}: {value}\r\n" for name, value in headers.items()) +
+                          "\r\n").encode('utf-8'))
+            await writer.drain()
+            version, status, headers = await self.readhead(reader)
+            if not 200 <= status < 300:
+                raise pqexception(f"Proxy {proxy.hostname} refused to connect to {host}:{port}: {status}")
+
+            if hasattr(writer, "start_tls"):
+                await writer.start_tls(context, server_hostname=host)
+            else:
+                # Python 3.10 has no StreamWriter.start_tls(), so do what it does
+                loop = asyncio.get_running_loop()
+                protocol = writer.transport.get_protocol()
+                transport = await loop.start_tls(writer.transport, protocol, context,
+                                                 server_hostname=host)
+                protocol._over_ssl = True
+                writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        except BaseException:
+            closewriter(writer)
+            raise
+
+        return reader, writer
+
+    async def readhead(self, reader, first=b""):
+        """readhead() -- Read a response's status line and headers
+
+        Params:
+        reader -- asyncio.StreamReader of the connection
+        first -- bytes of the status line already read
+
+        Throws:
+        pqexception if the status line isn't HTTP
+        asyncio.IncompleteReadError if the connection closes part way
+
+        Returns:
+        (version, status, headers), with header names in lower case
+        """
+
+        line = first + await reader.readline()
+        if not line.endswith(b"\n"):
+            raise asyncio.IncompleteReadError(line, None)
+        fields = line.decode('latin-1').split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith("HTTP/") or not fields[1].isdigit():
+            raise pqexception(f"Catch URL sent a bad response: {line!r}")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            if not line.strip():
+                break
+            name, sep, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        return fields[0], int(fields[1]), headers
+
+    async def exchange(self, key, conn, request):
+        """exchange() -- Send one request on a connection and read its response
+
+        Params:
+        key -- (scheme, host, port) the connection is to
+        conn -- (reader, writer) of the connection
+        request -- complete request as bytes
+
+        Throws:
+        pqstaleexception if the connection failed before any of the response
+        arrived; pqexception, OSError or asyncio.IncompleteReadError if the
+        exchange fails later.  The connection is closed first
+
+        Returns:
+        HTTP status code of the response
+        """
+
+        reader, writer = conn
+        try:
+            try:
+                writer.write(request)
+                await writer.drain()
+                first = await reader.read(1)
+            except ConnectionError as e:
+                raise pqstaleexception(f"Catch URL connection failed: {e}") from e
+            if not first:
+                raise pqstaleexception("Catch URL closed the connection")
+
+            version, status, headers = await self.readhead(reader, first)
+            # Interim 1xx responses can come ahead of the real one
+            while status < 200:
+                version, status, headers = await self.readhead(reader)
+
+            keepalive = version != "HTTP/1.0" and headers.get("connection", "").lower() != "close"
+
+            # The body is only read so the connection can be used again.
+            # Answers to HEAD, and 204 and 304 answers, never have one
+            if request.startswith(b"HEAD ") or status in (204, 304):
+                pass
+            elif "chunked" in headers.get("transfer-encoding", "").lower():
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    if not size:
+                        while (await reader.readline()).strip():
+                            pass
+                        break
+                    await reader.readexactly(size + 2)
+            elif "content-length" in headers:
+                await reader.readexactly(int(headers["content-length"]))
+            else:
+                await reader.read()
+                keepalive = False
+
+        except BaseException:
+            closewriter(writer)
+            raise
+
+        idle = self.idle.setdefault(key, [])
+        if keepalive and len(idle) < self.poolsize:
+            idle.append(conn)
+        else:
+            closewriter(writer)
+
+        return status
+
+    def close(self):
+        """close() -- Close every idle connection
 
-            print("Retrying...")
-            time.sleep(5)
+        Params:
+        None
 
-    # Connection established
-    return conn
+        Throws:
+        None
 
-def catchpost(name, url, msg):
+        Returns:
+        None
+        """
+
+        for idle in self.idle.values():
+            for reader, writer in idle:
+                closewriter(writer)
+        self.idle.clear()
+
+async def catchpost(name, url, msg, session):
     """catchpost() -- Post message to catch URL
 
     Params:
     name -- human-friendly name of application where message originated
     url -- URL where message should be sent
-    msg -- message to post
+    msg -- message to post, or a list of them to post in order as msg[]
+    session -- CatchSession to reuse connections from
 
     Throws:
     None
 
     Returns:
-    True on successful post, False otherwise
+    True on successful post, False if it failed and should be tried again,
+    None if the catch URL refused it and would only refuse it again
     """
 
-    formdata = {'msg': msg}
+    if isinstance(msg, list):
+        formdata = {'msg[]': msg}
+    else:
+        formdata = {'msg': msg}
+
+    body = urlencode(formdata, doseq=True).encode('utf-8')
+    headers = None
+    if catchgzip:
+        body = gzip.compress(body)
+        headers = {"Content-Encoding": "gzip"}
 
     try:
-        resp = requests.post(url, data=formdata, timeout=catchtimeout)
-        debug and print(f"HTTP post returned status {resp.status_code}")
+        status = await session.post(url, body, headers, catchtimeout)
+        log.debug("HTTP post returned status %s", status)
 
-    except RequestException as e:
-        debug and print(f"Failed to post {name} to {url}: {e}")
+    except asyncio.TimeoutError:
+        log.warning("Failed to post %s to %s: timed out", name, url)
         return False
 
-    return True
+    except (OSError, asyncio.IncompleteReadError, ValueError, pqexception) as e:
+        log.warning("Failed to post %s to %s: %s", name, url, e)
+        return False
 
-def closeall(connections):
-    """closeall() -- Close all connections in the supplied list
+    if status < 400:
+        return True
 
-    Params:
-    connections -- list of connections to try to close
+    # The catch URL may get over a timeout, throttling or a server error
+    if status >= 500 or status in catchretrystatuses:
+        log.warning("Failed to post %s to %s: HTTP %s", name, url, status)
+        return False
 
-    Throws:
-    None
+    log.warning("Catch URL %s refused %s with HTTP %s", url, name, status)
+    return None
 
-    Returns:
-    None
+class MemorySpool:
+    """MemorySpool -- ProQA messages waiting to be posted, held in memory only
+
+    Used with --no-spool.  At most maxsize messages are held; anything
+    past that is dropped, and everything held is lost if pqclient exits.
     """
 
-    for c in connections:
-        if c:
-            c.close()
-    debug and print("Connections closed")
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.ids = itertools.count(1)
 
-if __name__ == "__main__":
-    options = parsecmdline()
+    def add(self, name, msg):
+        """add() -- Hold a message until it has been posted
 
-    print(f"Pqclient - Version {version}  Station# {options.operatorid}")
-    print()
+        Params:
+        name -- human-friendly name of application where message originated
+        msg -- message to post
 
-    # _________________________________________________________________________________________
-    #                              ProQA connections - medical, fire, police
-    # _________________________________________________________________________________________
-    medcon = None
-    fircon = None
-    polcon = None
-    servercon = None
+        Throws:
+        None
 
-    # Create empty buffers for receiving messages
-    servermsg = "".encode('utf-8')
-    medmsg = ""
-    firmsg = ""
-    polmsg = ""
+        Returns:
+        ID of the held message, or None if there was no room for it
+        """
 
-    try:
-        #  connect to medical, fire, police 
-        medcon = pqconnect("Med", options.medhost, options.medport)
-        fircon = pqconnect("Fire", options.firhost, options.firport)
-        polcon = pqconnect("Police", options.polhost, options.polport)
+        if len(self.items) >= self.maxsize:
+            return None
+        item = (next(self.ids), name, msg, time.time())
+        self.items.append(item)
+        return item[0]
+
+    def peek(self, limit):
+        """peek() -- Oldest messages still waiting to be posted
+
+        Params:
+        limit -- most messages to return
+
+        Throws:
+        None
+
+        Returns:
+        List of (id, name, msg, queued time) tuples, oldest first
+        """
+
+        return list(itertools.islice(self.items, limit))
+
+    def remove(self, ids):
+        """remove() -- Forget messages that have been posted
+
+        Params:
+        ids -- IDs of the oldest messages, as returned by peek()
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        while self.items and self.items[0][0] in ids:
+            self.items.popleft()
+
+    def depth(self):
+        """depth() -- Number of messages waiting to be posted
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        Count of held messages
+        """
+
+        return len(self.items)
+
+    def close(self):
+        pass
+
+class DiskSpool:
+    """DiskSpool -- ProQA messages waiting to be posted, held in a SQLite file
+
+    Every message is written here before it is posted and deleted once
+    the catch URL accepts it, so nothing is lost if the catch URL is down
+    or pqclient is restarted.  The file is in WAL mode with
+    synchronous=NORMAL: each add is a cheap append to the log, and fsyncs
+    are batched into checkpoints.  Messages are only ever removed oldest
+    first, so the IDs left are contiguous and the backlog size comes from
+    the ends of the rowid index rather than a scan.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS spool ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "name TEXT NOT NULL, msg TEXT NOT NULL, queued REAL NOT NULL)")
+
+    def add(self, name, msg):
+        """add() -- Record a message until it has been posted
+
+        Params:
+        name -- human-friendly name of application where message originated
+        msg -- message to post
+
+        Throws:
+        sqlite3.Error if the message can't be written
+
+        Returns:
+        ID of the recorded message
+        """
+
+        cursor = self.db.execute("INSERT INTO spool (name, msg, queued) VALUES (?, ?, ?)",
+                                 (name, msg, time.time()))
+        return cursor.lastrowid
+
+    def peek(self, limit):
+        """peek() -- Oldest messages still waiting to be posted
+
+        Params:
+        limit -- most messages to return
+
+        Throws:
+        None
+
+        Returns:
+        List of (id, name, msg, queued time) tuples, oldest first
+        """
+
+        return self.db.execute("SELECT id, name, msg, queued FROM spool ORDER BY id LIMIT ?",
+                               (limit,)).fetchall()
+
+    def remove(self, ids):
+        """remove() -- Delete messages that have been posted
+
+        Params:
+        ids -- IDs of the oldest messages, as returned by peek()
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.db.execute("DELETE FROM spool WHERE id <= ?", (max(ids),))
+
+    def depth(self):
+        """depth() -- Number of messages waiting to be posted
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        Count of spooled messages
+        """
+
+        first, last = self.db.execute("SELECT min(id), max(id) FROM spool").fetchone()
+        return last - first + 1 if first else 0
+
+    def close(self):
+        self.db.close()
+
+class CatchPoster:
+    """CatchPoster -- Posts ProQA messages to the catch URL from its own task
+
+    Messages are spooled so a slow catch URL never holds up CAD
+    deliveries or ProQA reads, which keep flowing while posts are in
+    flight.  Posts share one CatchSession, so the TCP and TLS handshakes
+    to the catch URL are paid once rather than for every message.
+
+    With batchsize above 1, messages from every discipline that arrive
+    within batchwait seconds of each other go out together as msg[]
+    fields, in the order they were received.  A message that arrives
+    alone still goes out as msg[], so the catch URL always gets the
+    same form.
+
+    A failed post is retried, oldest message first, with exponential
+    backoff up to catchretrymax seconds, so nothing later overtakes it.
+    A message the catch URL refuses outright (a 4xx other than 408 or
+    429) would only be refused again, so it is logged in full and
+    dropped rather than holding up everything behind it.  A refused
+    batch is posted again one message at a time, so only the messages
+    that are refused on their own are dropped.
+    """
+
+    def __init__(self, url, spool, poolsize=catchpoolsize, batchsize=catchbatch,
+                 batchwait=catchbatchms / 1000):
+        self.url = url
+        self.spool = spool
+        self.batchsize = max(1, batchsize)
+        self.batchwait = batchwait
+        self.session = CatchSession(poolsize)
+        self.wakeup = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        """start() -- Start posting from a task on the running event loop
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def post(self, name, msg):
+        """post() -- Spool a message to be posted
+
+        Params:
+        name -- human-friendly name of application where message originated
+        msg -- message to post
+
+        Throws:
+        None
+
+        Returns:
+        True if the message was spooled, False if it had to be dropped
+        """
+
+        try:
+            spoolid = self.spool.add(name, msg)
+        except sqlite3.Error as e:
+            log.warning("Unable to spool %s message, dropping it: %s", name, e)
+            return False
+
+        if spoolid is None:
+            log.warning("Catch URL queue is full, dropping %s message", name)
+            return False
+
+        self.wakeup.set()
+        log.debug("Queued %s message for catch URL, queue depth %s", name, self.spool.depth())
+        return True
+
+    async def wait(self, event, timeout):
+        """wait() -- Wait for an event to be set, for at most timeout seconds
+
+        Params:
+        event -- asyncio.Event to wait for
+        timeout -- seconds to wait, None for no limit
+
+        Throws:
+        None
+
+        Returns:
+        True if the event was set, False on timeout
+        """
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self):
+        """run() -- Post spooled messages until told to stop
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        retrydelay = 0
+        alone = 0  # Messages to post one at a time after their batch was refused
 
-        # Wait for a connection
         while True:
-            # _________________________________________________________________________________________
-            #                          connect to pqserver if not connected
-            # _________________________________________________________________________________________
-            if not servercon:
-                # In case this is a reconnect and we lost connection after a
-                # partial message, clear the buffer
-                servermsg = "".encode('utf-8')
-                print(f"Connecting to pqserver on {options.serverhost}:{options.serverport}...")
-                servercon = serverconnect(options.serverhost, options.serverport, options.operatorid)
-
-            debug and print("Waiting for data from:  ProQA Med, Fire, Police  or pqserver/CAD")
-            # Wait for data to read from either pqserver or ProQA med,fir,or police
-            rlist = select.select([servercon, medcon, fircon, polcon], [], [])[0]
-
-            # __________________________________________________________________________________
-            #   Connection From pqserver. Read entire string, route based on leading group id:  m,f,p  - sent from cad3
-            # __________________________________________________________________________________
-            if servercon in rlist:
+            # Clear first so a message spooled after peek() still wakes us
+            self.wakeup.clear()
+            batch = self.spool.peek(1 if alone else self.batchsize)
+
+            if not batch:
+                if self.stopping.is_set():
+                    break
+                await self.wakeup.wait()
+                continue
+
+            # Hold a short batch open until the oldest message's window closes
+            if len(batch) < self.batchsize and not self.stopping.is_set() and not retrydelay and not alone:
+                remaining = batch[0][3] + self.batchwait - time.time()
+                if remaining > 0 and await self.wait(self.wakeup, remaining):
+                    continue
+
+            result = await self.send(batch)
+            if result is None and len(batch) > 1:
+                log.warning("Catch URL refused a batch of %s messages, posting them one at a time",
+                            len(batch))
+                alone = len(batch)
+                continue
+
+            if result is not False:
+                if result is None:
+                    for spoolid, name, msg, queued in batch:
+                        log.error("Dropping %s message the catch URL refused: %s", name, msg)
+                self.spool.remove([item[0] for item in batch])
+                log.debug("Catch URL queue depth %s", self.spool.depth())
+                alone = max(0, alone - 1)
+                retrydelay = 0
+                continue
+
+            # Whatever is left stays spooled for the next run
+            if self.stopping.is_set():
+                break
+
+            retrydelay = min(catchretrymax, retrydelay * 2 or 1)
+            log.debug("Retrying catch URL in %ss, %s messages waiting", retrydelay, self.spool.depth())
+            await self.wait(self.stopping, retrydelay)
+
+    async def send(self, batch):
+        """send() -- Post a batch of spooled messages and report on each one
+
+        Params:
+        batch -- list of (id, name, msg, queued time) tuples, oldest first
+
+        Throws:
+        None
+
+        Returns:
+        True if the batch was delivered, False if it should be tried again,
+        None if the catch URL refused it
+        """
+
+        start = time.time()
+        # Batching promises the catch URL msg[] fields, even for a batch of one
+        if len(batch) == 1 and self.batchsize == 1:
+            spoolid, name, msg, queued = batch[0]
+            ok = await catchpost(name, self.url, msg, self.session)
+        else:
+            names = ", ".join(dict.fromkeys(item[1] for item in batch))
+            ok = await catchpost(names, self.url, [item[2] for item in batch], self.session)
+        elapsed = (time.time() - start) * 1000
+
+        if log.isEnabledFor(logging.DEBUG):
+            for n, (spoolid, name, msg, queued) in enumerate(batch, 1):
+                log.debug("%s %s message %s of %s in %.0fms after %.0fms in queue",
+                          {True: "Posted", False: "Failed to post", None: "Catch URL refused"}[ok],
+                          name, n, len(batch),
+                          elapsed, (start - queued) * 1000)
+
+        return ok
+
+    async def stop(self, timeout):
+        """stop() -- Finish posting what's spooled, waiting at most timeout seconds
+
+        Params:
+        timeout -- seconds to wait for the spool to drain
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.stopping.set()
+        self.wakeup.set()
+        if self.task:
+            try:
+                await asyncio.wait_for(self.task, timeout)
+            except asyncio.TimeoutError:
+                log.debug("Gave up posting with %s messages waiting", self.spool.depth())
+        self.session.close()
+        self.spool.close()
+
+class Delivery:
+    """Delivery -- A CAD message from pqserver on its way to ProQA
+
+    conn is the pqserver connection it arrived on, so an answer that
+    comes after that connection has gone is dropped rather than sent on
+    the next one.  ok is None until ProQA has been sent the message or
+    it has been turned away.
+    """
+
+    def __init__(self, conn, msgid, groupid, payload):
+        self.conn = conn
+        self.msgid = msgid
+        self.groupid = groupid
+        self.payload = payload
+        self.ok = None
+
+class ProQALink:
+    """ProQALink -- Connection to one ProQA application (Med, Fire or Police)
+
+    Each link runs two tasks of its own.  One connects, backing off
+    exponentially up to pqretrymax seconds, and reads ProQA's output for
+    the catch URL; the other sends CAD messages from the link's queue.
+    A ProQA restart or a ProQA that stops reading only affects CAD
+    messages for that discipline while the others keep flowing.
+    reported is the state pqserver was last told about, and nothing is
+    reported until tried says the first connection attempt is over, so
+    a link still starting up isn't announced as down.
+    """
+
+    def __init__(self, client, name, label, groupid, host, port):
+        self.client = client
+        self.name = name
+        self.label = label
+        self.groupid = groupid
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.framer = Framer()
+        self.queue = asyncio.Queue()
+        self.retrydelay = 0
+        self.reported = True
+        self.tried = False
+
+    def up(self):
+        """up() -- Check whether the link is connected
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        True if connected to ProQA
+        """
+
+        return self.writer is not None
+
+    async def run(self):
+        """run() -- Keep the link connected and pass ProQA's output to the catch URL
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        while True:
+            try:
+                self.reader, self.writer = await pqconnect(self.name, self.host, self.port)
+            except pqexception as e:
+                self.backoff()
+                log.info("%s, retrying in %ss", e, self.retrydelay)
+                if not self.tried:
+                    self.tried = True
+                    self.client.linkchanged()
+                await asyncio.sleep(self.retrydelay)
+                continue
+
+            log.info("Connected to ProQA %s on %s:%s", self.name, self.host, self.port)
+            self.retrydelay = 0
+            self.tried = True
+            self.framer.clear()
+            self.client.linkchanged()
+
+            await self.read()
+            await asyncio.sleep(self.retrydelay)
+
+    def backoff(self):
+        """backoff() -- Lengthen the wait before the next connection attempt
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.retrydelay = min(pqretrymax, self.retrydelay * 2 or 1)
+
+    def disconnect(self, reason):
+        """disconnect() -- Close a failed link and schedule a reconnect
+
+        Params:
+        reason -- why the link is being closed
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        log.warning("ProQA %s link down: %s", self.name, reason)
+        if self.writer:
+            closewriter(self.writer)
+            self.reader = self.writer = None
+        self.backoff()
+        self.client.linkchanged()
+
+    def submit(self, delivery):
+        """submit() -- Queue a CAD message to be sent to this ProQA application
+
+        Params:
+        delivery -- Delivery holding the message
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.queue.put_nowait(delivery)
+
+    async def send(self):
+        """send() -- Send queued CAD messages to ProQA and answer pqserver for each
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        while True:
+            delivery = await self.queue.get()
+
+            if not self.writer:
+                log.info("ProQA %s is not connected, rejecting message", self.name)
+                delivery.ok = False
+            else:
                 try:
-                    data = servercon.recv(16)
-                    if data:
-                        servermsg+=data
-                        debug and print(f"Received from pqserver: {data}")
-
-                        # Did we receive the message terminator?
-                        if eomstring in servermsg.decode('utf-8'):
-                            # read one more batch
-                            #data = servercon.recv(16)
-                            #if data:
-                                #servermsg+=data
-                                #debug and print(f"Received last from pqserver: {data}")
-                                #debug and print()
-                           
-                            # Parse out group ID in first char from rest of message
-                            groupid=servermsg[0:1].decode("utf-8") 
-                            senddata=servermsg[1:]
-
-                            print(f"Received full from CAD: {servermsg}")
-                            print()
-                            print(f"Groupid: {groupid}")
-                            print(f"Senddata: {senddata}")
-                            print()
-                            
-                            # Clear the buffer
-                            servermsg = "".encode('utf-8')
-                        
-                            # Figure out where this is going
-                            name = None
-                            conn = None
-
-                            if groupid=='m':
-                                name = "Med"
-                                conn = medcon
-                            elif groupid=='f':
-                                name = "Fire"
-                                conn = fircon
-                            elif groupid=='p':
-                                name = "Police"
-                                conn = polcon
-                        
-                            # If group ID was valid, send message
-                            if name:
-                                try:
-                                    pqsend(name, conn, senddata)
-                                except pqexception as e:
-                                    servercon.sendall("NO\n".encode('utf-8'))
-                                    raise pqexception(e)
-
-                                servercon.sendall("OK\n".encode('utf-8'))
-                            else:
-                                # Invalid group ID
-                                servercon.sendall("NO\n".encode('utf-8'))
-
-                    # Or see that the client closed the connection
-                    else:
-                        raise socket.error("Lost connection to pqserver, attempting reconnect")
-
-                except OSError as e:
-                    print(f"Error receiving data from pqserver: {e}")
-                    print("Attempting to reconnect to server")
-                    servercon.shutdown(socket.SHUT_RDWR)
-                    servercon.close()
-                    servercon = None
+                    delivery.ok = await pqsend(self.name, self.writer, delivery.payload)
+                except pqexception as e:
+                    self.disconnect(e)
+                    delivery.ok = False
+
+            self.client.server.ack(delivery)
+
+    async def read(self):
+        """read() -- Post complete messages from ProQA until the link goes down
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        reader = self.reader
+        while True:
+            try:
+                data = await reader.read(self.client.readsize)
+            except OSError as e:
+                data = None
+                reason = e
+            else:
+                reason = "ProQA closed the connection"
+
+            # Sending may already have found the link down
+            if reader is not self.reader:
+                return
+
+            # Or see that ProQA closed the connection
+            if not data:
+                self.disconnect(reason)
+                return
+
+            framelog.debug("received from ProQA %s: %s", self.name, data)
+            for frame in self.framer.feed(data):
+                msg = frame.decode('utf-8', errors='replace')
+                log.debug("posting %s msg to catchname: %s", self.name.lower(), msg)
+                self.client.poster.post(self.label, msg)
+
+class ServerLink:
+    """ServerLink -- Connection to pqserver, kept up by its own task
+
+    ProQA output keeps being read and posted while pqserver is
+    unreachable.  Failed attempts back off exponentially up to
+    serverretrymax seconds, with jitter so a room full of pqclients
+    doesn't reconnect in lockstep when pqserver restarts.
+
+    state is "down" (waiting to retry), "connecting", "registering"
+    (operator ID sent, waiting for "OK") or "up".  With protocol "auto",
+    protocol 2 is asked for first and a pqserver that hangs up on the
+    request is tried again straight away with protocol 1.  Protocol 2
+    also offers pqserver the compression methods listed, and to answer
+    its heartbeats; if pqserver agrees but then goes quiet for longer
+    than it would tolerate from us, the connection is given up as dead
+    and retried.
+
+    ProQA links answer in their own time, so with protocol 1, where
+    pqserver matches answers to messages by order, answers wait in
+    unanswered until every earlier message has been answered too.
+    """
+
+    def __init__(self, client, host, port, operatorid, protocol="auto", compression=()):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.operatorid = operatorid
+        self.protocol = protocol
+        self.compression = [method for method in compression if method in compressors()]
+        self.decompressor = None
+        self.version = 1 if protocol == "1" else 2
+        self.reader = None
+        self.writer = None
+        self.state = "down"
+        self.answer = bytearray()
+        self.framer = None
+        self.unanswered = deque()  # Deliveries in the order pqserver sent them
+        self.retrydelay = 0
+        self.nextattempt = 0  # When to retry
+        self.hungup = False  # pqserver closed the connection without answering our hello
+        self.silence = 0  # Seconds pqserver may go without a word, 0 if it doesn't ping
+        self.lastheard = 0  # Loop time pqserver last sent anything
+        self.watchdog = None  # Timer for the next check on lastheard
+
+    def up(self):
+        """up() -- Check whether pqserver has accepted our registration
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        True if messages can be exchanged with pqserver
+        """
+
+        return self.state == "up"
+
+    async def run(self):
+        """run() -- Connect to pqserver and relay its messages, reconnecting as needed
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        while True:
+            await asyncio.sleep(max(0, self.nextattempt - time.monotonic()))
+
+            log.info("Connecting to pqserver on %s:%s with protocol %s...", self.host, self.port, self.version)
+            try:
+                data = await asyncio.wait_for(self.register(), serverconnecttimeout)
+            except asyncio.TimeoutError:
+                self.fail("timed out")
+                continue
+            except (OSError, pqexception) as e:
+                self.fail(e)
+                continue
+
+            await self.relay(data)
+
+    async def register(self):
+        """register() -- Connect, send our operator ID and wait for pqserver to accept it
+
+        Params:
+        None
+
+        Throws:
+        OSError or pqexception if pqserver can't be reached or says no
+
+        Returns:
+        Whatever pqserver sent right behind its answer
+        """
+
+        self.state = "connecting"
+        self.hungup = False
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        if self.version == 2:
+            hello = f"{v2hello} {self.operatorid} {','.join(self.compression) or 'none'} ping\n"
+        else:
+            hello = self.operatorid
+        self.writer.write(hello.encode('utf-8'))
+        self.state = "registering"
+
+        while True:
+            data = await self.reader.read(self.client.readsize)
+            if not data:
+                if self.answer:
+                    raise pqexception(f"pqserver replied: {self.answer.decode('utf-8', errors='replace').rstrip()}")
+                self.hungup = True
+                raise pqexception("pqserver answered but didn't respond")
+
+            framelog.debug("Received from pqserver: %s", data)
+            self.answer += data
+            end = self.answer.find(b"\n")
+            if end >= 0:
+                break
+
+        answer = self.answer[:end].decode('utf-8', errors='replace').rstrip()
+        fields = answer.split()
+        if self.version == 2:
+            # pqserver names the compression it picked, if any, then how it will ping us
+            accepted = (fields[:2] == ["OK", v2hello] and
+                        (len(fields) == 2 or fields[2] in self.compression + ["none"]))
+        else:
+            accepted = answer == "OK"
+        if not accepted:
+            raise pqexception(f"pqserver replied: {answer}")
+
+        method = fields[2] if len(fields) > 2 and fields[2] != "none" else None
+        self.decompressor = Decompressor(method) if method else None
+
+        # pqserver tolerates interval x misses of silence from us, and so do we
+        interval = None
+        self.silence = 0
+        for feature in fields[3:]:
+            if feature.startswith("ping="):
+                try:
+                    interval, misses = feature[5:].split(",")
+                    self.silence = float(interval) * int(misses)
+                except ValueError:
+                    raise pqexception(f"pqserver replied: {answer}")
+
+        log.info("Connection to pqserver succeeded with protocol %s%s%s, entering normal operation",
+                 self.version, f" and {method} compression" if method else "",
+                 f", heartbeats every {interval}s" if interval else "")
+        self.state = "up"
+        self.retrydelay = 0
+        self.framer = PacketReader() if self.version == 2 else Framer()
+
+        # pqserver may have sent messages right behind its OK
+        data = bytes(self.answer[end + 1:])
+        self.answer.clear()
+        return data
+
+    async def relay(self, data):
+        """relay() -- Pass CAD messages from pqserver to ProQA until the connection fails
+
+        Params:
+        data -- bytes already received after pqserver's answer
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        # A fresh registration starts out assuming every link is up
+        for link in self.client.links:
+            link.reported = True
+        self.report()
+
+        loop = asyncio.get_running_loop()
+        self.lastheard = loop.time()
+        if self.silence:
+            self.watchdog = loop.call_later(self.silence, self.listen)
+
+        while True:
+            try:
+                messages = self.parse(data)
+            except pqframeexception as e:
+                self.fail(e)
+                return
+
+            # pqserver may pipeline several messages, so handle
+            # every complete one we've received
+            for msgid, groupbyte, payload in messages:
+                delivery = Delivery(self.writer, msgid, groupbyte, payload)
+                self.unanswered.append(delivery)
+                self.client.route(delivery)
+
+            try:
+                data = await self.reader.read(self.client.readsize)
+            except OSError as e:
+                self.fail(e)
+                return
+
+            # Or see that pqserver closed the connection
+            if not data:
+                self.fail("Lost connection to pqserver")
+                return
+
+            self.lastheard = loop.time()
+            framelog.debug("Received from pqserver: %s", data)
+
+    def listen(self):
+        """listen() -- Give up on pqserver if it has stopped pinging us
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.watchdog = None
+        if not self.writer:
+            return
+
+        loop = asyncio.get_running_loop()
+        quiet = loop.time() - self.lastheard
+        if quiet >= self.silence:
+            log.warning("Nothing from pqserver for %.1fs, dropping the connection", quiet)
+
+            # relay() sees the connection close and retries
+            self.writer.transport.abort()
+            return
+
+        self.watchdog = loop.call_later(self.silence - quiet, self.listen)
+
+    def parse(self, data):
+        """parse() -- Collect complete CAD messages from bytes pqserver sent
+
+        Params:
+        data -- bytes just received
+
+        Throws:
+        pqframeexception if pqserver sent something that isn't a valid packet
+
+        Returns:
+        List of (msgid, groupid, payload) tuples, possibly empty.  groupid
+        and payload are bytes, and msgid is None with protocol 1.
+        """
+
+        if self.version == 2:
+            messages = []
+            for msgid, groupid, flags, payload in self.framer.feed(data):
+                if flags & flagping:
+                    self.send(packet(msgid, groupid, flagpong))
                     continue
+                if flags & flagcompressed:
+                    if not self.decompressor:
+                        raise pqframeexception("Compressed message without compression agreed")
+                    payload = self.decompressor.decompress(payload)
+                messages.append((msgid, groupid, payload))
+            return messages
 
-            # medical - post to cad via catchpro_url
-            if medcon in rlist:
-                data = medcon.recv(16)
-                if data:
-                    debug and print(f"received from ProQA Med: {data}")
-                    medmsg += data.decode('utf-8')
-                    if eomstring in medmsg:
-                        print(f"posting med msg to catchname: {medmsg}")
-                        catchpost("Medical", options.catchname, medmsg)
-                        medmsg = ""
-                # Or see that the server closed the connection
-                else:
-                    raise pqexception("ProQA med has closed the connection")
-                
-            # fire - post to cad via catchpro_url
-            if fircon in rlist:
-                data = fircon.recv(16)
-                if data:
-                    debug and print(f"received from ProQA Fire: {data}")
-                    firmsg += data.decode('utf-8')
-                    if eomstring in firmsg:
-                        print(f"posting fire msg to catchname: {firmsg}")
-                        catchpost("Fire", options.catchname, firmsg)
-                        firmsg = ""
-
-                # Or see that the server closed the connection
-                else:
-                    raise pqexception("ProQA fire has closed the connection")
-
-            # police - post to cad via catchpro_url
-            if polcon in rlist:
-                data = polcon.recv(16)
-                if data:
-                    debug and print(f"received from ProQA Police: {data}")
-                    polmsg += data.decode('utf-8')
-                    if eomstring in polmsg:
-                        print(f"posting police msg to catchpro_url: {polmsg}")
-                        catchpost("Police", options.catchname, polmsg)
-                        polmsg = ""
-
-                # Or see that the server closed the connection
+        return [(None, frame[0:1], frame[1:]) for frame in self.framer.feed(data)]
+
+    def send(self, data):
+        """send() -- Send bytes to pqserver
+
+        The transport buffers whatever the socket can't take straight
+        away, so this never waits; a broken connection is noticed by
+        relay() and retried.
+
+        Params:
+        data -- bytes to send
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        try:
+            self.writer.write(data)
+        except OSError as e:
+            log.warning("Error sending to pqserver: %s", e)
+
+    def ack(self, delivery):
+        """ack() -- Tell pqserver whether a message was passed on to ProQA
+
+        Params:
+        delivery -- Delivery whose ok has been set
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        # Its connection has gone, and pqserver has already given up on it
+        if delivery.conn is not self.writer or not self.up():
+            log.debug("Dropping answer for a message from an earlier pqserver connection")
+            return
+
+        if self.version == 2:
+            self.unanswered.remove(delivery)
+            self.send(packet(delivery.msgid, delivery.groupid, flagack if delivery.ok else flagnak))
+            return
+
+        while self.unanswered and self.unanswered[0].ok is not None:
+            self.send(b"OK\n" if self.unanswered.popleft().ok else b"NO\n")
+
+    def report(self):
+        """report() -- Tell pqserver about any ProQA link that has changed state
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if not self.up():
+            return
+
+        for link in self.client.links:
+            if link.tried and link.up() != link.reported:
+                state = "UP" if link.up() else "DOWN"
+                if self.version == 2:
+                    self.send(packet(0, link.groupid.encode('utf-8'), flagstatus, state.encode('utf-8')))
                 else:
-                    raise pqexception("ProQA police has closed the connection")
+                    self.send(f"LINK {link.groupid} {state}\n".encode('utf-8'))
+                link.reported = link.up()
+
+    def fail(self, reason):
+        """fail() -- Close the connection and schedule the next attempt
+
+        Params:
+        reason -- why the connection failed
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        log.warning("Unable to talk to pqserver: %s", reason)
+        if self.watchdog:
+            self.watchdog.cancel()
+            self.watchdog = None
+        if self.writer:
+            closewriter(self.writer)
+            self.reader = self.writer = None
+
+        # An older pqserver hangs up on a protocol 2 hello without a word;
+        # a timeout or reset may just be a slow or restarting new one
+        refused = self.hungup
+        self.hungup = False
+
+        # In case we lost connection after a partial message, drop it
+        self.framer = None
+        self.answer.clear()
+        self.unanswered.clear()
+        self.state = "down"
+
+        if self.protocol == "auto" and self.version == 2 and refused:
+            log.info("pqserver may not know protocol 2, retrying with protocol 1")
+            self.version = 1
+            self.nextattempt = time.monotonic()
+            return
+
+        # Give protocol 2 another chance in case pqserver has been upgraded
+        if self.protocol == "auto":
+            self.version = 2
+
+        self.retrydelay = min(serverretrymax, self.retrydelay * 2 or 1)
+        delay = random.uniform(self.retrydelay / 2, self.retrydelay)
+        self.nextattempt = time.monotonic() + delay
+        log.info("Retrying in %.1fs", delay)
+
+class PQClient:
+    """PQClient -- Relay between pqserver, the ProQA applications and the catch URL
+
+    Every connection runs as its own asyncio task: the pqserver link,
+    a connection and a sender per ProQA discipline, and the catch URL
+    poster.  They are joined by queues, so a slow peer only holds up
+    what is waiting on it:
+
+        client = PQClient("1", serverhost="pqserver.example")
+        await client.run()
+
+    proqa lists (name, label, group ID, host, port) for each ProQA
+    application, and defaults to Med, Fire and Police on the module's
+    default ports.  spool defaults to a MemorySpool of catchqueuesize
+    messages.
+    """
+
+    def __init__(self, operatorid, serverhost=serverhost, serverport=serverport, proqa=None,
+                 catchname=catchname, spool=None, catchpoolsize=catchpoolsize,
+                 catchbatch=catchbatch, catchbatchms=catchbatchms, protocol=protocol,
+                 compression=compression, readsize=readsize):
+        self.operatorid = operatorid
+        self.readsize = max(1, readsize)
+
+        if proqa is None:
+            proqa = [("Med", "Medical", "m", medhost, medport),
+                     ("Fire", "Fire", "f", firhost, firport),
+                     ("Police", "Police", "p", polhost, polport)]
+        self.links = [ProQALink(self, *settings) for settings in proqa]
+
+        # CAD messages are routed by the group ID in their first character
+        self.groups = {link.groupid: link for link in self.links}
+
+        self.poster = CatchPoster(catchname, spool or MemorySpool(max(1, catchqueuesize)),
+                                  catchpoolsize, catchbatch, catchbatchms / 1000)
+        self.server = ServerLink(self, serverhost, serverport, operatorid,
+                                 protocol, compression.split(","))
+        self.tasks = []
+
+    async def run(self):
+        """run() -- Run every connection until cancelled
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        loop = asyncio.get_running_loop()
+        self.poster.start()
+        for link in self.links:
+            self.tasks.append(loop.create_task(link.run()))
+            self.tasks.append(loop.create_task(link.send()))
+        self.tasks.append(loop.create_task(self.server.run()))
+
+        try:
+            await asyncio.gather(*self.tasks)
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """stop() -- Close every connection and give queued posts a chance to go out
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        for writer in [self.server.writer] + [link.writer for link in self.links]:
+            if writer:
+                closewriter(writer)
+        log.debug("Connections closed")
+
+        # Give posts already queued a chance to go out
+        await self.poster.stop(catchtimeout)
+
+    def linkchanged(self):
+        """linkchanged() -- Pass a ProQA link going up or down on to pqserver
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.server.report()
+
+    def route(self, delivery):
+        """route() -- Hand a CAD message to the ProQA application it is for
+
+        Params:
+        delivery -- Delivery holding the message
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        # Group ID is the first char of the message, or in the packet header
+        groupid = delivery.groupid.decode("utf-8", errors='replace')
+
+        log.debug("Received message for group %s: %s", groupid, delivery.payload)
+
+        # Figure out where this is going; an invalid group ID gets NO, and
+        # so does a ProQA link that's down once the message reaches it
+        link = self.groups.get(groupid)
+        if link:
+            link.submit(delivery)
+        else:
+            delivery.ok = False
+            self.server.ack(delivery)
+
+if __name__ == "__main__":
+    options = parsecmdline()
+
+    log.info("Pqclient - Version %s  Station# %s", version, options.operatorid)
+
+    # ProQA messages are spooled and posted to the catch URL in the background
+    spool = None
+    if options.spoolfile:
+        spoolpath = options.spoolfile.format(operatorid=options.operatorid)
+        try:
+            spool = DiskSpool(spoolpath)
+        except sqlite3.Error as e:
+            log.error("Unable to open spool file %s: %s", spoolpath, e)
+            sys.exit(2)
+        if spool.depth():
+            log.info("%s ProQA messages waiting in %s from an earlier run", spool.depth(), spoolpath)
+
+    client = PQClient(options.operatorid, options.serverhost, options.serverport,
+                      [("Med", "Medical", "m", options.medhost, options.medport),
+                       ("Fire", "Fire", "f", options.firhost, options.firport),
+                       ("Police", "Police", "p", options.polhost, options.polport)],
+                      options.catchname, spool, options.catchpoolsize,
+                      options.catchbatch, options.catchbatchms, options.protocol,
+                      options.compression, options.readsize)
+
+    try:
+        asyncio.run(client.run())
 
     except pqexception as e:
-        debug and print(f"Exiting: {e}")
+        log.debug("Exiting: %s", e)
         sys.exit(2)
 
     except KeyboardInterrupt:
-        debug and print("Received interrupt signal, exiting")
+        log.debug("Received interrupt signal, exiting")
         sys.exit(0)
-
-    # Always close all connections at the end of this block regardless of exceptions
-    finally:
-        # Close all connections
-        closeall([servercon,medcon,fircon,polcon])
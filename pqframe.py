@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# pqframe - message framing and stream helpers shared by pqserver and pqclient
+#
+#  . must sit next to pqserver.py on the server
+#  . pyinstaller bundles it into pqclient.exe automatically
+
+import zlib
+import struct
+
+# zstd is better and cheaper than zlib but needs pip install zstandard
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+eomstring = "</comm>"
+readsize = 65536  # Default bytes to ask for on each socket read
+
+# Protocol v2 between pqserver and pqclient.  pqclient says "PQ/2 <op>\n"
+# instead of sending its bare operator ID, pqserver answers "OK PQ/2\n",
+# and from then on everything in both directions is a packet: this
+# header followed by length bytes of payload.  Messages to pqclient carry
+# the CAD body after the group ID; acks and status use the flags below.
+v2hello = "PQ/2"
+header = struct.Struct("!IcBI")  # Message ID, group ID, flags, payload length
+maxpayload = 16 * 1024 * 1024  # Anything longer means the stream is corrupt
+flagack = 0x01  # Operator passed message msgid on to ProQA
+flagnak = 0x02  # Operator couldn't pass message msgid on
+flagstatus = 0x04  # ProQA link for the group is b"UP" or b"DOWN"
+flagcompressed = 0x08  # Payload is the next piece of the connection's compressed stream
+flagping = 0x10  # pqserver checking the link is alive; answer with flagpong and the same msgid
+flagpong = 0x20  # Answer to the ping with this msgid
+
+# Heartbeats.  A pqclient that can answer pings says "ping" after its
+# compression methods (or "none") in its hello.  pqserver then adds
+# "ping=<interval>,<misses>" after the method it picked (or "none") in
+# its answer, pings every interval seconds, and drops the operator after
+# that many pings in a row go unanswered; pqclient reconnects if it
+# hears nothing at all for as long.  Pings carry group ID b"\0" and no
+# payload, and are never compressed.
+pinggroup = b"\0"
+
+# Compression for protocol 2, best first.  pqclient lists the ones it
+# can use after its operator ID and pqserver answers with the one it
+# picked, if any.
+compressmin = 64  # Payloads shorter than this aren't worth compressing
+
+# Exceptions to throw
+class pqframeexception(Exception):
+    pass
+
+class Framer:
+    """Framer -- Split a byte stream into frames that end with a terminator
+
+    Data is appended to a bytearray as it arrives and only the newly
+    appended bytes are searched, backing up len(terminator)-1 bytes in
+    case a terminator straddles two reads.  Nothing is decoded until a
+    frame is complete, so a multibyte UTF-8 character split across reads
+    comes out intact.
+    """
+
+    def __init__(self, terminator=eomstring):
+        if isinstance(terminator, str):
+            terminator = terminator.encode('utf-8')
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def feed(self, data):
+        """feed() -- Add received bytes and collect any frames they complete
+
+        Params:
+        data -- bytes-like object just read from the socket
+
+        Throws:
+        None
+
+        Returns:
+        List of complete frames as bytes, each including its terminator,
+        in the order they arrived.  Often empty, and may hold several.
+        """
+
+        self.buffer += data
+
+        frames = []
+        start = 0
+        search = max(0, self.scanned - len(self.terminator) + 1)
+
+        while True:
+            end = self.buffer.find(self.terminator, search)
+            if end < 0:
+                break
+            end += len(self.terminator)
+            frames.append(bytes(self.buffer[start:end]))
+            start = search = end
+
+        # Drop consumed frames; everything left has now been searched
+        if start:
+            del self.buffer[:start]
+        self.scanned = len(self.buffer)
+
+        return frames
+
+    def clear(self):
+        """clear() -- Discard any partial frame, e.g. after a reconnect
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.buffer.clear()
+        self.scanned = 0
+
+def closewriter(writer):
+    """closewriter() -- Close a stream, ignoring a peer that has already gone
+
+    Params:
+    writer -- asyncio.StreamWriter, or transport, to close
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    try:
+        writer.close()
+    except OSError:
+        pass
+
+def packet(msgid, groupid, flags, payload=b""):
+    """packet() -- Build a complete v2 packet
+
+    Params:
+    msgid -- message ID the packet carries or answers
+    groupid -- single-byte group ID, e.g. b"m"
+    flags -- combination of the flag* values
+    payload -- bytes-like payload
+
+    Throws:
+    struct.error if a field is out of range
+
+    Returns:
+    Packet as bytes
+    """
+
+    return header.pack(msgid, groupid, flags, len(payload)) + payload
+
+class PacketReader:
+    """PacketReader -- Split a v2 byte stream into packets
+
+    Each header says exactly where its packet ends, so nothing is
+    searched for and the payload may contain anything, eomstring
+    included.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """feed() -- Add received bytes and collect any packets they complete
+
+        Params:
+        data -- bytes-like object just read from the socket
+
+        Throws:
+        pqframeexception if a header claims an impossible length
+
+        Returns:
+        List of (msgid, groupid, flags, payload) tuples in the order they
+        arrived, with groupid and payload as bytes
+        """
+
+        self.buffer += data
+
+        packets = []
+        start = 0
+        while len(self.buffer) - start >= header.size:
+            msgid, groupid, flags, length = header.unpack_from(self.buffer, start)
+            if length > maxpayload:
+                raise pqframeexception(f"Packet claims {length} bytes of payload")
+
+            end = start + header.size + length
+            if end > len(self.buffer):
+                break
+            packets.append((msgid, groupid, flags, bytes(self.buffer[start + header.size:end])))
+            start = end
+
+        if start:
+            del self.buffer[:start]
+
+        return packets
+
+    def clear(self):
+        """clear() -- Discard any partial packet, e.g. after a reconnect
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.buffer.clear()
+
+def compressors():
+    """compressors() -- Compression methods this installation can use
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    List of names, best first
+    """
+
+    return ["zstd", "zlib"] if zstandard else ["zlib"]
+
+class Compressor:
+    """Compressor -- Compresses every message sent on one connection as one stream
+
+    Each message is flushed on its own so it can be decompressed as soon
+    as it arrives, but the stream carries on across messages: tags and
+    phrases seen in earlier messages compress to almost nothing.
+    """
+
+    def __init__(self, method):
+        if method == "zstd":
+            self.stream = zstandard.ZstdCompressor(level=3).compressobj()
+            self.flushmode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self.stream = zlib.compressobj()
+            self.flushmode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data):
+        """compress() -- Compress the next message on the stream
+
+        Params:
+        data -- bytes-like message
+
+        Throws:
+        None
+
+        Returns:
+        Compressed bytes, complete enough to decompress on their own
+        """
+
+        return self.stream.compress(data) + self.stream.flush(self.flushmode)
+
+class Decompressor:
+    """Decompressor -- Undoes a Compressor, one message at a time in the order sent"""
+
+    def __init__(self, method):
+        self.method = method
+        if method == "zstd":
+            self.stream = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            self.stream = zlib.decompressobj()
+
+    def decompress(self, data):
+        """decompress() -- Decompress the next message on the stream
+
+        Params:
+        data -- compressed bytes, as returned by Compressor.compress()
+
+        Throws:
+        pqframeexception if the data is corrupt or expands past maxpayload
+
+        Returns:
+        The original message as bytes
+        """
+
+        try:
+            if self.method == "zstd":
+                message = self.stream.decompress(data)
+            else:
+                message = self.stream.decompress(data, maxpayload)
+                if self.stream.unconsumed_tail:
+                    raise pqframeexception(f"Message expands past {maxpayload} bytes")
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+            raise pqframeexception(f"Unable to decompress message: {e}")
+
+        if len(message) > maxpayload:
+            raise pqframeexception(f"Message expands past {maxpayload} bytes")
+        return message
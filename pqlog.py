@@ -0,0 +1,158 @@
+# pqlog - Logging shared by pqserver and pqclient
+#
+# Messages go through the standard logging module, so nothing is formatted
+# for a level that is switched off, and the ones that are on are queued and
+# written by a background thread, keeping slow terminals and journald off
+# the event loop.  Raw traffic is logged at DEBUG on a separate "frames"
+# logger, which can be kept in a fixed-size ring in memory instead of being
+# written out as it happens.  The ring is dumped when an error is logged, when
+# the program exits, and on SIGUSR1 where there is one.
+
+import sys
+import queue
+import signal
+import atexit
+import logging
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+logformat = "%(asctime)s %(levelname)s %(message)s"
+
+class BackgroundHandler(QueueHandler):
+    """BackgroundHandler -- Queues records to be formatted on the listener's thread
+
+    QueueHandler normally formats each record before queueing it, which
+    would put the formatting back on the caller's thread.  Records are
+    queued as they are instead, so their arguments must not change after
+    they are logged; pass bytes, not a buffer that will be reused.
+    """
+
+    def prepare(self, record):
+        return record
+
+class RingHandler(logging.Handler):
+    """RingHandler -- Keeps the last size records in memory until dump() is called
+
+    Records are stored unformatted, so keeping one costs a deque append.
+    """
+
+    def __init__(self, size):
+        super().__init__()
+        self.records = deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, logger):
+        """dump() -- Log every record in the ring, oldest first, and empty it
+
+        Params:
+        logger -- logger to write the records to
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        records = list(self.records)
+        self.records.clear()
+        if not records:
+            return
+        logger.info("Dumping %d recent frames", len(records))
+        for record in records:
+            logger.handle(record)
+        logger.info("End of recent frames")
+
+class DumpTrigger(logging.Handler):
+    """DumpTrigger -- Dumps a ring whenever a record at level or above is logged
+
+    Goes on the program's logger, so an error arrives with the traffic that
+    led up to it, on every platform.
+    """
+
+    def __init__(self, ring, logger, level=logging.ERROR):
+        super().__init__(level)
+        self.ring = ring
+        self.logger = logger
+
+    def emit(self, record):
+        self.ring.dump(self.logger)
+
+def setuplogging(name, level=logging.INFO, ringsize=0, stream=None):
+    """setuplogging() -- Send a program's log through a background thread
+
+    Params:
+    name -- name of the program's logger, e.g. "pqserver"; traffic is
+            logged on name + ".frames"
+    level -- lowest level to log
+    ringsize -- frames to keep in memory for dumping, 0 to log them like
+                everything else
+    stream -- where to write, sys.stdout by default
+
+    Throws:
+    None
+
+    Returns:
+    The running QueueListener, which should be stopped before exiting
+    to write out what is still queued; atexit does so for the main
+    process.  With a ring, logging an error dumps it, and so does exiting
+    the main process, or SIGUSR1 on Unix; call dumpframes() before
+    stopping the listener anywhere else.
+    """
+
+    # Calling this again, e.g. in a forked worker, replaces the earlier setup
+    logger = logging.getLogger(name)
+    frames = logging.getLogger(f"{name}.frames")
+    for handler in logger.handlers + frames.handlers:
+        logger.removeHandler(handler)
+        frames.removeHandler(handler)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(logformat))
+
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.setLevel(level)
+    logger.addHandler(BackgroundHandler(records))
+    logger.propagate = False
+
+    if not ringsize:
+        frames.setLevel(logging.NOTSET)
+        frames.propagate = True
+        return listener
+
+    # Frames stay in the ring whatever the program's level, until dumped
+    ring = RingHandler(ringsize)
+    frames.setLevel(logging.DEBUG)
+    frames.addHandler(ring)
+    frames.propagate = False
+
+    # Registered after listener.stop, so it runs first and the dump is written
+    logger.addHandler(DumpTrigger(ring, logger))
+    atexit.register(ring.dump, logger)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dumpframes(name))
+
+    return listener
+
+def dumpframes(name):
+    """dumpframes() -- Write out the frames a program has kept in its ring
+
+    Params:
+    name -- name the program's logging was set up with
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    for handler in logging.getLogger(f"{name}.frames").handlers:
+        if isinstance(handler, RingHandler):
+            handler.dump(logging.getLogger(name))
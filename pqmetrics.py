@@ -0,0 +1,240 @@
+# pqmetrics - Counters and histograms served in Prometheus text format
+#
+# Everything here is updated from the event loop's thread only, so a
+# counter is a plain attribute and a histogram a preallocated list of
+# bucket counts: recording a message adds to numbers that already exist
+# and takes no lock.  The text is only built when something scrapes it.
+
+import asyncio
+import bisect
+
+# Seconds, from well under a millisecond on a LAN to past the ack timeout
+latencybuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Quantiles to estimate from each histogram, as well as its buckets
+quantiles = (0.5, 0.95, 0.99)
+
+class Histogram:
+    """Histogram -- Counts of observed values falling in fixed buckets
+
+    counts has one slot per bound plus one for everything above the
+    last; observe() adds to a slot, the running sum and the count.
+    """
+
+    def __init__(self, bounds=latencybuckets):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """observe() -- Record one value
+
+        Params:
+        value -- value to record, in the same units as the bounds
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """quantile() -- Estimate a quantile the way Prometheus' histogram_quantile() does
+
+        Params:
+        q -- quantile wanted, between 0 and 1
+
+        Throws:
+        None
+
+        Returns:
+        Estimated value, interpolated within its bucket, or None before
+        anything has been observed
+        """
+
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for n, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if n == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[n - 1] if n else 0.0
+                return lower + (self.bounds[n] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def samples(self, labels=""):
+        """samples() -- Sample lines for this histogram, without name or type
+
+        Params:
+        labels -- labels to add to every sample, as 'name="value",...'
+
+        Throws:
+        None
+
+        Returns:
+        List of (suffix, labels, value) tuples for family()
+        """
+
+        sep = "," if labels else ""
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            cumulative += count
+            samples.append(("_bucket", f'{labels}{sep}le="{bound}"', cumulative))
+        samples.append(("_sum", labels, self.total))
+        samples.append(("_count", labels, self.count))
+        return samples
+
+def family(name, kind, helptext, samples):
+    """family() -- Format one metric family in Prometheus text format
+
+    Params:
+    name -- metric name
+    kind -- "counter", "gauge", "histogram" or "summary"
+    helptext -- one-line description
+    samples -- (suffix, labels, value) tuples, or (labels, value) for
+               samples with no suffix; labels as 'name="value",...'
+
+    Throws:
+    None
+
+    Returns:
+    List of lines, without newlines
+    """
+
+    lines = [f"# HELP {name} {helptext}", f"# TYPE {name} {kind}"]
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("",) + tuple(sample)
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}{suffix}{labels} {value}")
+    return lines
+
+def quantilesamples(histogram, labels=""):
+    """quantilesamples() -- Estimated quantiles of a histogram, as summary samples
+
+    Params:
+    histogram -- Histogram to estimate from
+    labels -- labels to add to every sample, as 'name="value",...'
+
+    Throws:
+    None
+
+    Returns:
+    List of (labels, value) tuples for family(), empty before anything
+    has been observed
+    """
+
+    if not histogram.count:
+        return []
+    sep = "," if labels else ""
+    return [(f'{labels}{sep}quantile="{q}"', histogram.quantile(q)) for q in quantiles]
+
+class LagProbe:
+    """LagProbe -- Measures how late the event loop runs a timer
+
+    Every interval seconds a callback is due; how long after that it
+    actually runs is how long the loop spent in the iteration that was
+    going on, so the histogram shows how long callbacks hold the loop.
+    """
+
+    def __init__(self, histogram, interval=0.25):
+        self.histogram = histogram
+        self.interval = interval
+        self.timer = None
+
+    def start(self):
+        """start() -- Start probing on the running loop
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_at(loop.time() + self.interval, self.fire)
+
+    def fire(self):
+        """fire() -- Record how late this callback ran and schedule the next
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        loop = asyncio.get_running_loop()
+        self.histogram.observe(max(0.0, loop.time() - self.timer.when()))
+        self.timer = loop.call_at(loop.time() + self.interval, self.fire)
+
+    def stop(self):
+        """stop() -- Stop probing
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+async def scrape(reader, writer, render, timeout=5):
+    """scrape() -- Serve one HTTP request on a metrics connection and close it
+
+    Any GET is answered with the metrics, whatever its path, so a
+    scraper can use the usual /metrics.
+
+    Params:
+    reader -- asyncio.StreamReader for the connection
+    writer -- asyncio.StreamWriter for the connection
+    render -- function returning the metrics text
+    timeout -- seconds to wait for the request
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        if request.startswith(b"GET "):
+            status = "200 OK"
+            body = render().encode('utf-8')
+        else:
+            status = "405 Method Not Allowed"
+            body = b"Only GET is supported\n"
+        writer.write(f"HTTP/1.0 {status}\r\n"
+                     "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     "Connection: close\r\n\r\n".encode('utf-8') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+        pass
+    finally:
+        writer.close()
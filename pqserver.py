@@ -12,14 +12,58 @@
 
 
 import socket
-import select
+import asyncio
 import sys
+import os
+import time
+import signal
+import shutil
 import argparse
+import itertools
+import sqlite3
+import logging
+import tempfile
+import multiprocessing
+import multiprocessing.connection
+from collections import deque
+
+from pqframe import Framer, PacketReader, pqframeexception, eomstring, readsize
+from pqframe import v2hello, header, flagack, flagnak, flagstatus, flagcompressed
+from pqframe import flagping, flagpong, pinggroup
+from pqframe import Compressor, compressors, compressmin, closewriter
+from pqlog import setuplogging, dumpframes
+from pqmetrics import Histogram, LagProbe, family, quantilesamples, scrape
+
+log = logging.getLogger("pqserver")
+framelog = logging.getLogger("pqserver.frames")  # Raw traffic, at DEBUG
 
 #Global variables
-debug = True  # Enable debugging messages
-eomstring = "</comm>"
+debug = False  # Enable debugging messages
+loglevel = "info"  # Lowest level of message to log
+logframes = 0  # Recent frames to keep in memory for errors, exit and SIGUSR1, 0 to log them at debug level
 maxoperators= 10
+cadtimeout = 1  # Seconds CAD may go quiet before its connection is dropped
+acktimeout = 1  # Seconds an operator has to acknowledge a message
+pipelinedepth = 4  # Messages that may await an ack from one operator at once
+queuehighwater = 32  # Messages held for one operator before CAD is told BUSY
+holdtime = 0  # Seconds to hold messages for a disconnected operator, 0 to refuse them
+holdfile = None  # SQLite file to keep held messages in across restarts
+compression = "zstd,zlib"  # Compression protocol 2 pqclients may ask for
+workers = 1  # Processes to share CAD and pqclient connections between
+cadbacklog = socket.SOMAXCONN  # CAD connections the kernel may queue before they're accepted
+metricshost = "127.0.0.1"  # Address to serve metrics on
+metricsport = 0  # TCP port to serve Prometheus metrics on, 0 for none
+metricspath = None  # Unix socket to serve Prometheus metrics on
+pinginterval = 2  # Seconds between heartbeats to protocol 2 pqclients, 0 for none
+pingmisses = 3  # Heartbeats in a row an operator may miss before it is dropped
+keepalive = 0  # Seconds idle before TCP keepalive probes on operator connections, 0 for none
+tcpusertimeout = 0  # Seconds sent data may go unacknowledged before the kernel drops an operator, 0 for the default
+
+# Messages are only ever handled as bytes on their way through
+eombytes = eomstring.encode('utf-8')
+
+# First line from a CAD that wants to send many messages on one connection
+cadhello = "CAD/2"
 
 # Command-line defaults
 cadhost='0.0.0.0'
@@ -44,7 +88,7 @@ def parsecmdline():
     options -- dictionary of selected command-line options
     """
 
-    # Since we'll be updating it later, use the global debug variable
+    # Since we'll be updating it later, use the global setting
     global debug
 
     # Define command-line arguments
@@ -54,7 +98,19 @@ def parsecmdline():
 
     #-d / --debug
     parser.add_argument("-d", "--debug", dest="debug", default=debug,
-                        action="store_true", help="enable debugging outputs")
+                        action="store_true", help="enable debugging outputs (same as --log-level debug)")
+
+    #--log-level
+    parser.add_argument("--log-level", dest="loglevel", default=loglevel,
+                        choices=["debug", "info", "warning", "error"],
+                        help="lowest level of message to log")
+
+    #--log-frames
+    parser.add_argument("--log-frames", dest="logframes", type=int,
+                        default=logframes,
+                        help="keep this many recent frames in memory and log them when an error "
+                             "is logged, on exit and on SIGUSR1 (Unix), instead of logging "
+                             "every frame at debug level")
 
     #--cad-host
     parser.add_argument("--cad-host", dest="cadhost",
@@ -76,23 +132,112 @@ def parsecmdline():
                         default=clientport,
                         help="port to listen on for connections from pqclients")
 
+    #--max-operators
+    parser.add_argument("--max-operators", dest="maxoperators", type=int,
+                        default=maxoperators,
+                        help="maximum number of connected operators")
+
+    #--read-size
+    parser.add_argument("--read-size", dest="readsize", type=int,
+                        default=readsize,
+                        help="bytes to request on each socket read")
+
+    #--ack-timeout
+    parser.add_argument("--ack-timeout", dest="acktimeout", type=float,
+                        default=acktimeout,
+                        help="seconds an operator has to acknowledge a message")
+
+    #--pipeline-depth
+    parser.add_argument("--pipeline-depth", dest="pipelinedepth", type=int,
+                        default=pipelinedepth,
+                        help="messages sent to an operator before waiting for acks")
+
+    #--queue-high-water
+    parser.add_argument("--queue-high-water", dest="queuehighwater", type=int,
+                        default=queuehighwater,
+                        help="messages queued for an operator before CAD gets BUSY")
+
+    #--hold-time
+    parser.add_argument("--hold-time", dest="holdtime", type=float,
+                        default=holdtime,
+                        help="seconds to hold messages for a disconnected operator, answering QUEUED")
+
+    #--hold-file
+    parser.add_argument("--hold-file", dest="holdfile",
+                        default=holdfile,
+                        help="SQLite file that keeps held messages across restarts")
+
+    #--compression
+    parser.add_argument("--compression", dest="compression",
+                        default=compression,
+                        help="comma-separated compression methods to allow pqclients, or none")
+
+    #--cad-backlog
+    parser.add_argument("--cad-backlog", dest="cadbacklog", type=int,
+                        default=cadbacklog,
+                        help="CAD connections the kernel may queue while pqserver is busy")
+
+    #--workers
+    parser.add_argument("--workers", dest="workers", type=int,
+                        default=workers,
+                        help="worker processes sharing the ports, one per core; each gets its own hold file")
+
+    #--ping-interval
+    parser.add_argument("--ping-interval", dest="pinginterval", type=float,
+                        default=pinginterval,
+                        help="seconds between heartbeats to pqclients that answer them, 0 for none")
+
+    #--ping-misses
+    parser.add_argument("--ping-misses", dest="pingmisses", type=int,
+                        default=pingmisses,
+                        help="heartbeats in a row an operator may miss before it is dropped")
+
+    #--keepalive
+    parser.add_argument("--keepalive", dest="keepalive", type=float,
+                        default=keepalive,
+                        help="seconds idle before TCP keepalive probes on operator connections, 0 for none")
+
+    #--tcp-user-timeout
+    parser.add_argument("--tcp-user-timeout", dest="tcpusertimeout", type=float,
+                        default=tcpusertimeout,
+                        help="seconds data to an operator may go unacknowledged before the "
+                             "connection is dropped (Linux only), 0 for the kernel default")
+
+    #--metrics-host
+    parser.add_argument("--metrics-host", dest="metricshost",
+                        default=metricshost,
+                        help="IP address to serve Prometheus metrics on")
+
+    #--metrics-port
+    parser.add_argument("--metrics-port", dest="metricsport", type=int,
+                        default=metricsport,
+                        help="port to serve Prometheus metrics on, 0 for none; with --workers, "
+                             "worker n uses this port plus n")
+
+    #--metrics-socket
+    parser.add_argument("--metrics-socket", dest="metricspath",
+                        default=metricspath,
+                        help="Unix socket to serve Prometheus metrics on; with --workers, "
+                             "worker n adds .n to the path")
+
     #parse arguments
     options = parser.parse_args()
 
-    # Set global debug setting from command-line options
+    # Everything else is handed to PQServer
     debug = options.debug
-
     if debug:
-        print("Processed command-line arguments:")
-        print(options)
+        options.loglevel = "debug"
+    setuplogging("pqserver", options.loglevel.upper(), options.logframes)
+
+    log.debug("Processed command-line arguments: %s", options)
 
     return options
 
-def closeall(connections):
-    """closeall() -- Close all connections in the supplied list
+def raisefdlimit():
+    """raisefdlimit() -- Allow as many open sockets as the system permits
 
     Params:
-    connections -- list of connections to try to close
+    None
 
     Throws:
     None
@@ -101,229 +246,2188 @@ def closeall(connections):
     None
     """
 
-    for sock in connections:
-        if sock:
-            sock.shutdown(socket.SHUT_RDWR)
-            sock.close()
-    print("Exiting, all connections closed")
+    # Hundreds of operators can exceed the default soft limit of 1024 files
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            log.debug("Raised open file limit from %s to %s", soft, hard)
+    except (ImportError, ValueError, OSError) as e:
+        log.debug("Unable to raise open file limit: %s", e)
+
+class QueuedMessage:
+    """QueuedMessage -- Base for whatever stands in an operator's queue
+
+    CadConnection, StreamedMessage, HeldMessage and ForwardedMessage each
+    pass the final status on in their own reply(), but share the ack
+    timer that Operator.pump() starts when the message is sent.  Each
+    sets server, recipient, cadmsg, timer and queued.
+    """
+
+    def stoptimer(self):
+        """stoptimer() -- Cancel the ack timer, if it is running
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def expire(self):
+        """expire() -- Handle the operator not acknowledging in time
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.timer = None
+        log.warning("Operator %s didn't acknowledge message in time, closing connection to client", self.recipient)
+        self.server.metrics.acktimeouts += 1
+        self.server.dropoperator(self.recipient)
+
+class CadInbox(asyncio.BufferedProtocol):
+    """CadInbox -- Reads a CAD connection straight into its parser's buffer
+
+    asyncio's streams receive each read in a fresh 256KB bytes object,
+    copy it into a buffer of their own and copy it out again.  Here the
+    transport recv_into()s the server's one scratch buffer instead, and
+    what arrived is appended to buffer from there, so CAD's bytes are
+    copied once on their way in.  transport stands in for a
+    StreamWriter; CAD is only ever written a line at a time.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = bytearray()
+        self.received = 0  # Bytes appended since read() last returned
+        self.closed = False
+        self.error = None
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.spawn(self.server.cadconnection(self), transport)
+
+    def get_buffer(self, sizehint):
+        return self.server.scratch
+
+    def buffer_updated(self, nbytes):
+        self.buffer += self.server.scratch[:nbytes]
+        self.received += nbytes
+        self.wake()
+
+    def eof_received(self):
+        self.closed = True
+        self.wake()
+
+        # Keep the connection open to answer
+        return True
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.error = exc
+        self.wake()
+
+    def wake(self):
+        """wake() -- Let read() return
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read(self):
+        """read() -- Wait for more of what CAD sends to land in buffer
+
+        Params:
+        None
+
+        Throws:
+        OSError if the connection failed
+
+        Returns:
+        Bytes appended to buffer since the last call, 0 once CAD has
+        closed the connection
+        """
+
+        if not self.received and not self.closed:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+        count, self.received = self.received, 0
+        if not count and self.error:
+            raise self.error
+        return count
+
+class CadConnection(QueuedMessage):
+    """CadConnection -- Parser state for one message being received from CAD
+
+    Each CAD connection carries a single message: the station number on a
+    line by itself followed by the message body, ending with eomstring.
+    Every connection is read by its own task, so any number of CAD
+    senders are interleaved and a slow one only delays itself.
+
+    Everything CAD sends lands in the CadInbox's bytearray and is
+    searched in place, and the finished message is a memoryview of it,
+    so the body is never decoded or copied again on its way to the
+    operator.
+    """
+
+    def __init__(self, server, inbox):
+        self.server = server
+        self.inbox = inbox
+        self.writer = inbox.transport
+        self.address = self.writer.get_extra_info("peername")
+        self.recipient = None
+        self.buffer = inbox.buffer
+        self.scanned = 0  # Bytes of buffer already searched
+        self.start = None  # Where the message starts, after the station line
+        self.cadmsg = None
+        self.timer = None  # Ack timeout while an operator has the message
+        self.queued = None  # When the operator's queue took the message
+
+    def reply(self, text):
+        """reply() -- Send a final status line to CAD and close the connection
+
+        Params:
+        text -- status to send, without trailing newline
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.stoptimer()
+
+        # The transport sends whatever it's given before it closes
+        reply = f"{text}\n".encode('utf-8')
+        self.server.metrics.cadbytesout += len(reply)
+        try:
+            self.writer.write(reply)
+        except OSError as e:
+            log.warning("Failed to send %s to CAD on %s: %s", text, self.address, e)
+        closewriter(self.writer)
+
+        # A held message reports its own fate once it has one
+        if self.cadmsg is not None and self.server.delivered and text != "QUEUED":
+            self.server.delivered(self.recipient, self.cadmsg, text)
+
+    async def run(self):
+        """run() -- Read CAD's message and hand it over for delivery
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        eom = len(eombytes)
+
+        while True:
+            try:
+                count = await asyncio.wait_for(self.inbox.read(), self.server.cadtimeout)
+            except asyncio.TimeoutError:
+                log.debug("No data received from CAD before timeout, closing connection")
+                closewriter(self.writer)
+                return
+            except OSError as e:
+                log.warning("Error receiving from CAD on %s: %s", self.address, e)
+                closewriter(self.writer)
+                return
+
+            # Or see that CAD closed the connection without finishing
+            if not count:
+                log.debug("CAD closed connection without sending terminator")
+                closewriter(self.writer)
+                return
+
+            if framelog.isEnabledFor(logging.DEBUG):
+                framelog.debug("received from CAD: %s", bytes(self.buffer[-count:]))
+            self.server.metrics.cadbytesin += count
+
+            # Have we received the station# yet?
+            if self.start is None:
+                # Wait for the rest of the first line
+                end = self.buffer.find(b"\n", self.scanned)
+                if end < 0:
+                    self.scanned = len(self.buffer)
+                    continue
+
+                station = self.buffer[:end].decode('utf-8', errors='replace').rstrip()
+
+                # CAD wants to keep the connection open for many messages
+                if station == cadhello:
+                    log.debug("CAD on %s is streaming messages", self.address)
+                    self.writer.write(f"OK {cadhello}\n".encode('utf-8'))
+                    del self.buffer[:end + 1]
+                    await CadStream(self.server, self.inbox).run()
+                    return
+
+                # Did we get a number?  first line from cad is station# 1-9 and \n
+                if not station.isdigit():
+                    log.info("Received invalid operator ID from CAD: %s", station)
+                    closewriter(self.writer)
+                    return
+
+                # Which operator's workstation gets it
+                self.recipient = self.server.route(station)
+
+                # Is this operator currently connected?  connected by pqaclient when starting
+                # Or did it drop off recently enough that we're holding its messages?
+                if not self.server.knows(self.recipient):
+                    log.info("Received non-existent operator ID from CAD: %s", station)
+                    self.reply("No such operator")
+                    return
+
+                # Don't bother reading a message the operator has no room for
+                elif self.server.busy(self.recipient):
+                    log.info("Operator %s has %s messages queued, answering BUSY", self.recipient, self.server.queuehighwater)
+                    self.reply("BUSY")
+                    return
+
+                # Recipient is valid and currently connected, or being held for
+                log.debug("Receiving message for operator %s", self.recipient)
+
+                # Whatever followed the station line is the start of the message
+                self.start = self.scanned = end + 1
+
+            # Is this the end of the message?  Only one is expected per connection.
+            # Back up in case the terminator straddles two reads.
+            end = self.buffer.find(eombytes, max(self.start, self.scanned - eom + 1))
+            if end < 0:
+                self.scanned = len(self.buffer)
+                continue
+
+            # Nothing more is read, so the buffer can be lent out as it is
+            self.inbox.transport.pause_reading()
+            self.cadmsg = memoryview(self.buffer)[self.start:end + eom]
+            self.server.metrics.cadreceived += 1
+            self.server.deliver(self)
+            return
+
+class StreamedMessage(QueuedMessage):
+    """StreamedMessage -- One message from a CadStream, answered on that stream
+
+    Stands in for a CadConnection in the operator's queue; its status
+    goes back to the CadStream, which answers CAD in order.
+    """
+
+    def __init__(self, stream, corrid, recipient, cadmsg):
+        self.server = stream.server
+        self.stream = stream
+        self.corrid = corrid
+        self.recipient = recipient
+        self.cadmsg = cadmsg
+        self.status = None
+        self.timer = None
+        self.queued = None
+
+    def reply(self, text):
+        """reply() -- Record the final status and pass it back to CAD in turn
+
+        Params:
+        text -- status to send, without trailing newline
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.stoptimer()
+        if self.status is None:
+            self.status = text
+            self.stream.answer(self)
+
+class CadStream:
+    """CadStream -- A CAD connection carrying many messages
+
+    A CAD that starts its connection with a "CAD/2" line, and gets
+    "OK CAD/2" back, can keep the connection open and send any number
+    of messages on it, each framed like a one-shot message with an
+    optional correlation ID after the station number:
+
+        <station>[ <corrid>]\n<message></comm>
+
+    Every message is answered, in the order they were sent, with a line
+    "<corrid> <status>", where the status is the one a one-shot CAD
+    connection would get and corrid defaults to the message's position
+    on the connection, counting from 1.  Messages for different
+    operators are delivered at the same time, so a slow operator only
+    holds up the answers behind it, and no more than queuehighwater
+    messages are read ahead of their answers.
+    """
+
+    def __init__(self, server, inbox):
+        self.server = server
+        self.inbox = inbox
+        self.writer = inbox.transport
+        self.address = self.writer.get_extra_info("peername")
+        self.buffer = inbox.buffer
+        self.scanned = 0  # Bytes of buffer already searched
+        self.start = None  # Where the current message starts, after its station line
+        self.station = None
+        self.corrid = None
+        self.sequence = itertools.count(1)
+        self.unanswered = deque()  # StreamedMessages in the order CAD sent them
+        self.room = asyncio.Event()  # Set while fewer than queuehighwater await answers
+        self.room.set()
+        self.finished = False  # CAD has stopped sending and waits for the rest of its answers
+
+    async def run(self):
+        """run() -- Read and deliver messages until CAD stops sending
+
+        A CAD that half-closes the connection once it has sent everything
+        still gets every answer; answer() closes the connection after the
+        last one.
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        while True:
+            self.parse()
+
+            # Leave the rest in the kernel while CAD waits for answers
+            if not self.room.is_set():
+                self.writer.pause_reading()
+                await self.room.wait()
+                self.writer.resume_reading()
+                continue
+
+            try:
+                count = await self.inbox.read()
+            except OSError as e:
+                log.warning("Error receiving from CAD on %s: %s", self.address, e)
+                closewriter(self.writer)
+                return
+
+            if not count:
+                log.debug("CAD on %s closed its stream with %s messages unanswered",
+                          self.address, len(self.unanswered))
+                self.finished = True
+                if not self.unanswered:
+                    closewriter(self.writer)
+                return
+            self.server.metrics.cadbytesin += count
+
+    def parse(self):
+        """parse() -- Deliver complete messages from the buffer while there is room
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        eom = len(eombytes)
+
+        while self.room.is_set():
+            if self.start is None:
+                end = self.buffer.find(b"\n", self.scanned)
+                if end < 0:
+                    self.scanned = len(self.buffer)
+                    return
+                fields = self.buffer[:end].decode('utf-8', errors='replace').split()
+                self.station = fields[0] if fields else ""
+                self.corrid = fields[1] if len(fields) > 1 else None
+                self.start = self.scanned = end + 1
+
+            # Back up in case the terminator straddles two reads
+            end = self.buffer.find(eombytes, max(self.start, self.scanned - eom + 1))
+            if end < 0:
+                self.scanned = len(self.buffer)
+                return
+
+            cadmsg = bytes(self.buffer[self.start:end + eom])
+            del self.buffer[:end + eom]
+            self.scanned = 0
+            self.start = None
+
+            sequence = next(self.sequence)
+            self.server.metrics.cadreceived += 1
+            self.submit(StreamedMessage(self, self.corrid or str(sequence),
+                                        self.server.route(self.station), cadmsg))
+
+    def submit(self, msg):
+        """submit() -- Hand one streamed message over for delivery
+
+        Params:
+        msg -- StreamedMessage just received
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.unanswered.append(msg)
+        if len(self.unanswered) >= self.server.queuehighwater:
+            self.room.clear()
+
+        if not self.station.isdigit():
+            log.info("Received invalid operator ID from CAD: %s", self.station)
+            msg.reply("NO")
+        elif not self.server.knows(msg.recipient):
+            log.info("Received non-existent operator ID from CAD: %s", self.station)
+            msg.reply("No such operator")
+        else:
+            log.debug("Received message for operator %s", msg.recipient)
+            self.server.deliver(msg)
+
+    def answer(self, msg):
+        """answer() -- Send CAD every status that is now next in line
+
+        Params:
+        msg -- StreamedMessage whose status has just been set
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        # A held message reports its own fate once it has one
+        if self.server.delivered and msg.status != "QUEUED":
+            self.server.delivered(msg.recipient, msg.cadmsg, msg.status)
+
+        while self.unanswered and self.unanswered[0].status is not None:
+            done = self.unanswered.popleft()
+            if self.writer.is_closing():
+                continue
+            reply = f"{done.corrid} {done.status}\n".encode('utf-8')
+            self.server.metrics.cadbytesout += len(reply)
+            try:
+                self.writer.write(reply)
+            except OSError as e:
+                log.warning("Failed to send %s to CAD on %s: %s", done.status, self.address, e)
+
+        # The transport sends whatever it's given before it closes
+        if self.finished and not self.unanswered:
+            closewriter(self.writer)
+        elif len(self.unanswered) < self.server.queuehighwater:
+            self.room.set()
+
+class Operator:
+    """Operator -- A registered pqclient and the deliveries waiting on it
+
+    Messages are written to the operator's stream as they are submitted,
+    and the CAD connection behind each one waits in pending until the
+    operator answers "OK"/"NO" or its ack timer runs out.  Nothing here
+    waits on the operator, so a slow workstation only delays messages
+    addressed to it.
+
+    Up to pipelinedepth messages are sent ahead of their acks, and at
+    most queuehighwater are held in total before CAD is turned away with
+    "BUSY".  Each message sent gets an ID; protocol 1 pqclients answer
+    in order, protocol 2 ones name the ID they are answering.  Protocol
+    2 messages are compressed if pqclient asked for it.
+
+    pqclient also reports its ProQA links, as "LINK <group> UP|DOWN"
+    lines or status packets, which are tracked in links and never count
+    as acks.
+
+    A protocol 2 pqclient that offered to answer pings is sent one every
+    pinginterval seconds, and dropped once pingmisses in a row go
+    unanswered, so a station whose network vanished without closing the
+    connection is noticed in seconds.  rtt is the round trip of the
+    latest ping answered.
+    """
+
+    def __init__(self, server, op, reader, writer, protocol=1, method=None, ping=False):
+        self.server = server
+        self.op = op
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.protocol = protocol
+        self.compressor = Compressor(method) if method else None
+        self.acks = PacketReader() if protocol == 2 else Framer(b"\n")
+        self.msgids = itertools.count(1)
+        self.waiting = deque()  # CAD connections not yet sent
+        self.pending = {}  # Message ID -> CAD connection sent, awaiting an ack
+        self.links = {}  # ProQA group ID -> False while that link is down
+        self.latency = server.metrics.operatorlatency(op)
+        self.pinger = None  # Timer for the next heartbeat
+        self.pingids = itertools.count(1)
+        self.pingid = None  # ID of the latest ping, until it's answered
+        self.pingsent = 0  # Loop time it was sent
+        self.missed = 0  # Pings in a row that went unanswered
+        self.rtt = None  # Seconds the latest answered ping took
+
+        if ping and server.pinginterval:
+            self.pinger = asyncio.get_running_loop().call_later(server.pinginterval, self.heartbeat)
+
+    def heartbeat(self):
+        """heartbeat() -- Ping the operator, or drop it if too many pings went unanswered
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.pinger = None
+        if self.pingid is not None:
+            self.missed += 1
+            if self.missed >= self.server.pingmisses:
+                log.warning("Operator %s missed %s heartbeats, closing connection to client",
+                            self.op, self.missed)
+                self.server.metrics.pingevictions += 1
+                self.server.dropoperator(self.op)
+                self.writer.transport.abort()
+                return
+
+        loop = asyncio.get_running_loop()
+        self.pingid = next(self.pingids) & 0xffffffff
+        self.pingsent = loop.time()
+        self.writer.write(header.pack(self.pingid, pinggroup, flagping, 0))
+        self.server.metrics.operatorbytesout += header.size
+        self.pinger = loop.call_later(self.server.pinginterval, self.heartbeat)
+
+    def full(self):
+        """full() -- Check whether the operator's queue is at its high-water mark
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        True if no more messages should be accepted for this operator
+        """
+
+        return len(self.waiting) + len(self.pending) >= self.server.queuehighwater
+
+    def submit(self, cad):
+        """submit() -- Queue a complete CAD message for delivery
+
+        Params:
+        cad -- CadConnection or HeldMessage holding the complete message
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        cad.queued = time.monotonic()
+        self.waiting.append(cad)
+        self.pump()
+
+    def pump(self):
+        """pump() -- Start sending queued messages while the pipeline has room
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        loop = asyncio.get_running_loop()
+        metrics = self.server.metrics
+
+        while self.waiting and len(self.pending) < self.server.pipelinedepth:
+            cad = self.waiting.popleft()
+            if framelog.isEnabledFor(logging.DEBUG):
+                framelog.debug("Sending to %s: %s", self.op, bytes(cad.cadmsg))
+            cad.timer = loop.call_later(self.server.acktimeout, cad.expire)
+            msgid = next(self.msgids) & 0xffffffff
+            self.pending[msgid] = cad
+            if self.protocol == 2:
+                # The group ID goes in the header and the rest is the payload
+                payload = memoryview(cad.cadmsg)[1:]
+                flags = 0
+                if self.compressor and len(payload) >= compressmin:
+                    payload = self.compressor.compress(payload)
+                    flags = flagcompressed
+                # From Python 3.12 this is one sendmsg() with no copying
+                self.writer.writelines((header.pack(msgid, bytes(cad.cadmsg[0:1]), flags, len(payload)),
+                                        payload))
+                metrics.operatorbytesout += header.size + len(payload)
+            else:
+                self.writer.write(cad.cadmsg)
+                metrics.operatorbytesout += len(cad.cadmsg)
+            metrics.cadrelayed += 1
+
+    async def run(self):
+        """run() -- Read the operator's acks and status until it goes away
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        try:
+            while True:
+                try:
+                    data = await self.reader.read(self.server.readsize)
+                except OSError:
+                    data = None
+
+                # Client has closed connection
+                if not data:
+                    log.info("Operator %s disconnected", self.op)
+                    return
+                self.server.metrics.operatorbytesin += len(data)
+
+                try:
+                    replies = self.acks.feed(data)
+                except pqframeexception as e:
+                    log.warning("Operator %s sent a bad packet, closing connection to client: %s", self.op, e)
+                    return
+
+                if not self.answer(replies):
+                    return
+
+                self.pump()
+
+        finally:
+            # Unless it was already dropped for something else
+            if self.server.operators.get(self.op) is self:
+                self.server.dropoperator(self.op)
+
+    def answer(self, replies):
+        """answer() -- Pass the operator's answers back to CAD
+
+        Params:
+        replies -- lines (protocol 1) or packets (protocol 2) from pqclient
+
+        Throws:
+        None
+
+        Returns:
+        False if the operator sent something it shouldn't have
+        """
+
+        for reply in replies:
+            if self.protocol == 2:
+                msgid, groupid, flags, payload = reply
+
+                # Answer to a heartbeat; an old one still shows the operator is there
+                if flags & flagpong:
+                    if msgid == self.pingid:
+                        self.rtt = asyncio.get_running_loop().time() - self.pingsent
+                        self.pingid = None
+                    self.missed = 0
+                    continue
+
+                groupid = groupid.decode('utf-8', errors='replace')
+
+                # ProQA link state, not an answer to any message
+                if flags & flagstatus:
+                    self.linkstate(groupid, payload.decode('utf-8', errors='replace'))
+                    continue
+
+                resp = "OK" if flags & flagack else "NO" if flags & flagnak else repr(reply)
+
+            else:
+                resp = reply.decode('utf-8', errors='replace').rstrip()
+
+                # ProQA link state, not an answer to any message
+                if resp.startswith("LINK "):
+                    fields = resp.split()
+                    if len(fields) == 3:
+                        self.linkstate(fields[1], fields[2])
+                        continue
+
+                # Protocol 1 answers in the order messages were sent
+                msgid = next(iter(self.pending), None)
+
+            if msgid not in self.pending:
+                log.info("Ignoring unexpected response from operator %s: %s", self.op, resp)
+                continue
+
+            cad = self.pending.pop(msgid)
+            self.latency.observe(time.monotonic() - cad.queued)
+
+            if resp == "OK":
+                log.debug("Message acknowledged by Operator %s", self.op)
+                self.server.metrics.acksok += 1
+                cad.reply("OK")
+            elif resp == "NO":
+                log.info("Operator %s rejected message", self.op)
+                self.server.metrics.acksno += 1
+                cad.reply("NO")
+            else:
+                log.warning("Operator %s sent garbage acknowledgement, closing connection to client", self.op)
+                self.server.metrics.acksno += 1
+                cad.reply("NO")
+                return False
+
+        return True
+
+    def linkstate(self, groupid, state):
+        """linkstate() -- Record pqclient's report on one of its ProQA links
+
+        Params:
+        groupid -- group ID of the ProQA application
+        state -- "UP" or "DOWN"
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if state in ("UP", "DOWN"):
+            log.info("Operator %s ProQA link %s is %s", self.op, groupid, state)
+            self.links[groupid] = state == "UP"
+
+class HeldMessage(QueuedMessage):
+    """HeldMessage -- A CAD message kept for an operator after CAD was told "QUEUED"
+
+    CAD has hung up by the time one of these is delivered, so it stands
+    in for the CadConnection in the operator's queue and the outcome is
+    only logged.  rowid is its row in the hold file, if there is one.
+    """
+
+    def __init__(self, server, recipient, cadmsg, expires=None, rowid=None):
+        self.server = server
+        self.recipient = recipient
+        self.cadmsg = cadmsg
+        self.expires = expires or time.monotonic() + server.holdtime
+        self.rowid = rowid
+        self.timer = None
+        self.queued = None
+
+    def reply(self, text):
+        """reply() -- Record how delivery of a held message turned out
+
+        Params:
+        text -- status CAD would have been sent
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.stoptimer()
+        log.info("Held message for operator %s finished with %s", self.recipient, text)
+        self.server.holdqueue.forget(self)
+
+        if self.server.delivered:
+            self.server.delivered(self.recipient, self.cadmsg, text)
+
+class HoldQueue:
+    """HoldQueue -- CAD messages kept for operators that are briefly disconnected
+
+    When an operator drops off, messages for it are held in arrival
+    order for up to holdtime seconds, at most queuehighwater of them, and
+    handed to the operator as soon as it registers again.  With a hold
+    file every held message is also written to SQLite (WAL mode,
+    synchronous=NORMAL, like pqclient's spool) so a pqserver restart
+    doesn't lose them; its row is deleted once the operator answers.
+    """
+
+    def __init__(self, server, path=None):
+        self.server = server
+        self.queues = {}  # Operator ID -> deque of HeldMessage
+        self.departed = {}  # Operator ID -> when it disconnected
+        self.timer = None
+        self.db = None
+
+        if not path:
+            return
+
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS held ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "operator TEXT NOT NULL, msg BLOB NOT NULL, expires REAL NOT NULL)")
+
+        # Pick up whatever an earlier run was still holding
+        self.db.execute("DELETE FROM held WHERE expires <= ?", (time.time(),))
+        now = time.monotonic()
+        offset = now - time.time()
+        for rowid, op, msg, expires in self.db.execute(
+                "SELECT id, operator, msg, expires FROM held ORDER BY id").fetchall():
+            self.queues.setdefault(op, deque()).append(
+                HeldMessage(server, op, msg, expires + offset, rowid))
+            self.departed[op] = now
+        for op, queue in self.queues.items():
+            log.info("Holding %s messages for operator %s from an earlier run", len(queue), op)
+
+    def accepts(self, op):
+        """accepts() -- Check whether messages for an operator should be held
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        True if the operator disconnected less than holdtime ago; messages
+        already held don't extend that
+        """
+
+        departed = self.departed.get(op)
+        return departed is not None and time.monotonic() - departed < self.server.holdtime
+
+    def full(self, op):
+        """full() -- Check whether an operator's held messages are at the high-water mark
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        True if no more messages can be held for this operator
+        """
+
+        return len(self.queues.get(op, ())) >= self.server.queuehighwater
+
+    def depart(self, op):
+        """depart() -- Note that an operator has just disconnected
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.server.holdtime:
+            self.departed[op] = time.monotonic()
+
+    def hold(self, msg):
+        """hold() -- Keep a message until its operator registers or it expires
+
+        Params:
+        msg -- HeldMessage to keep
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.queues.setdefault(msg.recipient, deque()).append(msg)
+
+        if self.db and msg.rowid is None:
+            try:
+                wallclock = msg.expires - time.monotonic() + time.time()
+                msg.rowid = self.db.execute(
+                    "INSERT INTO held (operator, msg, expires) VALUES (?, ?, ?)",
+                    (msg.recipient, msg.cadmsg, wallclock)).lastrowid
+            except sqlite3.Error as e:
+                log.warning("Unable to write held message to disk, holding it in memory only: %s", e)
+
+        if self.timer is None or msg.expires < self.timer.when():
+            self.schedule()
+
+    def release(self, op):
+        """release() -- Hand over everything held for an operator that has registered
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        List of HeldMessage, oldest first
+        """
+
+        self.departed.pop(op, None)
+        return list(self.queues.pop(op, ()))
+
+    def forget(self, msg):
+        """forget() -- Remove a message that has been delivered, refused or expired
+
+        Params:
+        msg -- HeldMessage to remove from the hold file
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.db and msg.rowid is not None:
+            try:
+                self.db.execute("DELETE FROM held WHERE id = ?", (msg.rowid,))
+            except sqlite3.Error as e:
+                log.warning("Unable to remove held message from disk: %s", e)
+            msg.rowid = None
+
+    def schedule(self):
+        """schedule() -- Arrange for expire() to run when the oldest message runs out
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        # The loop's clock is time.monotonic(), same as the expiry times
+        deadline = min((queue[0].expires for queue in self.queues.values()), default=None)
+        if deadline is not None:
+            self.timer = asyncio.get_running_loop().call_at(deadline, self.expire)
+
+    def expire(self):
+        """expire() -- Discard messages whose operator didn't come back in time
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.timer = None
+        now = time.monotonic()
+
+        for op, queue in list(self.queues.items()):
+            while queue and queue[0].expires <= now:
+                log.info("Operator %s didn't reconnect within %gs, discarding held message", op, self.server.holdtime)
+                queue.popleft().reply("NO")
+            if not queue:
+                del self.queues[op]
+
+        for op, when in list(self.departed.items()):
+            if now - when >= self.server.holdtime:
+                del self.departed[op]
+
+        self.schedule()
+
+    def close(self):
+        """close() -- Stop the expiry timer and close the hold file
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.db:
+            self.db.close()
+            self.db = None
+
+class ForwardedMessage(QueuedMessage):
+    """ForwardedMessage -- A CAD message another worker passed on for delivery
+
+    The worker CAD connected to still has the CAD connection, so this
+    stands in for it in the operator's queue and sends the final status
+    back over the PeerLink under the ID it arrived with.
+    """
+
+    def __init__(self, server, peer, msgid, recipient, cadmsg):
+        self.server = server
+        self.peer = peer
+        self.msgid = msgid
+        self.recipient = recipient
+        self.cadmsg = cadmsg
+        self.timer = None
+        self.queued = None
+
+    def reply(self, text):
+        """reply() -- Send the final status back to the worker CAD is waiting on
+
+        Params:
+        text -- status to send
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.stoptimer()
+        self.peer.send(b"S", text.encode('utf-8'), self.msgid)
+
+class PeerLink:
+    """PeerLink -- Unix socket to another pqserver worker
+
+    With --workers, every worker accepts CAD and pqclient connections on
+    the same ports, so CAD may reach a different worker than the
+    operator.  Workers tell each other which operators have registered
+    with them, and a CAD message for an operator on another worker is
+    passed to that worker, which delivers it and sends back the status
+    for CAD.  Each message is a v2 packet whose group byte says what it
+    carries:
+
+    W -- hello, the payload is the sender's worker number
+    O -- the operator in the payload has registered with the sender
+    G -- the operator in the payload has left the sender
+    C -- a CAD message, "<op>\n<message>", to deliver and answer with S
+    S -- the final status of the C message with the same ID
+    H -- a held message, like C, for an operator that has registered
+         with the receiver; it gets no answer
+    """
+
+    def __init__(self, server, worker, reader, writer):
+        self.server = server
+        self.worker = worker
+        self.reader = reader
+        self.writer = writer
+        self.msgids = itertools.count(1)
+        self.pending = {}  # Message ID -> CAD connection waiting on the other worker
+
+    def send(self, kind, payload=b"", msgid=0):
+        """send() -- Send one packet to the other worker
+
+        Params:
+        kind -- group byte saying what the packet carries
+        payload -- bytes-like payload
+        msgid -- ID of the message it carries or answers
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.writer.write(header.pack(msgid, kind, 0, len(payload)))
+        self.writer.write(payload)
+
+    def forward(self, cad, kind=b"C"):
+        """forward() -- Pass a CAD message to the worker that has its operator
+
+        Params:
+        cad -- CadConnection, ForwardedMessage or HeldMessage holding the message
+        kind -- b"C" to be answered, b"H" for a held message that isn't
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        msgid = 0
+        if kind == b"C":
+            msgid = next(self.msgids) & 0xffffffff
+            self.pending[msgid] = cad
+        self.send(kind, cad.recipient.encode('utf-8') + b"\n" + cad.cadmsg, msgid)
+
+    async def run(self):
+        """run() -- Act on packets from the other worker until it goes away
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        try:
+            while True:
+                msgid, kind, flags, length = header.unpack(await self.reader.readexactly(header.size))
+                payload = await self.reader.readexactly(length)
+
+                if kind == b"O":
+                    self.server.peerowns(self, payload.decode('utf-8'))
+                elif kind == b"G":
+                    self.server.peerleft(self, payload.decode('utf-8'))
+                elif kind == b"S":
+                    cad = self.pending.pop(msgid, None)
+                    if cad:
+                        cad.reply(payload.decode('utf-8', errors='replace'))
+                elif kind in (b"C", b"H"):
+                    op, sep, cadmsg = payload.partition(b"\n")
+                    op = op.decode('utf-8')
+                    if kind == b"C":
+                        self.server.deliver(ForwardedMessage(self.server, self, msgid, op, cadmsg))
+                    else:
+                        self.server.adopt(HeldMessage(self.server, op, cadmsg))
+
+        except (asyncio.IncompleteReadError, OSError):
+            log.warning("Lost connection to worker %s", self.worker)
+
+        finally:
+            self.close()
+
+    def close(self):
+        """close() -- Forget the other worker and fail what it was delivering
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        closewriter(self.writer)
+        if self.server.peers.get(self.worker) is self:
+            del self.server.peers[self.worker]
+        for op in [op for op, peer in self.server.owners.items() if peer is self]:
+            del self.server.owners[op]
+
+        pending = list(self.pending.values())
+        self.pending.clear()
+        for cad in pending:
+            cad.reply("NO")
+
+class Metrics:
+    """Metrics -- Counters kept by a PQServer, for its metrics endpoint
+
+    The counters are plain integers bumped from the event loop, and each
+    operator's delivery latency goes into a Histogram made when it first
+    registers, so recording a message allocates nothing and takes no
+    lock.  Queue depths and operator counts are read from the server
+    when render() is called.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.cadreceived = 0  # Complete messages read from CAD
+        self.cadrelayed = 0  # Messages written to an operator
+        self.acksok = 0
+        self.acksno = 0
+        self.acktimeouts = 0
+        self.pingevictions = 0  # Operators dropped for missing heartbeats
+        self.cadbytesin = 0
+        self.cadbytesout = 0
+        self.operatorbytesin = 0
+        self.operatorbytesout = 0
+        self.latency = {}  # Operator ID -> Histogram of seconds from queued to answered
+        self.looplag = Histogram()
+        self.probe = LagProbe(self.looplag)
+
+    def operatorlatency(self, op):
+        """operatorlatency() -- Get the latency histogram for an operator, making it if needed
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        Histogram to observe the operator's delivery latency in
+        """
+
+        if op not in self.latency:
+            self.latency[op] = Histogram()
+        return self.latency[op]
+
+    def render(self):
+        """render() -- Format every metric in Prometheus text format
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        Metrics text
+        """
+
+        server = self.server
+        lines = []
+
+        lines += family("pqserver_cad_messages_received_total", "counter",
+                        "Complete messages read from CAD", [("", self.cadreceived)])
+        lines += family("pqserver_cad_messages_relayed_total", "counter",
+                        "Messages written to an operator's pqclient", [("", self.cadrelayed)])
+        lines += family("pqserver_acks_total", "counter",
+                        "Operator answers to relayed messages, by result",
+                        [('result="ok"', self.acksok), ('result="no"', self.acksno),
+                         ('result="timeout"', self.acktimeouts)])
+        lines += family("pqserver_heartbeat_evictions_total", "counter",
+                        "Operators dropped for missing heartbeats", [("", self.pingevictions)])
+        lines += family("pqserver_bytes_received_total", "counter", "Bytes read, by peer",
+                        [('peer="cad"', self.cadbytesin), ('peer="operator"', self.operatorbytesin)])
+        lines += family("pqserver_bytes_sent_total", "counter", "Bytes written, by peer",
+                        [('peer="cad"', self.cadbytesout), ('peer="operator"', self.operatorbytesout)])
+
+        lines += family("pqserver_operators", "gauge", "Operators connected to this process",
+                        [("", len(server.operators))])
+        lines += family("pqserver_operators_elsewhere", "gauge",
+                        "Operators connected to other workers", [("", len(server.owners))])
+        lines += family("pqserver_max_operators", "gauge", "Most operators allowed at once",
+                        [("", server.maxoperators)])
+
+        queues = []
+        for op, operator in sorted(server.operators.items()):
+            queues.append((f'operator="{op}",state="waiting"', len(operator.waiting)))
+            queues.append((f'operator="{op}",state="pending"', len(operator.pending)))
+        if server.holdqueue:
+            for op, held in sorted(server.holdqueue.queues.items()):
+                queues.append((f'operator="{op}",state="held"', len(held)))
+        lines += family("pqserver_queue_depth", "gauge",
+                        "Messages waiting to be sent, awaiting an ack, or held, by operator", queues)
+        lines += family("pqserver_operator_rtt_seconds", "gauge",
+                        "Round trip of each operator's latest answered heartbeat",
+                        [(f'operator="{op}"', operator.rtt)
+                         for op, operator in sorted(server.operators.items())
+                         if operator.rtt is not None])
+
+        latency = []
+        estimates = []
+        for op, histogram in sorted(self.latency.items()):
+            latency += histogram.samples(f'operator="{op}"')
+            estimates += quantilesamples(histogram, f'operator="{op}"')
+        lines += family("pqserver_delivery_latency_seconds", "histogram",
+                        "Seconds from a message reaching an operator's queue to its answer", latency)
+        lines += family("pqserver_delivery_latency_quantile_seconds", "gauge",
+                        "Delivery latency quantiles estimated from the histogram buckets", estimates)
+
+        lines += family("pqserver_loop_lag_seconds", "histogram",
+                        "How late the event loop ran a timer, the length of the iteration that held it up",
+                        self.looplag.samples())
+
+        return "\n".join(lines) + "\n"
+
+class PQServer:
+    """PQServer -- Relay from CAD to pqclients, on asyncio streams
+
+    Everything the relay knows lives on the instance, so several can run
+    in one interpreter, in one event loop or alongside other services:
+
+        server = PQServer(cadport=6001, clientport=6000)
+        await server.start()
+        ...
+        await server.stop()
+
+    Settings default to the module globals, which are also the command
+    line's defaults; runserver() passes in whatever the command line
+    chose.  Two hooks let an embedding service change how messages flow:
+
+    route(station) -- returns the operator ID a CAD message addressed to
+    station should go to.  The default sends it to that station.
+
+    delivered(recipient, cadmsg, status) -- called exactly once for each
+    complete message, when its fate is known, with the final status CAD
+    was (or for held messages would have been) sent: "OK", "NO", "BUSY"
+    or "No such operator".  It runs in the worker CAD sent the message
+    to, except for held messages.  Those aren't reported when CAD is
+    told "QUEUED", but once the operator answers, or with "NO" if they
+    are refused or expire first, by whichever worker has them then.  A
+    message still held when the server stops is reported by the run that
+    picks it up from the hold file, or never without one.  A one-shot
+    CAD connection answered from its station line alone ("BUSY" or "No
+    such operator") never sent a message, so it isn't reported.
+
+    To share the load between processes, start one PQServer in each with
+    reuseport=True, its own worker number, and peerpaths listing a Unix
+    socket path for every worker.  They connect to each other over
+    PeerLinks before they start listening.
+
+    Counters are always kept in metrics; given metricsport or
+    metricspath they are served there in Prometheus text format.
+    """
+
+    def __init__(self, cadhost=cadhost, cadport=cadport, clienthost=clienthost,
+                 clientport=clientport, maxoperators=maxoperators, cadtimeout=cadtimeout,
+                 acktimeout=acktimeout, pipelinedepth=pipelinedepth,
+                 queuehighwater=queuehighwater, holdtime=holdtime, holdfile=holdfile,
+                 compression=compression, readsize=readsize, route=None, delivered=None,
+                 reuseport=False, worker=0, peerpaths=(), cadbacklog=cadbacklog,
+                 metricshost=metricshost, metricsport=metricsport, metricspath=metricspath,
+                 pinginterval=pinginterval, pingmisses=pingmisses, keepalive=keepalive,
+                 tcpusertimeout=tcpusertimeout):
+        self.cadhost = cadhost
+        self.cadport = cadport
+        self.clienthost = clienthost
+        self.clientport = clientport
+        self.maxoperators = max(1, maxoperators)
+        self.cadtimeout = cadtimeout
+        self.acktimeout = acktimeout
+        self.pipelinedepth = max(1, pipelinedepth)
+        self.queuehighwater = max(1, queuehighwater)
+        self.holdtime = max(0, holdtime)
+        self.holdfile = holdfile
+        self.compression = [method for method in compression.split(",") if method in compressors()]
+        self.readsize = max(1, readsize)
+        self.scratch = memoryview(bytearray(self.readsize))  # Every CAD read lands here first
+        self.cadbacklog = max(1, cadbacklog)
+        self.route = route or (lambda station: station)
+        self.delivered = delivered
+        self.pinginterval = max(0, pinginterval)
+        self.pingmisses = max(1, pingmisses)
+        self.keepalive = max(0, keepalive)
+        self.tcpusertimeout = max(0, tcpusertimeout)
+        self.metricshost = metricshost
+        self.metricsport = metricsport
+        self.metricspath = metricspath
+        self.metrics = Metrics(self)
+
+        self.reuseport = reuseport
+        self.worker = worker
+        self.peerpaths = list(peerpaths)
+
+        # Create dictionary to map operator numbers to their Operator
+        self.operators = {}
+        self.holdqueue = None
+        self.servers = []
+        self.tasks = set()
+
+        # Other workers, and which of them has each operator they've told us about
+        self.peers = {}  # Worker number -> PeerLink
+        self.owners = {}  # Operator ID -> PeerLink of the worker it registered with
+        self.peerserver = None
+
+    async def start(self):
+        """start() -- Start listening for CAD and pqclients
+
+        Params:
+        None
+
+        Throws:
+        pqserverexception if either listener can't be set up
+
+        Returns:
+        None
+        """
+
+        # Messages for operators that have dropped off, until they come back,
+        # with the clock started on anything left from an earlier run
+        try:
+            self.holdqueue = HoldQueue(self, self.holdfile)
+        except sqlite3.Error as e:
+            raise pqserverexception(f"Unable to open hold file {self.holdfile}: {e}")
+        self.holdqueue.expire()
+
+        #  listen on ports 6000 and 6001 for cad and pqaclients
+        try:
+            if self.peerpaths:
+                await self.joinpeers()
+            self.servers.append(await self.listen("CAD", self.cadhost, self.cadport, backlog=self.cadbacklog,
+                                                  protocol=lambda: CadInbox(self)))
+            self.servers.append(await self.listen("pqclients", self.clienthost, self.clientport,
+                                                  self.clientconnection,
+                                                  backlog=min(self.maxoperators, socket.SOMAXCONN)))
+            if self.metricsport:
+                self.servers.append(await self.listen("metrics scrapers", self.metricshost,
+                                                      self.metricsport, self.metricsconnection))
+            if self.metricspath:
+                self.servers.append(await self.listenunix("metrics scrapers", self.metricspath,
+                                                          self.metricsconnection))
+        except pqserverexception:
+            await self.stop()
+            raise
+
+        if self.metricsport or self.metricspath:
+            self.metrics.probe.start()
+
+    async def listen(self, name, host, port, handler=None, backlog=3, protocol=None):
+        """listen() -- Start an asyncio server
+
+        Params:
+        name -- human-friendly name of the server
+        host -- IP address to listen for connections on
+        port -- TCP port to listen for connections on, 0 for any free port
+        handler -- coroutine to run for each connection
+        backlog -- connections the kernel may queue before we accept them
+        protocol -- factory for an asyncio protocol to serve each
+                    connection with instead of streams and a handler
+
+        Throws:
+        pqserverexception if socket can't be established
+
+        Returns:
+        asyncio.Server, whose sockets say which port was bound
+        """
+
+        try:
+            if protocol:
+                server = await asyncio.get_running_loop().create_server(protocol, host, port, backlog=backlog,
+                                                                        reuse_port=self.reuseport)
+            else:
+                server = await asyncio.start_server(lambda reader, writer: self.spawn(handler(reader, writer), writer),
+                                                    host, port, backlog=backlog,
+                                                    reuse_port=self.reuseport)
+            log.info("Listening for connections from %s on %s:%s", name, host, server.sockets[0].getsockname()[1])
+            return server
+        except OSError as e:
+            raise pqserverexception(f"Failed to create {name} server on {host}:{port}: {e}")
+
+    async def listenunix(self, name, path, handler):
+        """listenunix() -- Start an asyncio server on a Unix socket
+
+        Params:
+        name -- human-friendly name of the server
+        path -- socket path; a stale socket left there is replaced
+        handler -- coroutine to run for each connection
+
+        Throws:
+        pqserverexception if socket can't be established
+
+        Returns:
+        asyncio.Server
+        """
+
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(lambda reader, writer: self.spawn(handler(reader, writer), writer),
+                                                     path)
+            log.info("Listening for connections from %s on %s", name, path)
+            return server
+        except OSError as e:
+            raise pqserverexception(f"Failed to create {name} server on {path}: {e}")
+
+    def spawn(self, coroutine, writer=None):
+        """spawn() -- Run a connection's coroutine as a task that stop() can cancel
+
+        A connection normally outlives its task only while CAD waits for
+        an answer, so the connection is closed if the task is cancelled.
+
+        Params:
+        coroutine -- coroutine to run
+        writer -- asyncio.StreamWriter of the connection it serves, if any
+
+        Throws:
+        None
+
+        Returns:
+        The new task
+        """
+
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if writer:
+            task.add_done_callback(lambda task: task.cancelled() and closewriter(writer))
+        return task
+
+    async def stop(self):
+        """stop() -- Stop listening, drop every operator and cancel every connection
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.peerserver:
+            self.servers.append(self.peerserver)
+            self.peerserver = None
+        for server in self.servers:
+            server.close()
+        for path in ([self.peerpaths[self.worker]] if self.peerpaths else []) + [self.metricspath]:
+            try:
+                if path:
+                    os.unlink(path)
+            except OSError:
+                pass
+        self.metrics.probe.stop()
+
+        for op in list(self.operators):
+            self.dropoperator(op)
+        for peer in list(self.peers.values()):
+            peer.close()
+
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        # From Python 3.12 this waits for every connection to close, so
+        # it has to come after everything above has closed them
+        try:
+            await asyncio.wait_for(asyncio.gather(*(server.wait_closed() for server in self.servers)),
+                                   self.cadtimeout)
+        except asyncio.TimeoutError:
+            log.warning("Connections still open after %ss, exiting anyway", self.cadtimeout)
+        self.servers = []
+
+        if self.holdqueue:
+            self.holdqueue.close()
+        log.info("Exiting, all connections closed")
+
+    def knows(self, op):
+        """knows() -- Check whether messages for an operator can be taken
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        True if the operator is connected or its messages are being held
+        """
+
+        return op in self.operators or op in self.owners or self.holdqueue.accepts(op)
+
+    def busy(self, op):
+        """busy() -- Check whether an operator's queue, live or held, is at its high-water mark
+
+        Params:
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        True if CAD should be told BUSY
+        """
+
+        # The worker that has the operator decides
+        if op in self.owners:
+            return False
+        if op in self.operators:
+            return self.operators[op].full()
+        return self.holdqueue.full(op)
+
+    def deliver(self, cad):
+        """deliver() -- Hand a complete CAD message to its operator for delivery
+
+        Params:
+        cad -- CadConnection or ForwardedMessage holding the complete message
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        # Another worker has the operator's connection
+        if cad.recipient in self.owners:
+            self.owners[cad.recipient].forward(cad)
+            return
+
+        # The queue may have filled up while the message was arriving
+        if self.busy(cad.recipient):
+            log.info("Operator %s has %s messages queued, answering BUSY", cad.recipient, self.queuehighwater)
+            cad.reply("BUSY")
+            return
+
+        # The operator may have gone away, or been away, while the message was arriving
+        if cad.recipient not in self.operators:
+            if self.holdqueue.accepts(cad.recipient):
+                log.info("Operator %s is disconnected, holding message for up to %gs", cad.recipient, self.holdtime)
+                self.holdqueue.hold(HeldMessage(self, cad.recipient, cad.cadmsg))
+                cad.reply("QUEUED")
+            else:
+                log.info("Operator %s disconnected before message could be sent", cad.recipient)
+                cad.reply("NO")
+            return
+
+        # No point sending what pqclient can't pass on to ProQA
+        groupid = bytes(cad.cadmsg[0:1]).decode('utf-8', errors='replace')
+        if not self.operators[cad.recipient].links.get(groupid, True):
+            log.info("Operator %s ProQA link %s is down, answering NO", cad.recipient, groupid)
+            cad.reply("NO")
+            return
+
+        self.operators[cad.recipient].submit(cad)
+
+    def dropoperator(self, op):
+        """dropoperator() -- Forget an operator, close its connection and fail its messages
+
+        Params:
+        op -- operator ID to drop
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        operator = self.operators.pop(op, None)
+        if not operator:
+            return
+        if operator.pinger:
+            operator.pinger.cancel()
+            operator.pinger = None
+
+        for peer in self.peers.values():
+            peer.send(b"G", op.encode('utf-8'))
+
+        # Its reader task sees the stream close and finishes
+        closewriter(operator.writer)
+
+        # Anything sent but unacknowledged may or may not have reached ProQA
+        for cad in operator.pending.values():
+            cad.reply("NO")
+
+        # Anything never sent can wait for the operator to come back
+        self.holdqueue.depart(op)
+        for cad in operator.waiting:
+            if not self.holdqueue.accepts(op) or self.holdqueue.full(op):
+                cad.reply("NO")
+            elif isinstance(cad, HeldMessage):
+                self.holdqueue.hold(cad)
+            else:
+                self.holdqueue.hold(HeldMessage(self, op, cad.cadmsg))
+                cad.reply("QUEUED")
+
+    async def cadconnection(self, inbox):
+        """cadconnection() -- Receive one message, or a stream of them, from a new CAD connection
+
+        Params:
+        inbox -- CadInbox reading the connection
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        log.debug("connection from CAD on %s", inbox.transport.get_extra_info('peername'))
+        await CadConnection(self, inbox).run()
+
+    async def metricsconnection(self, reader, writer):
+        """metricsconnection() -- Answer a scrape of the metrics endpoint
+
+        Params:
+        reader -- asyncio.StreamReader for the connection
+        writer -- asyncio.StreamWriter for the connection
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        await scrape(reader, writer, self.metrics.render)
+
+    async def clientconnection(self, reader, writer):
+        """clientconnection() -- Register a new pqclient and serve it until it goes away
+
+        pqclient sends its operator ID as soon as it connects, either bare
+        (protocol 1) or as a "PQ/2 <op> [<compression>,...|none] [ping]"
+        line.
+
+        Params:
+        reader -- asyncio.StreamReader for the connection
+        writer -- asyncio.StreamWriter for the connection
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        address = writer.get_extra_info("peername")
+        log.info("New client connection from %s", address[0])
+
+        hello = bytearray()
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(self.readsize), self.cadtimeout)
+            except asyncio.TimeoutError:
+                log.info("No data received from client before timeout, closing connection")
+                closewriter(writer)
+                return
+            except OSError:
+                data = None
+
+            if not data:
+                log.info("Client on %s closed connection before identifying itself", address[0])
+                closewriter(writer)
+                return
+
+            hello += data
+
+            # Protocol 1 clients send just the operator ID, anything else a line
+            if hello[:1].isdigit() or b"\n" in hello:
+                break
+            if len(hello) > 64:
+                log.info("Rejecting connection from %s that sent garbage", address[0])
+                closewriter(writer)
+                return
+
+        protocol = 1
+        method = None
+        ping = False
+        answer = "OK"
+
+        if hello[:1].isdigit():
+            op = hello.decode('utf-8', errors='replace').rstrip()
+        else:
+            fields = hello[:hello.find(b"\n")].decode('utf-8', errors='replace').split()
+            if len(fields) < 2 or fields[0] != v2hello:
+                log.info("Rejecting connection from %s asking for protocol %s", address[0], fields[:1])
+                writer.write("Unsupported protocol\n".encode('utf-8'))
+                closewriter(writer)
+                return
+
+            op = fields[1]
+            protocol = 2
+            answer = f"OK {v2hello}"
+
+            # Use the first compression method offered that we allow
+            offered = fields[2].split(",") if len(fields) > 2 else []
+            method = next((m for m in offered if m in self.compression), None)
+            ping = "ping" in fields[3:] and self.pinginterval > 0
+            if method or ping:
+                answer += f" {method or 'none'}"
+            if ping:
+                answer += f" ping={self.pinginterval:g},{self.pingmisses}"
+
+        # Make sure operator identified itself with a number
+        if not op.isdigit():
+            log.info("Rejecting connection from %s that sent garbage", address[0])
+            closewriter(writer)
+            return
+
+        elif op in self.operators or op in self.owners:
+            log.info("Rejecting connection from %s identified as already connected operator %s", address[0], op)
+            writer.write("Operator already connected\n".encode('utf-8'))
+            closewriter(writer)
+            return
+
+        elif len(self.operators) + len(self.owners) >= self.maxoperators:
+            log.info("Rejecting operator %s from %s, already at %s operators", op, address[0], self.maxoperators)
+            writer.write("Too many operators\n".encode('utf-8'))
+            closewriter(writer)
+            return
+
+        log.info("Operator %s connected from %s using protocol %s%s", op, address[0], protocol,
+                 f" with {method} compression" if method else "")
+        writer.write(f"{answer}\n".encode('utf-8'))
+
+        self.tunesocket(writer.get_extra_info("socket"))
+
+        # Record this open connection and the associated operator
+        operator = Operator(self, op, reader, writer, protocol, method, ping)
+        self.operators[op] = operator
+        for peer in self.peers.values():
+            peer.send(b"O", op.encode('utf-8'))
+
+        # Pass on whatever arrived while the operator was away
+        held = self.holdqueue.release(op)
+        if held:
+            log.info("Sending operator %s %s messages held while it was disconnected", op, len(held))
+        for msg in held:
+            operator.submit(msg)
+
+        await operator.run()
+
+    def tunesocket(self, sock):
+        """tunesocket() -- Apply the keepalive and user timeout settings to an operator's socket
+
+        Protocol 1 pqclients can't answer pings, so for them these are
+        the only way to notice a connection that died without closing.
+
+        Params:
+        sock -- the connection's socket
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        try:
+            if self.keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, "TCP_KEEPIDLE"):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(self.keepalive)))
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(self.keepalive / 3)))
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+            if self.tcpusertimeout and hasattr(socket, "TCP_USER_TIMEOUT"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(self.tcpusertimeout * 1000))
+        except OSError as e:
+            log.warning("Unable to set TCP keepalive or user timeout: %s", e)
+
+    async def joinpeers(self):
+        """joinpeers() -- Connect to every other worker before taking connections
+
+        Each worker listens on its own Unix socket and dials every worker
+        numbered below it, so each pair ends up with one PeerLink.
+
+        Params:
+        None
+
+        Throws:
+        pqserverexception if the other workers can't be reached
+
+        Returns:
+        None
+        """
+
+        path = self.peerpaths[self.worker]
+        try:
+            self.peerserver = await asyncio.start_unix_server(
+                lambda reader, writer: self.spawn(self.peerconnection(reader, writer), writer), path)
+        except OSError as e:
+            raise pqserverexception(f"Failed to listen for other workers on {path}: {e}")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 10
+        for worker, path in enumerate(self.peerpaths[:self.worker]):
+            # The other worker may still be starting up
+            while True:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    break
+                except OSError as e:
+                    if loop.time() > deadline:
+                        raise pqserverexception(f"Failed to connect to worker {worker} on {path}: {e}")
+                    await asyncio.sleep(0.05)
+            writer.write(header.pack(0, b"W", 0, len(str(self.worker))) + str(self.worker).encode('utf-8'))
+            self.addpeer(worker, reader, writer)
+
+        while len(self.peers) < len(self.peerpaths) - 1:
+            if loop.time() > deadline:
+                raise pqserverexception(f"Only {len(self.peers)} of {len(self.peerpaths) - 1} other workers connected")
+            await asyncio.sleep(0.05)
 
-def startserver(name, host, port):
-    """startserver() -- Create a socket for a listening server
+        log.debug("Worker %s connected to %s other workers", self.worker, len(self.peers))
+
+    async def peerconnection(self, reader, writer):
+        """peerconnection() -- Take a connection from another worker
+
+        Params:
+        reader -- asyncio.StreamReader for the connection
+        writer -- asyncio.StreamWriter for the connection
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        try:
+            msgid, kind, flags, length = header.unpack(await reader.readexactly(header.size))
+            worker = int(await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, OSError, ValueError):
+            closewriter(writer)
+            return
+        if kind != b"W":
+            closewriter(writer)
+            return
+
+        await self.addpeer(worker, reader, writer).run()
+
+    def addpeer(self, worker, reader, writer):
+        """addpeer() -- Start exchanging operators and messages with another worker
+
+        Params:
+        worker -- the other worker's number
+        reader -- asyncio.StreamReader for the connection
+        writer -- asyncio.StreamWriter for the connection
+
+        Throws:
+        None
+
+        Returns:
+        The new PeerLink
+        """
+
+        peer = PeerLink(self, worker, reader, writer)
+        self.peers[worker] = peer
+
+        # Catch it up on who has registered here
+        for op in self.operators:
+            peer.send(b"O", op.encode('utf-8'))
+
+        # Dialled links are read from their own task, accepted ones from the caller's
+        if worker < self.worker:
+            self.spawn(peer.run())
+        return peer
+
+    def peerowns(self, peer, op):
+        """peerowns() -- Note that an operator has registered with another worker
+
+        Params:
+        peer -- PeerLink to that worker
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.owners[op] = peer
+
+        # Anything held here while it was away goes to where it is now
+        held = self.holdqueue.release(op)
+        if held:
+            log.info("Passing %s messages held for operator %s to worker %s", len(held), op, peer.worker)
+        for msg in held:
+            peer.forward(msg, b"H")
+            self.holdqueue.forget(msg)
+
+    def peerleft(self, peer, op):
+        """peerleft() -- Note that an operator has left another worker
+
+        Params:
+        peer -- PeerLink to that worker
+        op -- operator ID
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.owners.get(op) is peer:
+            del self.owners[op]
+            self.holdqueue.depart(op)
+
+    def adopt(self, msg):
+        """adopt() -- Take over a held message another worker has passed on
+
+        Params:
+        msg -- HeldMessage for an operator that registered here
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if msg.recipient in self.operators:
+            self.operators[msg.recipient].submit(msg)
+        elif msg.recipient in self.owners:
+            self.owners[msg.recipient].forward(msg, b"H")
+        else:
+            self.holdqueue.hold(msg)
+
+async def runserver(options, worker=0, peerpaths=()):
+    """runserver() -- Run a PQServer with the command-line settings until cancelled
 
     Params:
-    name -- human-friendly name of the server
-    host -- IP address to listen for connections on
-    port -- TCP port to listen for connections on
+    options -- options from parsecmdline()
+    worker -- this process's worker number, with --workers
+    peerpaths -- Unix socket path of every worker, with --workers
 
     Throws:
-    pqserverexception if socket can't be established
+    pqserverexception if the server can't start
 
     Returns:
-    File descriptor of newly created socket
+    None
     """
 
+    # Every worker keeps its own held messages and metrics
+    holdfile = options.holdfile
+    metricsport = options.metricsport
+    metricspath = options.metricspath
+    if peerpaths:
+        holdfile = holdfile and f"{holdfile}.{worker}"
+        metricsport = metricsport and metricsport + worker
+        metricspath = metricspath and f"{metricspath}.{worker}"
+
+    server = PQServer(options.cadhost, options.cadport, options.clienthost, options.clientport,
+                      options.maxoperators, cadtimeout, options.acktimeout,
+                      options.pipelinedepth, options.queuehighwater, options.holdtime,
+                      holdfile, options.compression, options.readsize,
+                      reuseport=bool(peerpaths), worker=worker, peerpaths=peerpaths,
+                      cadbacklog=options.cadbacklog, metricshost=options.metricshost,
+                      metricsport=metricsport, metricspath=metricspath,
+                      pinginterval=options.pinginterval, pingmisses=options.pingmisses,
+                      keepalive=options.keepalive, tcpusertimeout=options.tcpusertimeout)
+    await server.start()
     try:
-        sock = socket.create_server((host, port), backlog=3)
-        print(f"Listening for connections from {name} on {host}:{port}")
-        return sock
-    except OSError as e:
-        raise pqserverexception(f"Failed to create {name} server on {host}:{port}: {e}")
-
-if __name__ == "__main__":
-    options = parsecmdline()
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
 
-    # Create list of connections to listen on
-    connections = []
+def runworker(options, worker, peerpaths):
+    """runworker() -- Run one worker process until it is told to stop
 
-    # Create dictionary to map operator numbers to open sockets
-    operators = {}
+    Params:
+    options -- options from parsecmdline()
+    worker -- this process's worker number
+    peerpaths -- Unix socket path of every worker
 
-    cadsock = None
-    clientsock = None
+    Throws:
+    None
 
-    debug and print(f"Listening for cad on {options.cadhost}:{options.cadport} and client on {options.clienthost}:{options.clientport}", file=sys.stderr)
+    Returns:
+    None; the process exits 1 if its server can't start
+    """
 
-    #  setup sockets on localhost ports 6000 and 6001, bind, listen for cad and pqaclients
-    try:
-        cadsock = startserver("CAD", options.cadhost, options.cadport)
-        connections.append(cadsock)
+    # The parent stops workers with SIGTERM, which should shut down cleanly
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
-        clientsock = startserver("pqclients", clienthost, clientport)
-        connections.append(clientsock)
+    # The parent's logging thread wasn't forked along with it, and a worker
+    # exits without running atexit, so it dumps its frames and stops its
+    # own thread
+    listener = setuplogging("pqserver", options.loglevel.upper(), options.logframes)
 
+    try:
+        asyncio.run(runserver(options, worker, peerpaths))
     except pqserverexception as e:
-        print(e)
-        closeall(connections)
+        log.error("Worker %s: %s", worker, e)
         sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dumpframes("pqserver")
+        listener.stop()
 
-    # Wait for a connection
-    while True:
-        try:
-            debug and print("waiting for a connection", file=sys.stderr)
-            rlist = select.select(connections, [], [])[0]
-            
-            # ==========================================================
-            # New message from CAD to send to a client
-            # ==========================================================
-
-            if cadsock in rlist:
-                cadcon, client_address = cadsock.accept()
-                cadcon.settimeout(1)
-                debug and print(f"connection from CAD on {client_address}", file=sys.stderr)
-
-                recipient = None
-                cadmsg = ""
-
-                while True:
-                    try:
-                        data = cadcon.recv(16)
-                    except socket.timeout:
-                        debug and print("No data received from CAD before timeout, closing connection")
-                        cadcon.shutdown(socket.SHUT_RDWR)
-                        cadcon.close()
-                        break
-
-                    if data:
-                        debug and print(f"received from CAD: {data}")
-                        decoded = data.decode('utf-8')
-                        
-                        # Have we received the station# yet?
-                        if not recipient:
-                            # If input contains newline, split into station and message
-                            if "\n" in decoded:
-                                recipient = decoded[:decoded.index("\n")]
-                                cadmsg = decoded[decoded.index("\n")+1:]
-
-                            # Did we get a number?  first line from cad is station# 1-9 and \n
-                            if not recipient or not recipient.isdigit():
-                                print(f"Received invalid operator ID from CAD: {recipient}")
-                                cadcon.shutdown(socket.SHUT_RDWR)
-                                cadcon.close()
-                                break
-
-                            # Is this operator currently connected?  connected by pqaclient when starting
-                            elif not recipient in operators:
-                                print(f"Received non-existent operator ID from CAD: {recipient}")
-                                cadcon.sendall("No such operator\n".encode('utf-8'))
-                                cadcon.shutdown(socket.SHUT_RDWR)
-                                cadcon.close()
-                                break
-
-                            # Recipient is valid and currently connected
-                            else:
-                                print(f"Receiving message for operator {recipient}")
-
-                        # We received the operator, this is the message
-                        else:
-                            cadmsg += data.decode('utf-8')
-                            
-                        # Is this the end of the message?
-                        if eomstring in cadmsg:
-                            debug and print(f"Sending to {recipient}: {cadmsg}")
-                            
-                            operators[recipient].sendall(cadmsg.encode('utf-8'))
-
-                            try:
-                                resp = operators[recipient].recv(4)
-                            except OSError as e:
-                                resp = None
-
-                            if resp and resp.decode('utf-8').rstrip() == "OK":
-                                print(f"Message acknowledged by Operator {recipient}")
-                                cadcon.sendall("OK\n".encode('utf-8'))
-
-                            else:
-                                print("Operator {recipient} didn't acknowledge message, closing connection to client")
-                                operators[recipient].shutdown(socket.SHUT_RDWR)
-                                operators[recipient].close()
-                                try:
-                                    connections.remove(operators[recipient])
-                                    del operators[recipient]
-                                except KeyError:
-                                    pass
-
-                                cadcon.sendall("NO\n".encode('utf-8'))
-
-                            cadcon.shutdown(socket.SHUT_RDWR)
-                            cadcon.close()
-                            break
-
-                    # Or see that the server closed the connection without finishing
-                    else:
-                        debug and print("CAD closed connection without sending terminator")
-                        break
-                        
-            # ======================================================================================
-            # New connection from a pqclient  - sent when pqclient.exe launches from c:\vproute
-            # ======================================================================================       
-            
-            if clientsock in rlist:
-                clientcon, client_address = clientsock.accept()
-                clientcon.settimeout(1)
-                print(f"New client connection from {client_address[0]}")
+def runworkers(options):
+    """runworkers() -- Fork worker processes and wait for any of them to exit
 
-                try:
-                    data = clientcon.recv(16)
-                except socket.timeout:
-                    print("No data received from client before timeout, closing connection")
-                    clientcon.shutdown(socket.SHUT_RDWR)
-                    clientcon.close()
-                    continue
+    Every worker listens on the CAD and pqclient ports with SO_REUSEPORT,
+    so the kernel spreads new connections between them.  If one worker
+    exits the rest are stopped too, and the parent exits 1 so systemd can
+    restart the lot.
 
-                if data:
-                    op = data.decode('utf-8').rstrip()
-
-                    # Make sure operator identified itself with a number
-                    if op.isdigit():
-                        if op in operators:
-                            print(f"Rejecting connection from {client_address[0]} identified as already connected operator {op}")
-                            clientcon.sendall("Operator already connected\n".encode('utf-8'))
-                            clientcon.shutdown(socket.SHUT_RDWR)
-                            clientcon.close()
-                        else:
-                            print(f"Operator {op} connected from {client_address[0]}")
-                            clientcon.sendall("OK\n".encode('utf-8'))
-
-                            # Record this open connection and the associated operator
-                            operators[op] = clientcon
-                            connections.append(operators[op])
-                    else:
-                        print(f"Rejecting connection from {client_address[0]} that sent garbage")
-                        clientcon.shutdown(socket.SHUT_RDWR)
-                        clientcon.close()
-
-                else:
-                    print(f"Client on {client_address[0]} closed connection before identifying itself")
-
-            for op in operators.keys():
-                conn = operators[op]
-                if conn in rlist:
-                    data = conn.recv(1)
-
-                    # Client has closed connection
-                    if not data:
-                        print(f"Operator {op} disconnected")
-                        try:
-                            connections.remove(operators[op])
-                            del operators[op]
-                        except KeyError:
-                            pass
-                        break
-
-            if clientsock in connections and len(operators) >= maxoperators:
-                print (f"Reached max number of operator connections {maxoperators}, not accepting more")
-                connections.remove(clientsock)
-            elif clientsock not in connections and len(operators) < maxoperators:
-                print (f"Connections below max number of operator connections {maxoperators}, accepting connections again")
-                connections.append(clientsock)
+    Params:
+    options -- options from parsecmdline()
 
-        except OSError as e:
-            print(f"Ignoring unhandled socket or IO error: {e}")
+    Throws:
+    None
 
-        except KeyboardInterrupt:
-            debug and print("Received interrupt signal, exiting")
-            break
+    Returns:
+    Exit status for the parent process
+    """
+
+    rundir = tempfile.mkdtemp(prefix="pqserver-")
+    peerpaths = [os.path.join(rundir, f"worker{n}.sock") for n in range(options.workers)]
+
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=runworker, args=(options, n, peerpaths),
+                                 name=f"pqserver-worker{n}")
+                 for n in range(options.workers)]
+
+    status = 0
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for process in processes:
+            process.start()
+        log.info("Started %s workers", options.workers)
+
+        # Each worker keeps its own frames, so have every one dump them
+        if options.logframes and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(process.pid, signum)
+                                                                 for process in processes])
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+        status = 1
+    except KeyboardInterrupt:
+        log.debug("Received interrupt signal, stopping workers")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    return status
+
+if __name__ == "__main__":
+    options = parsecmdline()
+
+    raisefdlimit()
+
+    log.debug("Listening for cad on %s:%s and client on %s:%s", options.cadhost, options.cadport, options.clienthost, options.clientport)
+
+    if options.workers > 1:
+        sys.exit(runworkers(options))
+
+    try:
+        asyncio.run(runserver(options))
+
+    except pqserverexception as e:
+        log.error("%s", e)
+        sys.exit(1)
 
+    except KeyboardInterrupt:
+        log.debug("Received interrupt signal, exiting")
 
-    closeall(connections)
     sys.exit(0)
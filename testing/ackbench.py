@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# ackbench - measure CAD -> operator ack latency through pqserver
+#
+#   python3 testing/ackbench.py --operators 10 --slow-delay 0.5
+#
+# Starts pqserver on spare ports, connects N simulated pqclients (operator 1
+# answers slowly), then fires CAD messages at all of them concurrently and
+# reports how long each CAD connection waited for its OK/NO.
+
+import socket
+import subprocess
+import threading
+import argparse
+import random
+import time
+import sys
+import os
+
+eomstring = "</comm>"
+
+pqserver = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pqserver.py")
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark CAD to operator acknowledgement latency in pqserver"
+        )
+
+    parser.add_argument("--operators", dest="operators", type=int, default=10,
+                        help="number of simulated pqclients")
+    parser.add_argument("--messages", dest="messages", type=int, default=20,
+                        help="messages sent to each operator")
+    parser.add_argument("--slow-delay", dest="slowdelay", type=float, default=0.5,
+                        help="seconds the slow operator waits before acknowledging")
+    parser.add_argument("--ack-timeout", dest="acktimeout", type=float, default=5,
+                        help="ack timeout passed to pqserver")
+    parser.add_argument("--cad-port", dest="cadport", type=int, default=16001,
+                        help="CAD port for the pqserver under test")
+    parser.add_argument("--clientport", dest="clientport", type=int, default=16000,
+                        help="pqclient port for the pqserver under test")
+    parser.add_argument("--server-arg", dest="serverargs", action="append", default=[],
+                        help="extra argument to pass to pqserver (repeatable)")
+
+    return parser.parse_args()
+
+def waitforport(port, timeout=10):
+    """waitforport() -- Wait until something is listening on a local port
+
+    Params:
+    port -- TCP port on localhost
+    timeout -- seconds to keep trying
+
+    Throws:
+    RuntimeError if nothing is listening before the timeout
+
+    Returns:
+    None
+    """
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+def operator(op, port, delay, ready):
+    """operator() -- Simulated pqclient that acknowledges every message
+
+    Params:
+    op -- operator ID to register as
+    port -- pqserver's pqclient port
+    delay -- seconds to wait before each acknowledgement
+    ready -- threading.Event to set once registered
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    conn = socket.create_connection(("localhost", port))
+    conn.sendall(op.encode('utf-8'))
+    conn.recv(32)
+    ready.set()
+
+    buffer = b""
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        buffer += data
+        while eomstring.encode('utf-8') in buffer:
+            msg, buffer = buffer.split(eomstring.encode('utf-8'), 1)
+            if delay:
+                time.sleep(delay)
+            conn.sendall(b"OK\n")
+    conn.close()
+
+def cadsend(port, op, results):
+    """cadsend() -- Send one CAD message and record how long the reply took
+
+    Params:
+    port -- pqserver's CAD port
+    op -- operator ID to address
+    results -- list to append (op, seconds, reply) to
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    start = time.perf_counter()
+    try:
+        conn = socket.create_connection(("localhost", port))
+        conn.sendall(f"{op}\nmbenchmark message for {op}{eomstring}".encode('utf-8'))
+        reply = conn.recv(32).decode('utf-8').rstrip()
+        conn.close()
+    except OSError as e:
+        reply = f"error: {e}"
+    results.append((op, time.perf_counter() - start, reply))
+
+def percentile(values, pct):
+    """percentile() -- Nearest-rank percentile of a list of numbers
+
+    Params:
+    values -- numbers to summarize
+    pct -- percentile between 0 and 100
+
+    Throws:
+    None
+
+    Returns:
+    The requested percentile, or 0 for an empty list
+    """
+
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def report(name, samples):
+    """report() -- Print latency statistics for a set of samples
+
+    Params:
+    name -- label for this set of samples
+    samples -- list of (op, seconds, reply) tuples
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    latencies = [s[1] * 1000 for s in samples]
+    busy = len([s for s in samples if s[2] == "BUSY"])
+    failures = len([s for s in samples if s[2] not in ("OK", "BUSY")])
+    print(f"{name:>16}: n={len(samples):<5} fail={failures:<4} busy={busy:<4} "
+          f"p50={percentile(latencies, 50):8.2f}ms p95={percentile(latencies, 95):8.2f}ms "
+          f"max={max(latencies, default=0):8.2f}ms")
+
+if __name__ == "__main__":
+    options = parsecmdline()
+
+    server = subprocess.Popen([sys.executable, pqserver,
+                               "--cad-port", str(options.cadport),
+                               "--clientport", str(options.clientport),
+                               "--ack-timeout", str(options.acktimeout)] + options.serverargs,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        waitforport(options.clientport)
+
+        # Operator 1 is the slow workstation, everyone else answers at once
+        ops = [str(n) for n in range(1, options.operators + 1)]
+        for op in ops:
+            ready = threading.Event()
+            delay = options.slowdelay if op == "1" else 0
+            threading.Thread(target=operator, daemon=True,
+                             args=(op, options.clientport, delay, ready)).start()
+            ready.wait(5)
+
+        sends = [op for op in ops for n in range(options.messages)]
+        random.shuffle(sends)
+
+        results = []
+        threads = []
+        start = time.perf_counter()
+        for op in sends:
+            thread = threading.Thread(target=cadsend, args=(options.cadport, op, results))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        print(f"{len(results)} messages to {options.operators} operators in {elapsed:.2f}s "
+              f"(slow operator delay {options.slowdelay}s)")
+        report("fast operators", [r for r in results if r[0] != "1"])
+        report("slow operator", [r for r in results if r[0] == "1"])
+
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# catchbench - connections and latency for catch URL posts from pqclient
+#
+#   python3 testing/catchbench.py --posts 200 --connect-delay 100
+#
+# Posts ProQA-sized messages through pqclient's catchpost() to a local
+# catchserver, once with a new connection for every message (the old
+# behaviour) and once with pqclient's pooled keep-alive session, then
+# repeats the pooled run against a server that drops idle connections to
+# show that stale connections are replaced without failed posts.
+#
+# To include real TLS handshakes, make a certificate for localhost and pass
+# it with --cert/--key:
+#   openssl req -x509 -newkey rsa:2048 -nodes -keyout key.pem -out cert.pem \
+#       -days 1 -subj /CN=localhost -addext subjectAltName=DNS:localhost
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pqclient
+from pqframe import eomstring
+from catchserver import startcatchserver
+from ackbench import percentile
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Compare per-post connections with pqclient's pooled session"
+        )
+
+    parser.add_argument("--posts", dest="posts", type=int, default=200,
+                        help="messages to post in each run")
+    parser.add_argument("--payload", dest="payload", type=int, default=2048,
+                        help="bytes per posted message")
+    parser.add_argument("--connect-delay", dest="connectdelay", type=float, default=50,
+                        help="milliseconds the stand-in stalls each new connection")
+    parser.add_argument("--cert", dest="cert",
+                        help="TLS certificate for CN=localhost, to post over https")
+    parser.add_argument("--key", dest="key", help="TLS private key file")
+
+    return parser.parse_args()
+
+async def run(options, name, session, idletimeout=0, pause=0):
+    """run() -- Post messages to a fresh stand-in and report what it saw
+
+    Params:
+    options -- command-line options
+    name -- label for this run
+    session -- pqclient.CatchSession to post with
+    idletimeout -- seconds before the stand-in closes idle connections
+    pause -- seconds to wait between posts
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    server = startcatchserver(0, connectdelay=options.connectdelay / 1000,
+                              cert=options.cert, key=options.key,
+                              idletimeout=idletimeout)
+    scheme = "https" if options.cert else "http"
+    url = f"{scheme}://localhost:{server.server_address[1]}/i/pqcatchlog.php"
+    msg = "x" * options.payload + eomstring
+
+    latencies = []
+    failures = 0
+    for n in range(options.posts):
+        start = time.perf_counter()
+        if not await pqclient.catchpost("Medical", url, msg, session):
+            failures += 1
+        latencies.append((time.perf_counter() - start) * 1000)
+        if pause:
+            await asyncio.sleep(pause)
+
+    stats = server.stats.snapshot()
+    server.shutdown()
+    server.server_close()
+
+    print(f"{name:>22}: posts={options.posts:<5} fail={failures:<4} "
+          f"connections={stats['connections']:<5} "
+          f"p50={percentile(latencies, 50):7.2f}ms p95={percentile(latencies, 95):7.2f}ms")
+
+async def main(options):
+    """main() -- Run each comparison in turn
+
+    Params:
+    options -- command-line options
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    # Trust the stand-in's own certificate rather than the system CAs
+    verify = options.cert or True
+
+    # A pool of none closes every connection after its post
+    session = pqclient.CatchSession(0, verify)
+    await run(options, "new connection per post", session)
+
+    session = pqclient.CatchSession(pqclient.catchpoolsize, verify)
+    await run(options, "pooled session", session)
+    session.close()
+
+    # Every other post finds its kept-alive connection already closed
+    session = pqclient.CatchSession(pqclient.catchpoolsize, verify)
+    options.posts = min(options.posts, 20)
+    await run(options, "pooled, stale conns", session, idletimeout=0.05, pause=0.1)
+    session.close()
+
+if __name__ == "__main__":
+    options = parsecmdline()
+    pqclient.debug = False
+
+    asyncio.run(main(options))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# catchserver - local stand-in for the pqcatchlog.php catch URL
+#
+#   python3 testing/catchserver.py --port 8080 --connect-delay 150
+#   pqclient -o 1 -u http://localhost:8080/i/pqcatchlog.php
+#
+# Accepts any POST, plain or gzipped, answers 200 with HTTP/1.1
+# keep-alive, and counts connections and posted messages.  --connect-delay stalls each new
+# connection to stand in for the TCP+TLS handshake over the WAN,
+# --idle-timeout drops quiet keep-alive connections, and --cert/--key
+# serve real TLS.  GET /stats returns the counters as JSON.
+
+import ssl
+import gzip
+import json
+import time
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class CatchStats:
+    """CatchStats -- Counters shared by every request handler"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.messages = 0
+        self.received = []
+        self.arrived = []  # time.time() each kept message arrived, alongside received
+
+    def snapshot(self):
+        """snapshot() -- Current counters as a dictionary
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        Dictionary of counters
+        """
+
+        with self.lock:
+            return {"connections": self.connections,
+                    "requests": self.requests,
+                    "messages": self.messages}
+
+class CatchHandler(BaseHTTPRequestHandler):
+    """CatchHandler -- Accepts posted ProQA messages like pqcatchlog.php"""
+
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body go out in separate writes; without this, Nagle
+    # holds the body back until the client's delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Close connections left idle this long, like a real web server
+        self.timeout = self.server.idletimeout or None
+        super().setup()
+        if self.server.connectdelay:
+            time.sleep(self.server.connectdelay)
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(200, json.dumps(self.server.stats.snapshot()).encode('utf-8'))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        fields = parse_qs(body.decode('utf-8', errors='replace'))
+        msgs = fields.get("msg", []) + fields.get("msg[]", [])
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        with self.server.stats.lock:
+            self.server.stats.requests += 1
+            self.server.stats.messages += len(msgs)
+            if self.server.keep:
+                self.server.stats.received.extend(msgs)
+                self.server.stats.arrived.extend([time.time()] * len(msgs))
+
+        self.reply(self.server.status, b'{"ok": true}')
+
+def startcatchserver(port, host="localhost", delay=0, connectdelay=0, status=200,
+                     cert=None, key=None, keep=False, verbose=False, idletimeout=0):
+    """startcatchserver() -- Run a catch URL stand-in on a background thread
+
+    Params:
+    port -- TCP port to listen on (0 picks a free one)
+    host -- address to listen on
+    delay -- seconds to wait before answering each post
+    connectdelay -- seconds to stall each new connection
+    status -- HTTP status to answer posts with
+    cert -- TLS certificate file, to serve https
+    key -- TLS private key file
+    keep -- keep every posted message in stats.received, and when it
+            arrived in stats.arrived
+    verbose -- log every request
+    idletimeout -- seconds before an idle keep-alive connection is closed
+
+    Throws:
+    OSError if the port can't be bound
+
+    Returns:
+    The running ThreadingHTTPServer; its stats attribute holds the counters
+    """
+
+    server = ThreadingHTTPServer((host, port), CatchHandler)
+    server.daemon_threads = True
+    server.stats = CatchStats()
+    server.delay = delay
+    server.connectdelay = connectdelay
+    server.status = status
+    server.keep = keep
+    server.verbose = verbose
+    server.idletimeout = idletimeout
+
+    if cert:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in for the ProQA catch URL")
+    parser.add_argument("--host", dest="host", default="localhost",
+                        help="address to listen on")
+    parser.add_argument("--port", dest="port", type=int, default=8080,
+                        help="port to listen on")
+    parser.add_argument("--delay", dest="delay", type=float, default=0,
+                        help="milliseconds to wait before answering each post")
+    parser.add_argument("--connect-delay", dest="connectdelay", type=float, default=0,
+                        help="milliseconds to stall each new connection")
+    parser.add_argument("--status", dest="status", type=int, default=200,
+                        help="HTTP status to answer posts with")
+    parser.add_argument("--idle-timeout", dest="idletimeout", type=float, default=0,
+                        help="seconds before idle keep-alive connections are closed")
+    parser.add_argument("--cert", dest="cert", help="TLS certificate file")
+    parser.add_argument("--key", dest="key", help="TLS private key file")
+    options = parser.parse_args()
+
+    server = startcatchserver(options.port, options.host, options.delay / 1000,
+                              options.connectdelay / 1000, options.status,
+                              options.cert, options.key, verbose=True,
+                              idletimeout=options.idletimeout)
+    print(f"Catch URL stand-in listening on {options.host}:{options.port}")
+
+    try:
+        while True:
+            time.sleep(10)
+            print(f"Stats: {server.stats.snapshot()}")
+    except KeyboardInterrupt:
+        print(f"Final stats: {server.stats.snapshot()}")
+        server.shutdown()
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+# e2ebench - end-to-end throughput and latency from CAD to the catch URL
+#
+#   python3 testing/e2ebench.py --operators 5 --rate 50 --duration 20 --output run.json
+#   python3 testing/e2ebench.py --operators 5 --rate 50 --duration 20 --baseline run.json
+#
+# Starts everything a real deployment has, on spare local ports: pqserver,
+# a fleet of real pqclient processes, pqsim standing in for the three
+# ProQA applications, and catchserver standing in for the catch URL.
+# Then it sends CAD messages at a steady rate to operators picked
+# uniformly or with a Zipf skew, and follows each message the whole way:
+#
+#   cad_ack         CAD sending the message until pqserver answers OK/NO
+#   cad_to_proqa    CAD sending it until ProQA has all of it (pqsim --stamp)
+#   proqa_to_catch  ProQA answering until pqclient's post reaches the catch URL
+#   cad_to_catch    the whole trip
+#
+# Each message body carries its sequence number and send time, so every
+# hop is timed from the same clock.  Throughput and p50/p99 for each hop
+# are printed and, with --output, written as JSON along with the options
+# and the commit under test.  --baseline compares against an earlier
+# JSON file and exits 1 if throughput or any hop's p50 or p99 got worse
+# by more than --tolerance percent.
+
+import json
+import random
+import re
+import subprocess
+import argparse
+import platform
+import tempfile
+import time
+import sys
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from ackbench import waitforport, percentile
+from catchserver import startcatchserver
+from loadtest import cadsend, cadstreamsend, raisefdlimit, pqserver
+
+here = os.path.dirname(os.path.abspath(__file__))
+pqclient = os.path.join(here, "..", "pqclient.py")
+pqsim = os.path.join(here, "pqsim.py")
+
+hops = ("cad_ack", "cad_to_proqa", "proqa_to_catch", "cad_to_catch")
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark CAD to catch URL through real pqserver and pqclient processes"
+        )
+
+    parser.add_argument("--operators", dest="operators", type=int, default=5,
+                        help="number of pqclient processes")
+    parser.add_argument("--rate", dest="rate", type=float, default=50,
+                        help="CAD messages per second")
+    parser.add_argument("--duration", dest="duration", type=float, default=10,
+                        help="seconds to send CAD messages for")
+    parser.add_argument("--payload", dest="payload", type=int, default=2048,
+                        help="bytes of message body per CAD message")
+    parser.add_argument("--stations", dest="stations", choices=["uniform", "zipf"],
+                        default="uniform",
+                        help="how CAD picks the operator for each message")
+    parser.add_argument("--zipf-exponent", dest="zipfexponent", type=float, default=1.0,
+                        help="skew of --stations zipf; operator n gets 1/n**exponent of the traffic")
+    parser.add_argument("--groups", dest="groups", default="mfp",
+                        help="ProQA group IDs to pick from for each message; repeat one to weight it")
+    parser.add_argument("--concurrency", dest="concurrency", type=int, default=16,
+                        help="CAD connections allowed in flight at once")
+    parser.add_argument("--persistent", dest="persistent", action="store_true",
+                        help="send over long-lived CAD/2 streams, one per sending thread")
+    parser.add_argument("--drain", dest="drain", type=float, default=10,
+                        help="seconds to wait after sending for posts to reach the catch URL")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="pqserver worker processes; use this rather than --server-arg "
+                             "so each worker's metrics port is reserved and read")
+    parser.add_argument("--base-port", dest="baseport", type=int, default=17000,
+                        help="first of 6 + --workers consecutive local ports to use")
+    parser.add_argument("--server-arg", dest="serverargs", action="append", default=[],
+                        help="extra argument to pass to pqserver (repeatable)")
+    parser.add_argument("--client-arg", dest="clientargs", action="append", default=[],
+                        help="extra argument to pass to every pqclient (repeatable)")
+    parser.add_argument("--log-dir", dest="logdir",
+                        help="directory to write each process's output to")
+    parser.add_argument("--output", dest="output",
+                        help="JSON file to write the results to")
+    parser.add_argument("--baseline", dest="baseline",
+                        help="JSON file from an earlier run to compare against")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=10,
+                        help="percent worse than the baseline that counts as a regression")
+
+    return parser.parse_args()
+
+class Rig:
+    """Rig -- pqserver, pqclients, pqsim and the catch URL, on local ports
+
+    Ports are allocated from base: pqclient port, CAD port, catch URL,
+    ProQA Med, Fire and Police, then one metrics port for each pqserver
+    worker, as worker n serves its metrics on the metrics port plus n.
+    pqclients run in a scratch directory so their spool files don't land
+    in the tree.
+    """
+
+    def __init__(self, options):
+        base = options.baseport
+        self.clientport = base
+        self.cadport = base + 1
+        self.catchport = base + 2
+        self.proqaports = (base + 3, base + 4, base + 5)
+        self.metricsports = tuple(base + 6 + n for n in range(options.workers))
+        self.operators = options.operators
+        self.logdir = options.logdir
+        self.workdir = tempfile.TemporaryDirectory(prefix="e2ebench-")
+        self.processes = []
+        self.catch = None
+
+        if self.logdir:
+            os.makedirs(self.logdir, exist_ok=True)
+
+        try:
+            self.start(options)
+        except Exception:
+            self.stop()
+            raise
+
+    def spawn(self, name, args):
+        """spawn() -- Start one Python process, with its output logged or discarded
+
+        Params:
+        name -- name for its log file
+        args -- script and arguments
+
+        Throws:
+        OSError if it can't be started
+
+        Returns:
+        None
+        """
+
+        output = subprocess.DEVNULL
+        if self.logdir:
+            output = open(os.path.join(self.logdir, f"{name}.log"), "w")
+        self.processes.append(subprocess.Popen([sys.executable] + args, cwd=self.workdir.name,
+                                               stdout=output, stderr=subprocess.STDOUT))
+
+    def start(self, options):
+        """start() -- Start every process and wait for all operators to register
+
+        Params:
+        options -- command-line options
+
+        Throws:
+        RuntimeError if something doesn't come up
+
+        Returns:
+        None
+        """
+
+        med, fire, police = self.proqaports
+        self.catch = startcatchserver(self.catchport, keep=True)
+
+        self.spawn("pqsim", [pqsim, "--quiet", "--stamp", "--medport", str(med),
+                             "--firport", str(fire), "--polport", str(police)])
+        self.spawn("pqserver", [pqserver, "--cad-port", str(self.cadport),
+                                "--clientport", str(self.clientport),
+                                "--metrics-port", str(self.metricsports[0]),
+                                "--workers", str(len(self.metricsports)),
+                                "--max-operators", str(self.operators)] + options.serverargs)
+        for port in self.proqaports + (self.cadport,) + self.metricsports:
+            waitforport(port)
+
+        catchurl = f"http://localhost:{self.catchport}/i/pqcatchlog.php"
+        for op in range(1, self.operators + 1):
+            self.spawn(f"pqclient-{op}", [pqclient, "-o", str(op), "-u", catchurl,
+                                          "--serverhost", "localhost",
+                                          "--serverport", str(self.clientport),
+                                          "--medport", str(med), "--firport", str(fire),
+                                          "--polport", str(police)] + options.clientargs)
+
+        # pqserver counts its operators; wait for every pqclient to register
+        deadline = time.monotonic() + 10 + self.operators / 10
+        while self.metric("pqserver_operators") < self.operators:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Only {self.metric('pqserver_operators'):.0f} of "
+                                   f"{self.operators} pqclients registered")
+            time.sleep(0.1)
+
+        # And give them a moment to connect to ProQA
+        time.sleep(1)
+
+    def metric(self, name):
+        """metric() -- Read one unlabelled metric from pqserver, summed over its workers
+
+        Params:
+        name -- metric name
+
+        Throws:
+        None
+
+        Returns:
+        Its total; a worker that can't be reached counts as 0
+        """
+
+        total = 0
+        for port in self.metricsports:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics",
+                                            timeout=5) as response:
+                    text = response.read().decode('utf-8')
+            except OSError:
+                continue
+            match = re.search(rf"^{name} (\S+)$", text, re.M)
+            total += float(match.group(1)) if match else 0
+        return total
+
+    def stop(self):
+        """stop() -- Stop every process and the catch URL
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        self.processes = []
+        if self.catch:
+            self.catch.shutdown()
+            self.catch = None
+        self.workdir.cleanup()
+
+def picker(options):
+    """picker() -- Make a function that picks the operator for each CAD message
+
+    Params:
+    options -- command-line options
+
+    Throws:
+    None
+
+    Returns:
+    Function returning an operator ID from 1 to options.operators
+    """
+
+    operators = range(1, options.operators + 1)
+    if options.stations == "uniform":
+        return lambda: random.choice(operators)
+    weights = [1 / n ** options.zipfexponent for n in operators]
+    return lambda: random.choices(operators, weights)[0]
+
+def generate(options, rig):
+    """generate() -- Send CAD messages at a steady rate until the time is up
+
+    Params:
+    options -- command-line options
+    rig -- running Rig to send to
+
+    Throws:
+    None
+
+    Returns:
+    (seconds spent sending, dictionary of sequence number -> (send
+    time, seconds to answer, reply))
+    """
+
+    send = cadstreamsend if options.persistent else cadsend
+    pick = picker(options)
+
+    def sendone(seq, op, group):
+        sent = time.time()
+        body = f"bench {seq} {sent:.6f} ".ljust(options.payload, "x")
+        monotonic, seconds, reply = send(rig.cadport, op, body, group)
+        return seq, (sent, seconds, reply)
+
+    futures = []
+    interval = 1 / options.rate
+    with ThreadPoolExecutor(options.concurrency) as pool:
+        began = time.monotonic()
+        nextsend = began
+        seq = 0
+        while nextsend < began + options.duration:
+            seq += 1
+            futures.append(pool.submit(sendone, seq, pick(), random.choice(options.groups)))
+            nextsend += interval
+            time.sleep(max(0, nextsend - time.monotonic()))
+    elapsed = time.monotonic() - began
+
+    return elapsed, dict(future.result() for future in futures)
+
+def collect(rig, expected, drain):
+    """collect() -- Wait for posts to reach the catch URL and pull out their timestamps
+
+    Params:
+    rig -- running Rig
+    expected -- number of messages ProQA should have passed on
+    drain -- most seconds to wait for them
+
+    Throws:
+    None
+
+    Returns:
+    Dictionary of sequence number -> (ProQA arrival time, catch arrival time)
+    """
+
+    stats = rig.catch.stats
+    deadline = time.monotonic() + drain
+    while time.monotonic() < deadline:
+        with stats.lock:
+            caught = sum(msg.count("bench ") for msg in stats.received)
+        if caught >= expected:
+            break
+        time.sleep(0.2)
+
+    # Each kept message is one answer from pqsim, with its ProQA timestamp
+    stamps = {}
+    with stats.lock:
+        for msg, arrived in zip(stats.received, stats.arrived):
+            proqa = re.search(r"From \d+ at ([\d.]+):", msg)
+            for seq, sent in re.findall(r"bench (\d+) ([\d.]+)", msg):
+                stamps[int(seq)] = (float(proqa.group(1)) if proqa else None, arrived)
+    return stamps
+
+def summarize(options, elapsed, sent, stamps):
+    """summarize() -- Work out throughput and latency for each hop
+
+    Params:
+    options -- command-line options
+    elapsed -- seconds spent sending
+    sent -- dictionary from generate()
+    stamps -- dictionary from collect()
+
+    Throws:
+    None
+
+    Returns:
+    Results dictionary, as written to JSON
+    """
+
+    samples = {hop: [] for hop in hops}
+    replies = {}
+    for seq, (start, seconds, reply) in sent.items():
+        replies[reply] = replies.get(reply, 0) + 1
+        samples["cad_ack"].append(seconds)
+        if seq in stamps:
+            proqa, caught = stamps[seq]
+            samples["cad_to_catch"].append(caught - start)
+            if proqa is not None:
+                samples["cad_to_proqa"].append(proqa - start)
+                samples["proqa_to_catch"].append(caught - proqa)
+
+    ok = replies.get("OK", 0)
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {name: value for name, value in vars(options).items()
+                    if name not in ("output", "baseline", "logdir")},
+        "sent": len(sent),
+        "replies": replies,
+        "caught": len(stamps),
+        "lost": ok - len([seq for seq in stamps if sent.get(seq, (0, 0, ""))[2] == "OK"]),
+        "throughput": {
+            "sent_per_s": len(sent) / elapsed,
+            "acked_per_s": ok / elapsed,
+            "caught_per_s": len(stamps) / elapsed,
+        },
+        "hops": {},
+    }
+    for hop in hops:
+        latencies = [seconds * 1000 for seconds in samples[hop]]
+        results["hops"][hop] = {
+            "count": len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": max(latencies, default=0),
+        }
+    return results
+
+def commit():
+    """commit() -- Identify the code under test
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    Output of git describe for the tree, or None outside a git checkout
+    """
+
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=here,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """compare() -- Print how a run differs from a baseline run
+
+    Params:
+    results -- results dictionary for this run
+    baseline -- results dictionary from an earlier run
+    tolerance -- percent worse that counts as a regression
+
+    Throws:
+    None
+
+    Returns:
+    List of regressions found, as strings
+    """
+
+    regressions = []
+    print(f"Compared with {baseline.get('commit')} from {baseline.get('timestamp')}:")
+    for name, value in results["options"].items():
+        if baseline.get("options", {}).get(name, value) != value:
+            print(f"  (baseline ran with {name} {baseline['options'][name]}, this run {value})")
+
+    def check(name, now, before, higherisbetter):
+        if not before:
+            return
+        change = (now - before) / before * 100
+        worse = -change if higherisbetter else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        print(f"  {name:<24} {before:>10.2f} -> {now:>10.2f} {change:>+7.1f}%{flag}")
+        if flag:
+            regressions.append(name)
+
+    check("caught/s", results["throughput"]["caught_per_s"],
+          baseline["throughput"]["caught_per_s"], True)
+    for hop in hops:
+        if hop in baseline["hops"]:
+            check(f"{hop} p50 ms", results["hops"][hop]["p50_ms"], baseline["hops"][hop]["p50_ms"], False)
+            check(f"{hop} p99 ms", results["hops"][hop]["p99_ms"], baseline["hops"][hop]["p99_ms"], False)
+    return regressions
+
+if __name__ == "__main__":
+    options = parsecmdline()
+    raisefdlimit()
+
+    if not options.groups or set(options.groups) - set("mfp"):
+        sys.exit("--groups may only contain m, f and p")
+
+    rig = Rig(options)
+    try:
+        print(f"{options.operators} pqclients, {options.rate:g} msgs/s for {options.duration:g}s, "
+              f"{options.payload} byte bodies, {options.stations} stations")
+        elapsed, sent = generate(options, rig)
+        ok = len([reply for start, seconds, reply in sent.values() if reply == "OK"])
+        stamps = collect(rig, ok, options.drain)
+    finally:
+        rig.stop()
+
+    results = summarize(options, elapsed, sent, stamps)
+
+    print(f"sent {results['sent']}, replies {results['replies']}, "
+          f"caught {results['caught']}, lost {results['lost']}")
+    print(f"{'hop':<16} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for hop, stats in results["hops"].items():
+        print(f"{hop:<16} {stats['count']:>6} {stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+              f"{stats['max_ms']:>8.2f}")
+    print("throughput " + ", ".join(f"{name} {rate:.1f}" for name, rate in results["throughput"].items()))
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {options.output}")
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            sys.exit(1)
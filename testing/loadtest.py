@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# loadtest - per-message latency through pqserver with hundreds of operators
+#
+#   python3 testing/loadtest.py --operators 500 --rate 200 --duration 10
+#
+# Starts pqserver on spare ports, connects a fleet of simulated pqclients
+# from one event loop, then sends CAD messages to random operators at a
+# steady rate and prints latency for each second of the run so any drift
+# as the fleet grows is easy to spot.  With --persistent, each sending
+# thread keeps one CAD/2 stream open instead of connecting per message.
+
+import socket
+import selectors
+import subprocess
+import threading
+import argparse
+import random
+import time
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ackbench import waitforport, percentile
+
+eomstring = "</comm>"
+
+pqserver = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pqserver.py")
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Load test pqserver with many connected pqclients"
+        )
+
+    parser.add_argument("--operators", dest="operators", type=int, default=500,
+                        help="number of simulated pqclients")
+    parser.add_argument("--rate", dest="rate", type=float, default=200,
+                        help="CAD messages per second")
+    parser.add_argument("--duration", dest="duration", type=float, default=10,
+                        help="seconds to send CAD messages for")
+    parser.add_argument("--concurrency", dest="concurrency", type=int, default=16,
+                        help="CAD connections allowed in flight at once")
+    parser.add_argument("--payload", dest="payload", type=int, default=2048,
+                        help="bytes of message body per CAD message")
+    parser.add_argument("--cad-port", dest="cadport", type=int, default=16001,
+                        help="CAD port for the pqserver under test")
+    parser.add_argument("--clientport", dest="clientport", type=int, default=16000,
+                        help="pqclient port for the pqserver under test")
+    parser.add_argument("--server-arg", dest="serverargs", action="append", default=[],
+                        help="extra argument to pass to pqserver (repeatable)")
+    parser.add_argument("--persistent", dest="persistent", action="store_true",
+                        help="send over long-lived CAD/2 streams, one per sending thread")
+
+    return parser.parse_args()
+
+def raisefdlimit():
+    """raisefdlimit() -- Allow this process as many sockets as the system permits
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+class Fleet:
+    """Fleet -- Simulated pqclients served from a single event loop
+
+    Every operator acknowledges each complete message as soon as it
+    arrives, so measured latency is pqserver's and not the simulator's.
+    """
+
+    def __init__(self, port, count):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.running = True
+
+        for n in range(1, count + 1):
+            conn = socket.create_connection(("localhost", port))
+            conn.sendall(str(n).encode('utf-8'))
+            reply = conn.recv(32)
+            if reply.rstrip() != b"OK":
+                raise RuntimeError(f"Operator {n} was refused: {reply}")
+            conn.setblocking(False)
+            self.buffers[conn] = b""
+            self.selector.register(conn, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """run() -- Acknowledge messages until stopped
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        eom = eomstring.encode('utf-8')
+        while self.running:
+            for key, mask in self.selector.select(0.5):
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    self.selector.unregister(conn)
+                    continue
+                buffer = self.buffers[conn] + data
+                acks = buffer.count(eom)
+                if acks:
+                    buffer = buffer[buffer.rindex(eom) + len(eom):]
+                    conn.sendall(b"OK\n" * acks)
+                self.buffers[conn] = buffer
+
+    def stop(self):
+        """stop() -- Stop the event loop and close every operator
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.running = False
+        self.thread.join()
+        for conn in self.buffers:
+            conn.close()
+
+def cadsend(port, op, body, group="m"):
+    """cadsend() -- Send one CAD message and time the reply
+
+    Params:
+    port -- pqserver's CAD port
+    op -- operator ID to address
+    body -- message body to send
+    group -- ProQA group ID the message is for
+
+    Throws:
+    None
+
+    Returns:
+    (send time, seconds, reply) tuple
+    """
+
+    sent = time.monotonic()
+    start = time.perf_counter()
+    try:
+        conn = socket.create_connection(("localhost", port))
+        conn.sendall(f"{op}\n{group}{body}{eomstring}".encode('utf-8'))
+        reply = conn.recv(32).decode('utf-8').rstrip()
+        conn.close()
+    except OSError as e:
+        reply = f"error: {e}"
+    return (sent, time.perf_counter() - start, reply)
+
+streams = threading.local()
+
+def cadstreamsend(port, op, body, group="m"):
+    """cadstreamsend() -- Send one CAD message on this thread's CAD/2 stream and time the answer
+
+    Params:
+    port -- pqserver's CAD port
+    op -- operator ID to address
+    body -- message body to send
+    group -- ProQA group ID the message is for
+
+    Throws:
+    None
+
+    Returns:
+    (send time, seconds, reply) tuple
+    """
+
+    sent = time.monotonic()
+    start = time.perf_counter()
+    try:
+        if not hasattr(streams, "conn"):
+            conn = socket.create_connection(("localhost", port))
+            conn.sendall(b"CAD/2\n")
+            streams.reader = conn.makefile("rb")
+            if streams.reader.readline() != b"OK CAD/2\n":
+                raise OSError("pqserver doesn't take CAD/2 streams")
+            streams.conn = conn
+        streams.conn.sendall(f"{op}\n{group}{body}{eomstring}".encode('utf-8'))
+        corrid, sep, reply = streams.reader.readline().decode('utf-8').rstrip().partition(" ")
+    except OSError as e:
+        reply = f"error: {e}"
+        if hasattr(streams, "conn"):
+            streams.conn.close()
+            del streams.conn
+    return (sent, time.perf_counter() - start, reply)
+
+if __name__ == "__main__":
+    options = parsecmdline()
+    raisefdlimit()
+
+    server = subprocess.Popen([sys.executable, pqserver,
+                               "--cad-port", str(options.cadport),
+                               "--clientport", str(options.clientport),
+                               "--max-operators", str(options.operators)] + options.serverargs,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    fleet = None
+    try:
+        waitforport(options.cadport)
+
+        start = time.perf_counter()
+        fleet = Fleet(options.clientport, options.operators)
+        print(f"Connected {options.operators} operators in {time.perf_counter() - start:.2f}s")
+
+        body = "x" * options.payload
+        send = cadstreamsend if options.persistent else cadsend
+        interval = 1 / options.rate
+        futures = []
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            began = time.monotonic()
+            next_send = began
+            while next_send < began + options.duration:
+                op = random.randint(1, options.operators)
+                futures.append(pool.submit(send, options.cadport, op, body))
+                next_send += interval
+                time.sleep(max(0, next_send - time.monotonic()))
+
+        results = [f.result() for f in futures]
+
+        print(f"{len(results)} messages at {options.rate:g}/s, {options.payload} byte bodies")
+        print(f"{'second':>6} {'msgs':>6} {'fail':>5} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for second in range(int(options.duration + 0.999)):
+            window = [r for r in results if second <= r[0] - began < second + 1]
+            latencies = [r[1] * 1000 for r in window]
+            failures = len([r for r in window if r[2] != "OK"])
+            print(f"{second:>6} {len(window):>6} {failures:>5} {percentile(latencies, 50):>8.2f} "
+                  f"{percentile(latencies, 99):>8.2f} {max(latencies, default=0):>8.2f}")
+
+        latencies = [r[1] * 1000 for r in results]
+        print(f"{'total':>6} {len(results):>6} {len([r for r in results if r[2] != 'OK']):>5} "
+              f"{percentile(latencies, 50):>8.2f} {percentile(latencies, 99):>8.2f} "
+              f"{max(latencies, default=0):>8.2f}")
+
+    finally:
+        if fleet:
+            fleet.stop()
+        server.terminate()
+        server.wait()
@@ -1,97 +1,473 @@
 #!/usr/bin/env python3
 
-# pqsim51  - simulate proqa medical on localhost port 5100
+# pqsim - simulate ProQA Med, Fire and Police for one or many workstations
+#
+#   python3 testing/pqsim.py
+#   python3 testing/pqsim.py --instances 300 --medport 20000 --firport 21000 --polport 22000 \
+#       --delay lognormal:50,0.5 --burst-interval 30 --disconnect-interval 600 --quiet
+#
+# Listens as ProQA Med, Fire and Police on localhost, 5100, 5200 and 5300
+# by default, and answers every message a pqclient sends with
+#
+#   From <port>: <message></comm>
+#
+# as one frame; the old pqsim echoed the message's own terminator too,
+# which pqclient then posted as a second, empty message.  Everything runs
+# on one asyncio loop, so one process can stand in for hundreds of
+# workstations' ProQA: instance n listens on each port plus n.  Several
+# things real ProQA does can be switched on:
+#
+#   --delay          answer after a delay drawn from a distribution
+#   --response-size  pad each answer out to a size drawn from a distribution
+#   --burst-interval send unsolicited bursts of --burst-size messages
+#   --disconnect-rate / --disconnect-interval
+#                    hang up on a message, or at random times
+#
+# Distributions are written as fixed:N, uniform:LOW,HIGH, exp:MEAN or
+# lognormal:MEDIAN,SIGMA, or just N for fixed.  Delays and intervals are
+# in milliseconds and seconds as their options say; answers on one
+# connection always go out in the order their messages arrived.
 
-import socket
-import select
+import asyncio
+import argparse
+import random
+import math
+import time
 import sys
 
 eomstring = "</comm>"
+eombytes = eomstring.encode('utf-8')
 
-connections = []
-sock51 = None
-sock52 = None
-sock53 = None
-
-try:
-    sock51 = socket.create_server(('localhost', 5100), backlog=3)
-    connections.append(sock51)
-    print("Socket created, bound and listening on localhost port 5100")
-
-    sock52 = socket.create_server(('localhost', 5200), backlog=3)
-    connections.append(sock52)
-    print("Socket created, bound and listening on localhost port 5200")
-
-    sock53 = socket.create_server(('localhost', 5300), backlog=3)
-    connections.append(sock53)
-    print("Socket created, bound and listening on localhost port 5300")
-
-    # Wait for a connection
-    while True:
-        rlist = select.select(connections, [], [],0.5)[0]  # only get readable sockets, not writable or error
-
-        for c in connections:
-            if c in rlist:
-                #print(c)
-
-                if c == sock51 or c == sock52 or c == sock53:
-                    con, client_address = c.accept()
-                    connections.append(con)
-
-                    if c == sock51:
-                        print(f"connection on 5100 from {client_address}", file=sys.stderr)
-                    elif c == sock52:
-                        print(f"connection on 5200 from {client_address}", file=sys.stderr)
-                    elif c == sock53:
-                        print(f"connection on 5300 from {client_address}", file=sys.stderr)
-
-                # Data on an active connection
-                else:
-                    print(f"Receiving message from client on {c.getsockname()[1]}")
-                    fulldata=""
-
-                    # Receive the data in small chunks and retransmit it
-                    while True:
-                        data = c.recv(16)  # Receive data in chunks of 16 bytes
-
-                        if data:
-                            print(f"received chunk from client on {c.getsockname()[1]}: {data}", file=sys.stderr)
-                            fulldata += data.decode('utf-8')  # Accumulate the received data
-
-                            if eomstring in fulldata:
-                                print("End of Msg received.")
-
-                                if fulldata:
-                                    print(f"Complete message client on {c.getsockname()[1]}: {fulldata}", file=sys.stderr)
-
-                                sendresponse=f"From {c.getsockname()[1]}: {fulldata}{eomstring}".encode('utf-8')
-                                fulldata=""
-
-                                try:
-                                    c.sendall(sendresponse)  
-                                except OSError as e:
-                                    print(f"Error sending response to client on {c.getsockname()[1]}: {e}")
-                                
-                                break  # Exit the loop
-
-
-                        else:
-                            print(f"Connection to client on {c.getsockname()[1]} closed by client")
-                            c.close()
-                            connections.remove(c)
-                            break
-
-except KeyboardInterrupt:
-    print("Received interrupt signal, exiting")
-
-except OSError as e:
-    print(f"Exception: {e}")
-
-finally:
-    # Clean up the connection
-    for c in connections:
-        if c:
-            c.close()
-    print("Connections closed")
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(description="Simulate ProQA Med, Fire and Police")
+
+    parser.add_argument("--read-size", dest="readsize", type=int, default=65536,
+                        help="bytes to request on each socket read")
+    parser.add_argument("--medport", dest="medport", type=int, default=5100,
+                        help="port to listen on as ProQA Med")
+    parser.add_argument("--firport", dest="firport", type=int, default=5200,
+                        help="port to listen on as ProQA Fire")
+    parser.add_argument("--polport", dest="polport", type=int, default=5300,
+                        help="port to listen on as ProQA Police")
+    parser.add_argument("--instances", dest="instances", type=int, default=1,
+                        help="workstations to simulate; instance n listens on each port plus n")
+    parser.add_argument("--delay", dest="delay", type=distribution, default=distribution("0"),
+                        help="milliseconds before answering each message, as a distribution")
+    parser.add_argument("--response-size", dest="responsesize", type=distribution,
+                        help="bytes to pad each answer out to, as a distribution")
+    parser.add_argument("--burst-interval", dest="burstinterval", type=float, default=0,
+                        help="mean seconds between unsolicited bursts on each connection, 0 for none")
+    parser.add_argument("--burst-size", dest="burstsize", type=distribution, default=distribution("3"),
+                        help="messages in each unsolicited burst, as a distribution")
+    parser.add_argument("--disconnect-rate", dest="disconnectrate", type=float, default=0,
+                        help="chance, from 0 to 1, of hanging up instead of answering a message")
+    parser.add_argument("--disconnect-interval", dest="disconnectinterval", type=float, default=0,
+                        help="mean seconds between random hang-ups on each connection, 0 for none")
+    parser.add_argument("--stamp", dest="stamp", action="store_true",
+                        help="put the time each message arrived in its response, for benchmarks")
+    parser.add_argument("--quiet", dest="quiet", action="store_true",
+                        help="only report connections, not every chunk and message")
+    parser.add_argument("--stats-interval", dest="statsinterval", type=float, default=0,
+                        help="seconds between printing totals, 0 for only at exit")
+
+    options = parser.parse_args()
+
+    # Instances must not run into the next application's ports
+    ports = sorted((options.medport, options.firport, options.polport))
+    if options.instances < 1 or ports[1] - ports[0] < options.instances or ports[2] - ports[1] < options.instances:
+        parser.error(f"{options.instances} instances need the Med, Fire and Police ports "
+                     "at least that far apart")
+
+    return options
+
+def distribution(spec):
+    """distribution() -- Parse a distribution given on the command line
+
+    Params:
+    spec -- fixed:N, uniform:LOW,HIGH, exp:MEAN, lognormal:MEDIAN,SIGMA or N
+
+    Throws:
+    argparse.ArgumentTypeError if spec can't be understood
+
+    Returns:
+    Function returning a new non-negative sample on each call
+    """
+
+    kind, sep, args = spec.partition(":")
+    if not sep:
+        kind, args = "fixed", spec
+    try:
+        values = [float(value) for value in args.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"can't read numbers in {spec}")
+
+    if kind == "fixed" and len(values) == 1:
+        return lambda: max(0.0, values[0])
+    if kind == "uniform" and len(values) == 2:
+        return lambda: max(0.0, random.uniform(*values))
+    if kind == "exp" and len(values) == 1:
+        return lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    raise argparse.ArgumentTypeError(f"unknown distribution {spec}")
+
+class Totals:
+    """Totals -- Counters for the whole simulator"""
+
+    def __init__(self):
+        self.connections = 0
+        self.open = 0
+        self.received = 0
+        self.answered = 0
+        self.unsolicited = 0
+        self.disconnects = 0
+
+    def __str__(self):
+        return (f"{self.open} open of {self.connections} connections, {self.received} messages "
+                f"received, {self.answered} answered, {self.unsolicited} unsolicited, "
+                f"{self.disconnects} injected disconnects")
+
+class ProQAConnection:
+    """ProQAConnection -- One pqclient connected to one simulated ProQA application
+
+    Messages are split out of whatever arrives as soon as their
+    terminator is seen, and each gets its own answer, scheduled for its
+    arrival plus a delay but never ahead of the answer before it.
+    """
+
+    def __init__(self, sim, port, reader, writer):
+        self.sim = sim
+        self.options = sim.options
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+        self.lastanswer = 0  # Loop time the latest scheduled answer goes out
+        self.timers = set()
+        self.closed = False
+
+    def later(self, delay, callback, *args):
+        """later() -- Run a callback after a delay unless the connection closes first
+
+        Params:
+        delay -- seconds to wait
+        callback -- function to call
+        args -- its arguments
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        def fire():
+            self.timers.discard(timer)
+            callback(*args)
+
+        timer = asyncio.get_running_loop().call_later(delay, fire)
+        self.timers.add(timer)
+
+    def send(self, data):
+        """send() -- Write to the pqclient if the connection is still open
+
+        Params:
+        data -- bytes to write
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if not self.closed:
+            self.writer.write(data)
+
+    def pad(self, text):
+        """pad() -- Pad an answer out to a size drawn from --response-size
+
+        Params:
+        text -- answer without its terminator
+
+        Throws:
+        None
+
+        Returns:
+        Answer as bytes, with its terminator
+        """
+
+        data = text.encode('utf-8')
+        if self.options.responsesize:
+            size = int(self.options.responsesize()) - len(eombytes)
+            if size > len(data):
+                data += b" " * (size - len(data))
+        return data + eombytes
+
+    def answer(self, message, arrived):
+        """answer() -- Schedule the answer to one message
+
+        Params:
+        message -- the message, without its terminator, as text
+        arrived -- time.time() it arrived
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.sim.totals.received += 1
+        if not self.options.quiet:
+            print("End of Msg received.")
+            print(f"Complete message client on {self.port}: {message}", file=sys.stderr)
+
+        if self.options.disconnectrate and random.random() < self.options.disconnectrate:
+            self.disconnect("on a message")
+            return
+
+        source = f"{self.port} at {arrived:.6f}" if self.options.stamp else self.port
+        response = self.pad(f"From {source}: {message}")
+
+        loop = asyncio.get_running_loop()
+        when = max(loop.time() + self.options.delay() / 1000, self.lastanswer)
+        self.lastanswer = when
+        self.later(when - loop.time(), self.answered, response)
+
+    def answered(self, response):
+        """answered() -- Send an answer whose delay is up
+
+        Params:
+        response -- bytes to send
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.sim.totals.answered += 1
+        self.send(response)
 
-sys.exit(0)
+    def burst(self):
+        """burst() -- Send unsolicited messages and schedule the next burst
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        for n in range(int(self.options.burstsize())):
+            self.sim.totals.unsolicited += 1
+            self.send(self.pad(f"From {self.port}: unsolicited {n + 1} at {time.time():.6f}"))
+        self.later(random.expovariate(1 / self.options.burstinterval), self.burst)
+
+    def disconnect(self, why):
+        """disconnect() -- Hang up on the pqclient as if ProQA had gone away
+
+        Params:
+        why -- what triggered it, for the log
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.closed:
+            return
+        self.sim.totals.disconnects += 1
+        print(f"Disconnecting client on {self.port} {why}")
+        self.close()
+
+    def close(self):
+        """close() -- Close the connection and cancel anything still scheduled
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        self.writer.close()
+
+    async def run(self):
+        """run() -- Answer the pqclient's messages until one side hangs up
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        if self.options.burstinterval:
+            self.later(random.expovariate(1 / self.options.burstinterval), self.burst)
+        if self.options.disconnectinterval:
+            self.later(random.expovariate(1 / self.options.disconnectinterval),
+                       self.disconnect, "at random")
+
+        try:
+            while not self.closed:
+                try:
+                    data = await self.reader.read(self.options.readsize)
+                except OSError:
+                    data = b""
+
+                if not data:
+                    if not self.closed:
+                        print(f"Connection to client on {self.port} closed by client")
+                    return
+
+                if not self.options.quiet:
+                    print(f"received chunk from client on {self.port}: {data}", file=sys.stderr)
+
+                arrived = time.time()
+                self.buffer += data
+                start = 0
+                while not self.closed:
+                    end = self.buffer.find(eombytes, start)
+                    if end < 0:
+                        break
+                    self.answer(self.buffer[start:end].decode('utf-8', errors='replace'), arrived)
+                    start = end + len(eombytes)
+                del self.buffer[:start]
+
+                # Don't read more than the pqclient can take answers for
+                if not self.closed:
+                    await self.writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self.close()
+            self.sim.totals.open -= 1
+
+class Simulator:
+    """Simulator -- Every simulated ProQA listener and its connections"""
+
+    def __init__(self, options):
+        self.options = options
+        self.totals = Totals()
+        self.servers = []
+
+    async def start(self):
+        """start() -- Listen on every instance's ports
+
+        Params:
+        None
+
+        Throws:
+        OSError if a port can't be bound
+
+        Returns:
+        None
+        """
+
+        for instance in range(self.options.instances):
+            for base in (self.options.medport, self.options.firport, self.options.polport):
+                port = base + instance
+                server = await asyncio.start_server(
+                    lambda reader, writer, port=port: self.connection(port, reader, writer),
+                    "localhost", port, backlog=3)
+                self.servers.append(server)
+                if self.options.instances == 1:
+                    print(f"Socket created, bound and listening on localhost port {port}")
+
+        if self.options.instances > 1:
+            print(f"Listening as {self.options.instances} ProQA instances from ports "
+                  f"{self.options.medport}, {self.options.firport} and {self.options.polport}")
+
+    async def connection(self, port, reader, writer):
+        """connection() -- Serve one pqclient connection
+
+        Params:
+        port -- port it connected to
+        reader -- asyncio.StreamReader for the connection
+        writer -- asyncio.StreamWriter for the connection
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        self.totals.connections += 1
+        self.totals.open += 1
+        print(f"connection on {port} from {writer.get_extra_info('peername')}", file=sys.stderr)
+        await ProQAConnection(self, port, reader, writer).run()
+
+    async def run(self):
+        """run() -- Serve until cancelled, printing totals as asked
+
+        Params:
+        None
+
+        Throws:
+        OSError if a port can't be bound
+
+        Returns:
+        None
+        """
+
+        await self.start()
+        try:
+            while True:
+                await asyncio.sleep(self.options.statsinterval or 3600)
+                if self.options.statsinterval:
+                    print(f"Totals: {self.totals}")
+        finally:
+            for server in self.servers:
+                server.close()
+            print(f"Totals: {self.totals}")
+
+if __name__ == "__main__":
+    options = parsecmdline()
+
+    try:
+        asyncio.run(Simulator(options).run())
+
+    except KeyboardInterrupt:
+        print("Received interrupt signal, exiting")
+
+    except OSError as e:
+        print(f"Exception: {e}")
+        sys.exit(1)
+
+    print("Connections closed")
+    sys.exit(0)
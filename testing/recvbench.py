@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# recvbench - socket reads and CPU per message on the pqsim round trip
+#
+#   python3 testing/recvbench.py --messages 500 --payload 4096
+#
+# Plays pqserver for a real pqclient that is wired to a real pqsim, sends
+# CAD messages through them and compares the read sizes given with
+# --read-size (by default the old 16 bytes against the new 64KB).  Both
+# children run under a launcher that counts socket calls and select
+# wakeups and records their CPU time, so no strace is needed.
+
+import socket
+import select
+import selectors
+import subprocess
+import argparse
+import signal
+import atexit
+import runpy
+import json
+import tempfile
+import time
+import sys
+import os
+
+eomstring = "</comm>"
+
+testing = os.path.dirname(os.path.abspath(__file__))
+pqclient = os.path.join(testing, "..", "pqclient.py")
+pqsim = os.path.join(testing, "pqsim.py")
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Count socket calls and CPU per message for pqclient and pqsim"
+        )
+
+    parser.add_argument("--messages", dest="messages", type=int, default=500,
+                        help="CAD messages to send through pqclient")
+    parser.add_argument("--payload", dest="payload", type=int, default=4096,
+                        help="bytes of message body per CAD message")
+    parser.add_argument("--read-size", dest="readsizes", type=int, action="append",
+                        help="read size to test (repeatable, default 16 and 65536)")
+    parser.add_argument("--serverport", dest="serverport", type=int, default=16000,
+                        help="port to impersonate pqserver on")
+
+    return parser.parse_args()
+
+def counted(outfile, script, args):
+    """counted() -- Run a script while counting its socket calls and CPU time
+
+    A snapshot is written to outfile + ".start" on SIGUSR1 and the final
+    totals to outfile when the script exits.
+
+    Params:
+    outfile -- where to write JSON totals
+    script -- path of the script to run as __main__
+    args -- its command-line arguments
+
+    Throws:
+    None
+
+    Returns:
+    None
+    """
+
+    counts = {"recv": 0, "send": 0, "select": 0}
+
+    class CountingSocket(socket.socket):
+        def recv(self, *args):
+            counts["recv"] += 1
+            return super().recv(*args)
+
+        def recv_into(self, *args):
+            counts["recv"] += 1
+            return super().recv_into(*args)
+
+        def send(self, *args):
+            counts["send"] += 1
+            return super().send(*args)
+
+        def sendall(self, *args):
+            counts["send"] += 1
+            return super().sendall(*args)
+
+    realselect = select.select
+
+    def countingselect(*args):
+        counts["select"] += 1
+        return realselect(*args)
+
+    # asyncio waits in whatever selectors.DefaultSelector is when its loop is made
+    class CountingSelector(selectors.DefaultSelector):
+        def select(self, *args):
+            counts["select"] += 1
+            return super().select(*args)
+
+    socket.socket = CountingSocket
+    select.select = countingselect
+    selectors.DefaultSelector = CountingSelector
+
+    def snapshot(path):
+        times = os.times()
+        with open(path, "w") as f:
+            json.dump(dict(counts, cpu=times.user + times.system), f)
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: snapshot(outfile + ".start"))
+    atexit.register(snapshot, outfile)
+
+    sys.argv = [script] + args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name="__main__")
+
+def launch(outfile, script, args):
+    """launch() -- Start a script under the counting launcher
+
+    Params:
+    outfile -- where the child writes its totals
+    script -- path of the script to run
+    args -- its command-line arguments
+
+    Throws:
+    None
+
+    Returns:
+    subprocess.Popen for the child
+    """
+
+    return subprocess.Popen([sys.executable, __file__, "--counted", outfile, script] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def delta(outfile):
+    """delta() -- Totals a child accumulated between its snapshot and exit
+
+    Params:
+    outfile -- path the child wrote its totals to
+
+    Throws:
+    None
+
+    Returns:
+    Dictionary of counter increases
+    """
+
+    with open(outfile + ".start") as f:
+        start = json.load(f)
+    with open(outfile) as f:
+        end = json.load(f)
+    return {key: end[key] - start[key] for key in end}
+
+def run(options, readsize):
+    """run() -- Send messages through pqclient and pqsim with one read size
+
+    Params:
+    options -- command-line options
+    readsize -- read size to give both children
+
+    Throws:
+    RuntimeError if pqclient doesn't connect or acknowledge
+
+    Returns:
+    Dictionary of per-process counter increases
+    """
+
+    listener = socket.create_server(("localhost", options.serverport))
+    listener.settimeout(10)
+    outdir = tempfile.mkdtemp(prefix="recvbench-")
+
+    sim = launch(f"{outdir}/pqsim.json", pqsim, ["--read-size", str(readsize)])
+    time.sleep(0.5)
+    client = launch(f"{outdir}/pqclient.json", pqclient,
+                    ["-o", "1", "--serverhost", "localhost",
+                     "--serverport", str(options.serverport),
+                     "--read-size", str(readsize), "--protocol", "1",
+                     "-u", "http://127.0.0.1:9/"])
+
+    try:
+        conn, address = listener.accept()
+        conn.recv(32)
+        conn.sendall(b"OK\n")
+        acks = conn.makefile("rb")
+
+        # Let both children finish starting up before counting
+        time.sleep(1)
+        sim.send_signal(signal.SIGUSR1)
+        client.send_signal(signal.SIGUSR1)
+        time.sleep(0.2)
+
+        body = ("x" * options.payload).encode('utf-8')
+        for n in range(options.messages):
+            conn.sendall(b"m" + body + eomstring.encode('utf-8'))
+
+            # pqclient may report a ProQA link going up or down in between
+            ack = acks.readline()
+            while ack.startswith(b"LINK "):
+                ack = acks.readline()
+            if ack != b"OK\n":
+                raise RuntimeError("pqclient didn't acknowledge message")
+
+        # Give pqclient time to collect pqsim's echoes
+        time.sleep(1)
+
+    finally:
+        client.send_signal(signal.SIGINT)
+        client.wait()
+        sim.send_signal(signal.SIGINT)
+        sim.wait()
+        listener.close()
+
+    return {"pqclient": delta(f"{outdir}/pqclient.json"),
+            "pqsim": delta(f"{outdir}/pqsim.json")}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == "--counted":
+        counted(sys.argv[2], sys.argv[3], sys.argv[4:])
+        sys.exit(0)
+
+    options = parsecmdline()
+    readsizes = options.readsizes or [16, 65536]
+
+    print(f"{options.messages} messages of {options.payload} bytes, per message:")
+    print(f"{'read size':>9} {'process':>9} {'recv':>8} {'send':>8} {'select':>8} {'CPU ms':>8}")
+    for readsize in readsizes:
+        results = run(options, readsize)
+        for name, counts in results.items():
+            print(f"{readsize:>9} {name:>9} "
+                  f"{counts['recv'] / options.messages:>8.1f} "
+                  f"{counts['send'] / options.messages:>8.1f} "
+                  f"{counts['select'] / options.messages:>8.1f} "
+                  f"{counts['cpu'] * 1000 / options.messages:>8.3f}")
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# relaybench - CPU and memory churn per message on pqserver's CAD->operator path
+#
+#   python3 testing/relaybench.py --messages 2000 --payload 1024 --payload 65536
+#
+# Loads pqserver as a module and runs a PQServer on its own event loop
+# in a thread, then drives it from this one in rounds: --inflight CAD
+# connections each send a message, a pretend pqclient reads them all and
+# acks, and CAD reads the answers.  Only the CPU time of the server's
+# thread is counted, event loop included.  tracemalloc measures how far
+# memory peaks above its resting level during each round, with every
+# message of the round inside pqserver at once, so per-message buffers
+# add up instead of hiding under asyncio's fixed 256KB read allocation.
+# The median round after warming up is divided by --inflight, and the
+# same figure for messages with empty bodies is subtracted, so what is
+# left, divided by the payload, is how many copies of each message
+# pqserver keeps while it is in flight.  This script reads into a
+# buffer it allocates up front so its own memory stays flat.
+#
+# --server points at another pqserver.py (with its own pqframe.py next to
+# it) so a change can be compared with the version before it, as long as
+# that one has PQServer too.
+
+import importlib.util
+import asyncio
+import threading
+import tracemalloc
+import gc
+import argparse
+import socket
+import time
+import sys
+import os
+
+eomstring = "</comm>"
+
+testing = os.path.dirname(os.path.abspath(__file__))
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Measure CPU and copies per message relayed by pqserver"
+        )
+
+    parser.add_argument("--messages", dest="messages", type=int, default=2000,
+                        help="CAD messages to relay for each payload size")
+    parser.add_argument("--warmup", dest="warmup", type=int, default=200,
+                        help="CAD messages to relay first without measuring")
+    parser.add_argument("--inflight", dest="inflight", type=int, default=16,
+                        help="CAD messages sent in each round before any is acked")
+    parser.add_argument("--payload", dest="payloads", type=int, action="append",
+                        help="bytes of message body (repeatable, default 1024 and 65536)")
+    parser.add_argument("--protocol", dest="protocol", type=int, choices=[1, 2], default=1,
+                        help="protocol the pretend pqclient registers with")
+    parser.add_argument("--server", dest="server",
+                        default=os.path.join(testing, "..", "pqserver.py"),
+                        help="pqserver.py to load")
+
+    return parser.parse_args()
+
+def loadserver(path, inflight):
+    """loadserver() -- Import pqserver from a file and start a PQServer on a thread
+
+    Params:
+    path -- path to pqserver.py
+    inflight -- messages the server must let an operator have unacked
+
+    Throws:
+    Whatever importing or starting it throws
+
+    Returns:
+    Bench holding the running server
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    sys.path.insert(0, directory)
+    sys.modules.pop("pqframe", None)
+    spec = importlib.util.spec_from_file_location("pqserver", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.path.remove(directory)
+
+    bench = Bench(module.PQServer(cadhost="localhost", cadport=0,
+                                  clienthost="localhost", clientport=0,
+                                  pipelinedepth=inflight, queuehighwater=inflight))
+    bench.start()
+    return bench
+
+class Bench:
+    """Bench -- A PQServer running on its own event loop in a thread"""
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        """start() -- Start the loop's thread and the server on it
+
+        Params:
+        None
+
+        Throws:
+        Whatever PQServer.start() throws
+
+        Returns:
+        None
+        """
+
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        self.cadaddress = self.server.servers[0].sockets[0].getsockname()
+        self.clientaddress = self.server.servers[1].sockets[0].getsockname()
+
+    def cpu(self):
+        """cpu() -- CPU seconds the server's thread has used so far
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        Seconds of CPU time
+        """
+
+        # time.thread_time() only counts the thread it's called from
+        return asyncio.run_coroutine_threadsafe(threadtime(), self.loop).result()
+
+    def settle(self):
+        """settle() -- Let the server's loop run whatever is already scheduled
+
+        Closing a connection frees its buffers a callback or two later,
+        which would otherwise land in the middle of the next round.
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        for n in range(2):
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), self.loop).result()
+        gc.collect()
+
+    def stop(self):
+        """stop() -- Stop the server and its loop
+
+        Params:
+        None
+
+        Throws:
+        None
+
+        Returns:
+        None
+        """
+
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+async def threadtime():
+    """threadtime() -- CPU time of the thread running the event loop"""
+
+    return time.thread_time()
+
+class Inbox:
+    """Inbox -- Reads replies into a buffer allocated up front"""
+
+    def __init__(self, size):
+        self.inbox = bytearray(size)
+        self.view = memoryview(self.inbox)
+
+    def until(self, sock, size):
+        """until() -- Read exactly size bytes from sock
+
+        Params:
+        sock -- our end of a connection to pqserver
+        size -- bytes to read
+
+        Throws:
+        RuntimeError if pqserver goes quiet or hangs up
+
+        Returns:
+        memoryview of the bytes read, valid until the next call
+        """
+
+        count = 0
+        while count < size:
+            try:
+                n = sock.recv_into(self.view[count:size])
+            except socket.timeout:
+                n = 0
+            if not n:
+                raise RuntimeError(f"pqserver stopped after {count} of {size} bytes")
+            count += n
+        return self.view[:count]
+
+def run(server, options, payload):
+    """run() -- Relay messages of one size and measure pqserver
+
+    Params:
+    server -- Bench running the server
+    options -- command-line options
+    payload -- bytes of message body after the group ID
+
+    Throws:
+    RuntimeError if a message isn't relayed
+
+    Returns:
+    (CPU microseconds per message, peak bytes above rest per message
+    in the median round)
+    """
+
+    inbox = Inbox(payload + 64)
+
+    operator = socket.create_connection(server.clientaddress, timeout=5)
+    operator.sendall(b"PQ/2 1\n" if options.protocol == 2 else b"1")
+    inbox.until(operator, 8 if options.protocol == 2 else 3)
+
+    body = b"m" + b"x" * payload + eomstring.encode('utf-8')
+    request = b"1\n" + body
+    if options.protocol == 2:
+        # The group ID moves into the header
+        expected = 10 + len(body) - 1
+        acks = [bytearray(b"\x00\x00\x00\x00m\x01\x00\x00\x00\x00") for n in range(options.inflight)]
+    else:
+        expected = len(body)
+        acks = [b"OK\n"] * options.inflight
+
+    warmup = -(-options.warmup // options.inflight)
+    rounds = -(-options.messages // options.inflight)
+    peaks = []
+    for n in range(warmup + rounds):
+        if n == warmup:
+            peaks.clear()
+            cpu = server.cpu()
+        cads = [socket.create_connection(server.cadaddress, timeout=5) for ack in acks]
+
+        server.settle()
+        tracemalloc.reset_peak()
+        rest = tracemalloc.get_traced_memory()[0]
+
+        for cad in cads:
+            cad.sendall(request)
+        for ack in acks:
+            sent = inbox.until(operator, expected)
+            if options.protocol == 2:
+                # Answer with an ACK for the message ID in the header
+                ack[:4] = sent[:4]
+        for ack in acks:
+            operator.sendall(ack)
+        for cad in cads:
+            if inbox.until(cad, 3) != b"OK\n":
+                raise RuntimeError("CAD wasn't told OK")
+
+        peaks.append(tracemalloc.get_traced_memory()[1] - rest)
+        for cad in cads:
+            cad.close()
+
+    cpu = server.cpu() - cpu
+    operator.close()
+    time.sleep(0.05)
+
+    peaks.sort()
+    return (cpu * 1e6 / (rounds * options.inflight), peaks[len(peaks) // 2] // options.inflight)
+
+if __name__ == "__main__":
+    options = parsecmdline()
+    server = loadserver(options.server, options.inflight)
+
+    tracemalloc.start()
+
+    print(f"{options.messages} messages through {os.path.relpath(options.server)}, "
+          f"protocol {options.protocol}, {options.inflight} in flight")
+    print(f"{'payload':>8} {'CPU us/msg':>11} {'peak bytes/msg':>15} {'over empty':>11} {'copies':>7}")
+    cpu, base = run(server, options, 0)
+    print(f"{0:>8} {cpu:>11.1f} {base:>15} {0:>11} {'':>7}")
+    for payload in options.payloads or [1024, 65536]:
+        cpu, peak = run(server, options, payload)
+        print(f"{payload:>8} {cpu:>11.1f} {peak:>15} {peak - base:>11} {(peak - base) / payload:>7.1f}")
+
+    server.stop()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# shutdowntest - check that pqserver stops promptly with clients still connected
+#
+#   python3 testing/shutdowntest.py
+#
+# Stops a PQServer in this process while a protocol 1 operator, an idle
+# CAD connection and a client that never said hello are all connected,
+# then does the same to pqserver --workers 2 with SIGTERM.  From Python
+# 3.12 asyncio's Server.wait_closed() waits for every connection to
+# close, so a stop() that waits on it too early hangs here.
+
+import subprocess
+import argparse
+import asyncio
+import signal
+import socket
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pqserver import PQServer
+from ackbench import waitforport
+from loadtest import pqserver
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Check that pqserver stops promptly with clients still connected"
+        )
+
+    parser.add_argument("--cad-port", dest="cadport", type=int, default=16201,
+                        help="CAD port for the pqserver under test")
+    parser.add_argument("--clientport", dest="clientport", type=int, default=16200,
+                        help="pqclient port for the pqserver under test")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=5,
+                        help="seconds pqserver may take to stop")
+
+    return parser.parse_args()
+
+def connectall(options):
+    """connectall() -- Open one of each kind of idle connection pqserver must not wait for
+
+    Params:
+    options -- command-line options
+
+    Throws:
+    OSError if pqserver isn't listening
+
+    Returns:
+    List of connected sockets
+    """
+
+    operator = socket.create_connection(("localhost", options.clientport))
+    operator.sendall(b"7")
+    operator.settimeout(options.timeout)
+    if operator.recv(32) != b"OK\n":
+        raise RuntimeError("pqserver didn't accept the protocol 1 operator")
+
+    cad = socket.create_connection(("localhost", options.cadport))
+    cad.sendall(b"7\n")
+    silent = socket.create_connection(("localhost", options.clientport))
+    return [operator, cad, silent]
+
+async def inprocess(options):
+    """inprocess() -- Time PQServer.stop() with clients connected
+
+    Params:
+    options -- command-line options
+
+    Throws:
+    None
+
+    Returns:
+    Seconds stop() took, or None if it didn't finish within the timeout
+    """
+
+    server = PQServer(cadport=options.cadport, clientport=options.clientport)
+    await server.start()
+
+    loop = asyncio.get_running_loop()
+    sockets = await loop.run_in_executor(None, connectall, options)
+    await asyncio.sleep(0.2)
+
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(server.stop(), options.timeout)
+        return time.monotonic() - started
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        for sock in sockets:
+            sock.close()
+
+def workers(options):
+    """workers() -- Time pqserver --workers 2 exiting on SIGTERM with clients connected
+
+    Params:
+    options -- command-line options
+
+    Throws:
+    None
+
+    Returns:
+    Seconds it took to exit, or None if it didn't within the timeout
+    """
+
+    server = subprocess.Popen([sys.executable, pqserver,
+                               "--cad-port", str(options.cadport),
+                               "--clientport", str(options.clientport),
+                               "--workers", "2"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sockets = []
+    try:
+        waitforport(options.cadport)
+        waitforport(options.clientport)
+        sockets = connectall(options)
+        time.sleep(0.2)
+
+        started = time.monotonic()
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(options.timeout)
+            return time.monotonic() - started
+        except subprocess.TimeoutExpired:
+            return None
+
+    finally:
+        for sock in sockets:
+            sock.close()
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+
+if __name__ == "__main__":
+    options = parsecmdline()
+
+    failed = False
+    for name, seconds in [("PQServer.stop()", asyncio.run(inprocess(options))),
+                          ("pqserver --workers 2, SIGTERM", workers(options))]:
+        if seconds is None:
+            print(f"{name}: FAILED, still running after {options.timeout}s")
+            failed = True
+        else:
+            print(f"{name}: stopped in {seconds:.2f}s")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# workerbench - CAD messages per second through pqserver as --workers grows
+#
+#   python3 testing/workerbench.py --workers 1 --workers 2 --workers 4 --duration 10
+#
+# For each worker count, starts pqserver on spare ports, connects a fleet
+# of simulated pqclients and then has several sender processes push CAD
+# messages to random operators as fast as pqserver answers them, each
+# with a few connections in flight.  Operators and CAD connections land
+# on whichever worker the kernel picks, so most messages cross from one
+# worker to another just as they would in production.  Throughput only
+# grows with workers on a machine with a spare core for each of them
+# plus the senders.
+
+import subprocess
+import argparse
+import random
+import time
+import sys
+import os
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+from ackbench import waitforport, percentile
+from loadtest import Fleet, cadsend, raisefdlimit, pqserver
+
+def parsecmdline():
+    """parsecmdline() -- parses cmd-line arguments
+
+    Params:
+    None
+
+    Throws:
+    None
+
+    Returns:
+    options -- dictionary of selected command-line options
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Measure pqserver throughput with increasing --workers"
+        )
+
+    parser.add_argument("--workers", dest="workers", type=int, action="append",
+                        help="worker count to test (repeatable, default 1, 2 and every core)")
+    parser.add_argument("--operators", dest="operators", type=int, default=100,
+                        help="number of simulated pqclients")
+    parser.add_argument("--senders", dest="senders", type=int, default=os.cpu_count(),
+                        help="processes sending CAD messages")
+    parser.add_argument("--concurrency", dest="concurrency", type=int, default=8,
+                        help="CAD connections each sender keeps in flight")
+    parser.add_argument("--duration", dest="duration", type=float, default=5,
+                        help="seconds to send CAD messages for at each worker count")
+    parser.add_argument("--payload", dest="payload", type=int, default=2048,
+                        help="bytes of message body per CAD message")
+    parser.add_argument("--cad-port", dest="cadport", type=int, default=16001,
+                        help="CAD port for the pqserver under test")
+    parser.add_argument("--clientport", dest="clientport", type=int, default=16000,
+                        help="pqclient port for the pqserver under test")
+    parser.add_argument("--server-arg", dest="serverargs", action="append", default=[],
+                        help="extra argument to pass to pqserver (repeatable)")
+
+    return parser.parse_args()
+
+def sender(args):
+    """sender() -- Send CAD messages back to back until the time is up
+
+    Params:
+    args -- (CAD port, operators, concurrency, payload, end time) tuple
+
+    Throws:
+    None
+
+    Returns:
+    List of (seconds, reply) tuples, one per message
+    """
+
+    port, operators, concurrency, payload, end = args
+    body = "x" * payload
+
+    def loop():
+        results = []
+        while time.time() < end:
+            sent, seconds, reply = cadsend(port, random.randint(1, operators), body)
+            results.append((seconds, reply))
+        return results
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        futures = [pool.submit(loop) for n in range(concurrency)]
+    return [result for future in futures for result in future.result()]
+
+def run(options, workers):
+    """run() -- Measure throughput with one worker count
+
+    Params:
+    options -- command-line options
+    workers -- value for pqserver's --workers
+
+    Throws:
+    None
+
+    Returns:
+    (messages per second, failures, p50 ms, p99 ms) tuple
+    """
+
+    server = subprocess.Popen([sys.executable, pqserver,
+                               "--cad-port", str(options.cadport),
+                               "--clientport", str(options.clientport),
+                               "--max-operators", str(options.operators),
+                               "--workers", str(workers)] + options.serverargs,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    fleet = None
+    try:
+        waitforport(options.cadport)
+        waitforport(options.clientport)
+        fleet = Fleet(options.clientport, options.operators)
+
+        # Give registrations time to reach every worker
+        time.sleep(0.5)
+
+        end = time.time() + options.duration
+        with Pool(options.senders) as pool:
+            batches = pool.map(sender, [(options.cadport, options.operators, options.concurrency,
+                                         options.payload, end)] * options.senders)
+        results = [result for batch in batches for result in batch]
+
+    finally:
+        if fleet:
+            fleet.stop()
+        server.terminate()
+        server.wait()
+
+    latencies = [seconds * 1000 for seconds, reply in results]
+    failures = len([reply for seconds, reply in results if reply != "OK"])
+    return (len(results) / options.duration, failures,
+            percentile(latencies, 50), percentile(latencies, 99))
+
+if __name__ == "__main__":
+    options = parsecmdline()
+    raisefdlimit()
+
+    counts = options.workers or sorted({1, 2, os.cpu_count()})
+
+    print(f"{options.operators} operators, {options.senders} senders x {options.concurrency} "
+          f"connections, {options.payload} byte bodies, {os.cpu_count()} cores")
+    print(f"{'workers':>7} {'msgs/s':>9} {'scaling':>8} {'fail':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    base = None
+    for workers in counts:
+        rate, failures, p50, p99 = run(options, workers)
+        base = base or rate
+        print(f"{workers:>7} {rate:>9.0f} {rate / base:>7.2f}x {failures:>6} {p50:>8.2f} {p99:>8.2f}")